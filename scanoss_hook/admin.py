@@ -0,0 +1,207 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Administration endpoints served by all the webhook handlers.
+
+ - GET /metrics: the metrics registry in the Prometheus text format
+ - GET /admin/profile: the profiling state
+ - POST /admin/profile[?seconds=N][&jobs=N]: arms on-demand profiling and returns the profiling state
+ - GET /admin/scanoss: the concurrency limit and circuit breaker state of the SCANOSS API clients
+ - GET /admin/results?repo=R&commit=C: the stored results of the latest scan of a commit
+ - GET /admin/results/comment?repo=R&commit=C: the comment of a commit, rendered again from its stored results
+ - GET /admin/results/cyclonedx?repo=R&commit=C: the CycloneDX components of a commit, from its stored results
+ - GET /admin/results/purl?purl=P[&version=V][&repo=R]: the commits whose latest scan matched a purl
+ - GET /admin/results/md5?md5=M: the commits where a file with the given MD5 was scanned
+
+The /admin/results endpoints only read the results store (see scanoss_hook.results_store), they do not contact the
+git host or the SCANOSS API.
+
+The /admin endpoints require the 'Authorization: Bearer <token>' header when 'admin: token' is configured. The
+/admin/results endpoints expose the scanned code of all the repositories and POST /admin/profile slows down the jobs,
+they answer 403 unless a token is configured.
+"""
+
+import hmac
+import json
+from urllib import parse
+
+from scanoss_hook import metrics, profiling, results_store, scanoss_client
+from scanoss_hook.scanner import Scanner
+
+
+def send_json(request_handler, status, data):
+  """ Writes a JSON response to a BaseHTTPRequestHandler.
+  """
+  body = json.dumps(data).encode()
+  request_handler.send_response(status)
+  request_handler.send_header("Content-Type", "application/json")
+  request_handler.send_header("Content-Length", str(len(body)))
+  request_handler.end_headers()
+  request_handler.wfile.write(body)
+
+
+def _token(request_handler):
+  return ((request_handler.config or {}).get('admin') or {}).get('token')
+
+
+def _authorized(request_handler):
+  token = _token(request_handler)
+  if not token:
+    return True
+  return hmac.compare_digest(request_handler.headers.get('Authorization', ''), "Bearer %s" % token)
+
+
+def _profile(request_handler, query):
+  send_json(request_handler, 200, profiling.status())
+
+
+def _arm_profile(request_handler, query):
+  seconds = float(query.get('seconds', ['0'])[0])
+  count = int(query.get('jobs', ['0'])[0])
+  if seconds < 0 or count < 0:
+    raise ValueError("The profiling seconds and jobs cannot be negative")
+  if seconds or count:
+    profiling.arm(seconds=seconds, jobs=count)
+  send_json(request_handler, 200, profiling.status())
+
+
+def _scanoss(request_handler, query):
+  send_json(request_handler, 200, {"clients": scanoss_client.status()})
+
+
+def _param(query, name):
+  values = query.get(name)
+  if not values or not values[0]:
+    raise ValueError("Missing parameter: %s" % name)
+  return values[0]
+
+
+def _stored_commit(request_handler, query):
+  """ Returns the latest stored scan of the commit given by the query, None after answering 404 if there is none.
+  """
+  store = results_store.get_store()
+  if store is None:
+    send_json(request_handler, 404, {"error": "The results store is not configured"})
+    return None
+  scan = store.get_commit(_param(query, 'repo'), _param(query, 'commit'))
+  if scan is None:
+    send_json(request_handler, 404, {"error": "No results stored for this commit"})
+  return scan
+
+
+def _format(request_handler, scan):
+  scanner = Scanner(request_handler.config)
+  if not scan["results"]:
+    return scanner, {"validation": True, "comment": "No results", "cyclondx": {}}
+  return scanner, scanner.format_scan_results(scan["results"])
+
+
+def _results(request_handler, query):
+  scan = _stored_commit(request_handler, query)
+  if scan is not None:
+    send_json(request_handler, 200, scan)
+
+
+def _results_comment(request_handler, query):
+  scan = _stored_commit(request_handler, query)
+  if scan is None:
+    return
+  scanner, result = _format(request_handler, scan)
+  comment = result["comment"]
+  if scan["provider"] == "github":
+    sbom_file = (request_handler.config.get('scanoss') or {}).get('sbom_filename', "SBOM.json")
+    comment = scanner.format_sbom_comment(result, scan["assets"], sbom_file)
+  send_json(request_handler, 200, {"repo": scan["repo"], "commit": scan["commit"], "validation": result["validation"],
+                                   "comment": comment})
+
+
+def _results_cyclonedx(request_handler, query):
+  scan = _stored_commit(request_handler, query)
+  if scan is None:
+    return
+  _, result = _format(request_handler, scan)
+  send_json(request_handler, 200, result["cyclondx"] or {"bomFormat": "CycloneDX", "specVersion": "1.2",
+                                                           "version": 1, "components": []})
+
+
+def _results_purl(request_handler, query):
+  store = results_store.get_store()
+  if store is None:
+    send_json(request_handler, 404, {"error": "The results store is not configured"})
+    return
+  purl = _param(query, 'purl')
+  version = query.get('version', [None])[0]
+  matches = store.find_purl(purl, version=version, repo=query.get('repo', [None])[0])
+  send_json(request_handler, 200, {"purl": purl, "version": version, "matches": matches})
+
+
+def _results_md5(request_handler, query):
+  store = results_store.get_store()
+  if store is None:
+    send_json(request_handler, 404, {"error": "The results store is not configured"})
+    return
+  md5 = _param(query, 'md5')
+  send_json(request_handler, 200, {"md5": md5, "files": store.find_md5(md5)})
+
+
+ROUTES = {
+    '/admin/profile': _profile,
+    '/admin/scanoss': _scanoss,
+    '/admin/results': _results,
+    '/admin/results/comment': _results_comment,
+    '/admin/results/cyclonedx': _results_cyclonedx,
+    '/admin/results/purl': _results_purl,
+    '/admin/results/md5': _results_md5,
+}
+
+POST_ROUTES = {
+    '/admin/profile': _arm_profile,
+}
+
+# Routes served only when 'admin: token' is configured
+TOKEN_ROUTES = {path for path in ROUTES if path.startswith('/admin/results')}
+
+
+def _serve(request_handler, url, route, token_required):
+  if token_required and not _token(request_handler):
+    send_json(request_handler, 403, {"error": "This endpoint requires 'admin: token' to be configured"})
+    return True
+  if not _authorized(request_handler):
+    send_json(request_handler, 401, {"error": "Not authorized"})
+    return True
+  try:
+    route(request_handler, parse.parse_qs(url.query))
+  except ValueError as e:
+    send_json(request_handler, 400, {"error": str(e)})
+  return True
+
+
+def handle_get(request_handler):
+  """ Serves the administration endpoints. Returns False if the request path is not one of them.
+  """
+  url = parse.urlsplit(request_handler.path)
+  if url.path == '/metrics':
+    metrics.send_metrics(request_handler)
+    return True
+  route = ROUTES.get(url.path)
+  if route is None:
+    return False
+  return _serve(request_handler, url, route, url.path in TOKEN_ROUTES)
+
+
+def handle_post(request_handler):
+  """ Serves the administration endpoints that change the state of the server, they all require 'admin: token'.
+  Returns False if the request path is not one of them.
+  """
+  url = parse.urlsplit(request_handler.path)
+  route = POST_ROUTES.get(url.path)
+  if route is None:
+    return False
+  # Drain the body so that the connection can be reused
+  length = int(request_handler.headers.get('Content-Length') or 0)
+  if length:
+    request_handler.rfile.read(length)
+  return _serve(request_handler, url, route, True)
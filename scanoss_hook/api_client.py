@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Shared HTTP client used for the git host APIs.
+
+All the outgoing calls to GitLab and Bitbucket go through request(), which uses a pooled requests.Session per
+host and schedules the call through the RateLimiter of the (host, token) pair. Responses are requested compressed
+and their transfer is counted (see scanoss_hook.compression). Every call is bounded by DEFAULT_TIMEOUT seconds, or
+less when the deadline of the calling job is closer (see jobs.timeout).
+"""
+
+import logging
+import threading
+from urllib import parse
+
+import requests
+import requests.adapters
+
+from scanoss_hook import compression, jobs, metrics, tracing
+from scanoss_hook.ratelimit import PRIORITY_NORMAL, get_limiter
+
+MAX_THROTTLED_RETRIES = 3
+# Seconds a job waits before retrying after a transient error, when the host does not send Retry-After
+RETRY_DELAY = 60
+# Seconds to connect or to wait for data from the git host
+DEFAULT_TIMEOUT = 60
+# Connections kept open per host, enough for the parallel fetches of several jobs
+POOL_MAXSIZE = 32
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(host):
+  """ Returns the shared requests.Session used for a host.
+  """
+  with _sessions_lock:
+    session = _sessions.get(host)
+    if session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_MAXSIZE)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      session.headers['Accept-Encoding'] = compression.ACCEPT_ENCODING
+      _sessions[host] = session
+    return session
+
+
+def request(method, url, token=None, priority=PRIORITY_NORMAL, **kwargs):
+  """ Performs an HTTP request against a git host API honouring its rate limits.
+  Raises jobs.JobCancelled if the job performing the request has been superseded, jobs.DeadlineExceeded if it runs
+  out of time before or during the request.
+
+  Parameters
+  ----------
+  method : str
+    The HTTP method.
+  url : str
+    The full URL of the request.
+  token : str
+    The API token or user used for the request, identifies the rate limit bucket.
+  priority : int
+    The priority of the request, see scanoss_hook.ratelimit.
+  kwargs :
+    Extra arguments for requests.Session.request. Without a timeout, the call is bounded by DEFAULT_TIMEOUT and the
+    deadline of the job. The transfer of streamed responses (stream=True) is counted
+    when they are read with compression.iter_response.
+  """
+  host = parse.urlsplit(url).netloc
+  limiter = get_limiter(host, token)
+  session = get_session(host)
+  attempt = 0
+  while True:
+    jobs.check_cancelled()
+    limiter.acquire(priority)
+    timeout = kwargs.pop('timeout', None) or jobs.timeout(DEFAULT_TIMEOUT)
+    with tracing.span("http %s" % method, host=host, path=parse.urlsplit(url).path) as s:
+      try:
+        r = session.request(method, url, timeout=timeout, **kwargs)
+      except requests.Timeout:
+        # Timed out by the deadline of the job rather than by a slow host
+        jobs.check_cancelled()
+        raise
+      s.set(status=r.status_code)
+    limiter.update(r.status_code, r.headers)
+    metrics.inc_counter("scanoss_hook_api_requests_total", labels={"host": host, "status": r.status_code})
+    if not kwargs.get('stream'):
+      compression.record_response(host, r)
+    if r.status_code != 429 or attempt >= MAX_THROTTLED_RETRIES:
+      return r
+    attempt += 1
+    logging.warning("Rate limited by %s, retrying request (%d/%d)", host, attempt, MAX_THROTTLED_RETRIES)
+
+
+def check_transient(r, what):
+  """ Raises jobs.RetryLater if a response is a transient error (429 or 5xx), so the job is retried later instead
+  of going on without what it was fetching.
+  """
+  if r.status_code != 429 and r.status_code < 500:
+    return
+  try:
+    delay = float(r.headers.get('Retry-After'))
+  except (TypeError, ValueError):
+    delay = RETRY_DELAY
+  raise jobs.RetryLater("Cannot fetch %s, the server returned status %d" % (what, r.status_code), delay)
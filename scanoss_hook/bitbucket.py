@@ -3,15 +3,18 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler
 from typing import Any
 
 import json
 import logging
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+from scanoss_hook import admin, api_client, cache, capture, compression, fingerprinting, jobs, logs, tracing
+from scanoss_hook.results_store import Source
+from scanoss_hook.ratelimit import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
 from scanoss_hook.scanner import Scanner
-from scanoss_hook.diff_parser import parse_diff
 
 # CONSTANTS
 BB_HEADER_EVENT = 'X-Event-Key'
@@ -20,9 +23,23 @@ BB_EVENT_PUSH = 'repo:push'
 
 BB_STATUS_SUCC = 'SUCCESSFUL'
 BB_STATUS_FAIL = 'FAILED'
+BB_TIMEOUT_DESCRIPTION = 'SCANOSS scan timed out in the %s stage'
+
+BB_DIFFSTAT_PAGELEN = 100
+DEFAULT_FETCH_WORKERS = 8
 
-# Executor
-executor = ThreadPoolExecutor(max_workers=10)
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+
+
+def get_fetch_pool(workers):
+  """ Returns the thread pool shared by all the jobs to fetch file contents in parallel.
+  """
+  global _fetch_pool
+  with _fetch_pool_lock:
+    if _fetch_pool is None:
+      _fetch_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bitbucket-fetch")
+    return _fetch_pool
 
 
 class BitbucketAPI:
@@ -37,61 +54,114 @@ class BitbucketAPI:
     The Bitbucket API Username
   base_url : str
     The Bitbucket API Base url.
+  fetch_workers : int
+    The number of files fetched in parallel.
 
   Methods
   -------
+  get_diffstat(base_url, commit)
+    Returns the files added or modified by a commit.
+
+  get_fingerprints(base_url, commit, filenames)
+    Fetches and fingerprints files of a commit in parallel.
   """
 
   def __init__(self, config):
     self.api_key = config['bitbucket']['api-key']
     self.api_user = config['bitbucket']['api-user']
     self.base_url = config['bitbucket']['api-base']
-
-  def get_commit_diff(self, base_url, commit):
-    request_url = "%s/diff/%s" % (base_url, commit['hash'])
-
-    r = requests.get(request_url, auth=(self.api_user, self.api_key))
-    if r.status_code != 200:
-      logging.error(
-          "There was an error trying to obtain diff for commit, the server returned status %d", r.status_code)
-      return None
-    return r.text
-
-  def get_files_in_commit_diff(self, base_url, commit):
-    diff = self.get_commit_diff(base_url, commit)
-    obj, _ = parse_diff(diff)
-    return list(obj.keys())
+    self.fetch_workers = int(config['bitbucket'].get('fetch-workers', DEFAULT_FETCH_WORKERS))
+
+  def _request(self, method, url, priority, **kwargs):
+    return api_client.request(method, url, token=self.api_user, priority=priority,
+                              auth=(self.api_user, self.api_key), **kwargs)
+
+  def get_diffstat(self, base_url, commit):
+    """ Returns the paths of the files added or modified by a commit, following the pages of the diffstat
+    endpoint. Returns None on error, raises jobs.RetryLater on a transient error.
+    """
+    url = "%s/diffstat/%s" % (base_url, commit['hash'])
+    params = {"pagelen": BB_DIFFSTAT_PAGELEN}
+    paths = []
+    while url:
+      r = self._request("GET", url, PRIORITY_HIGH, params=params)
+      api_client.check_transient(r, "the diffstat of %s" % commit['hash'])
+      if r.status_code != 200:
+        logging.error(
+            "There was an error trying to obtain diffstat for commit, the server returned status %d", r.status_code)
+        return None
+      data = r.json()
+      # We don't care about deleted files
+      paths += [v['new']['path'] for v in data.get('values', []) if v.get('status') != 'removed' and v.get('new')]
+      # The next page URL already has the query parameters
+      url = data.get('next')
+      params = None
+    return paths
+
+  def get_file_fingerprint(self, base_url, commit, filename, priority=PRIORITY_HIGH):
+    """ Returns the winnowing.Fingerprint of a file at a commit, None if it cannot be fetched. Raises jobs.RetryLater
+    on a transient error, so the commit is not scanned without the file. The contents are fingerprinted as they are
+    downloaded, and files already fingerprinted are not downloaded again.
+    """
+    url = "%s/src/%s/%s" % (base_url, commit['hash'], parse.quote(filename))
+    md5 = cache.blobs.get(url)
+    if md5 is not None:
+      fingerprint = cache.fingerprints.get(md5)
+      if fingerprint is not None:
+        return fingerprint
+    jobs.check_cancelled()
+    logs.sampled_debug("file", "Fetching %s at %s", filename, commit['hash'])
+    r = self._request("GET", url, priority, stream=True)
+    with r:
+      api_client.check_transient(r, "%s at %s" % (filename, commit['hash']))
+      if r.status_code != 200:
+        logging.warning("Cannot fetch %s at %s, the server returned status %d", filename, commit['hash'],
+                        r.status_code)
+        return None
+      size = r.headers.get('Content-Length')
+      fingerprint = fingerprinting.fingerprint_stream(compression.iter_response(parse.urlsplit(url).netloc, r),
+                                                      int(size) if size else None)
+    cache.fingerprints.put(fingerprint.md5, fingerprint)
+    cache.blobs.put(url, fingerprint.md5)
+    return fingerprint
+
+  def get_fingerprints(self, base_url, commit, filenames):
+    """ Returns a dictionary with the fingerprints of files of a commit, fetched in parallel.
+    """
+    fetch = jobs.bind(lambda filename: self.get_file_fingerprint(base_url, commit, filename))
+    fingerprints = get_fetch_pool(self.fetch_workers).map(fetch, filenames)
+    return {f: fp for f, fp in zip(filenames, fingerprints) if fp is not None}
 
   def post_commit_comment(self, base_url, commit, comment):
 
     comments_url = "%s/commit/%s/comments" % (base_url, commit['hash'])
     logging.debug("Posting comment to URL: %s, comment: %s",
-                  comments_url, comment)
-    r = requests.post(comments_url, json={"content": {"raw": comment}},
-                      auth=(self.api_user, self.api_key))
+                  comments_url, logs.payload(comment))
+    r = self._request("POST", comments_url, PRIORITY_LOW, json={"content": {"raw": comment}})
     if r.status_code >= 400:
       logging.error(
           "There was an error posting a comment for commit, the server returned status %d, and response: %s", r.status_code, r.text)
 
   def get_assets_json_file(self, base_url, commit):
-    return self.get_file_contents(base_url, commit, "oss_assets.json")
+    return self.get_file_contents(base_url, commit, "oss_assets.json", PRIORITY_LOW)
 
-  def get_file_contents(self, base_url, commit, filename):
+  def get_file_contents(self, base_url, commit, filename, priority=PRIORITY_HIGH):
     url = "%s/src/%s/%s" % (base_url, commit['hash'], filename)
-    logging.debug('Getting file contents from url: %s', url)
-    r = requests.get(url, auth=(self.api_user, self.api_key))
+    logs.sampled_debug("file", 'Getting file contents from url: %s', url)
+    r = self._request("GET", url, priority)
     if r.status_code == 200:
-      # obtain the download_url and request content from that URL
-      return r.text.encode()
+      return r.content
     return None
 
-  def update_build_status(self, base_url, commit, status=False):
+  def update_build_status(self, base_url, commit, status=False, description=None):
 
     logging.debug("Updating build status for commit %s", commit['hash'])
     url = "%s/commit/%s/statuses/build" % (base_url, commit['hash'])
     data = {"state": BB_STATUS_SUCC if status else BB_STATUS_FAIL,
             "key": commit['hash'], "url": "https://www.scanoss.co.uk"}
-    r = requests.post(url, json=data, auth=(self.api_user, self.api_key))
+    if description:
+      data["description"] = description
+    r = self._request("POST", url, PRIORITY_NORMAL, json=data)
     if r.status_code >= 400:
       logging.error(
           "There was an error updating build status for commit %s, %s", commit['hash'], r.text)
@@ -100,16 +170,35 @@ class BitbucketAPI:
 class BitbucketRequestHandler(BaseHTTPRequestHandler):
   """A Bitbucket hook request handler."""
 
+  provider = 'bitbucket'
+
   def __init__(self, config, *args: Any) -> None:
+    self.configure(config)
+    BaseHTTPRequestHandler.__init__(self, *args)
+
+  def configure(self, config) -> bool:
+    """ Sets up the handler for the given configuration, also used by the routed mode.
+    """
     self.config = config
     self.scanner = Scanner(config)
     self.base_url = self.config['bitbucket']['api-base']
     self.api = BitbucketAPI(config)
     logging.debug("Starting BitbucketRequestHandler with base_url: %s",
                   self.base_url)
-    BaseHTTPRequestHandler.__init__(self, *args)
+    return True
+
+  def do_GET(self):
+    """ Serves the metrics and administration endpoints.
+    """
+    if admin.handle_get(self):
+      return
+    self.send_response(404, "Not Found")
+    self.end_headers()
 
+  @tracing.traced("bitbucket.webhook", new_trace=True)
   def do_POST(self):
+    if admin.handle_post(self):
+      return
 
     # We are only interested in push events
     if self.headers.get(BB_HEADER_EVENT) != BB_EVENT_PUSH:
@@ -120,8 +209,6 @@ class BitbucketRequestHandler(BaseHTTPRequestHandler):
     # get payload
     header_length = int(self.headers['Content-Length'])
     json_payload = self.rfile.read(header_length).decode()
-    with open('/tmp/bb_payload', 'w') as f:
-      f.write(json_payload)
     json_params = {}
     if len(json_payload) > 0:
       json_params = json.loads(json_payload)
@@ -135,10 +222,13 @@ class BitbucketRequestHandler(BaseHTTPRequestHandler):
       self.send_response(200, "OK")
       self.end_headers()
       return
+    # Bitbucket deliveries are not signed, only push events are captured
+    capture.record(self.provider, self, json_payload)
     # Return OK to Bitbucket and keep processing using executor workers.
     logging.debug("Returning 200 OK")
     self.send_response(200, "OK")
     self.end_headers()
+    repository = json_params.get('repository') or {}
     # In Bitbucket API, the Event payload for a repo:push event may contain many 'changes'
     # Each of the 'changes' may contain several commits.
     for change in json_params['push'].get('changes'):
@@ -152,34 +242,56 @@ class BitbucketRequestHandler(BaseHTTPRequestHandler):
           logging.error("No Diff URL provided by the JSON payload, returning")
           return
 
-        # Process via executor
-        executor.submit(self.process_commits_diff(base_url, commits))
+        # Process via the job scheduler
+        key = "bitbucket:%s" % repository.get('full_name', base_url)
+        ref = (change.get('new') or {}).get('name')
+        jobs.dispatch(self, 'process_commits_diff', key, base_url, commits, cost=len(commits),
+                      supersede=(key, ref) if ref else None)
 
   def process_commits_diff(self, base_url, commits):
     logging.debug("Processing commits")
     # For each commit in push
-    files = {}
     for commit in commits:
-      # Get the contents of files in the commit
-      for filename in self.api.get_files_in_commit_diff(base_url, commit):
-        contents = self.api.get_file_contents(base_url, commit, filename)
-        if contents:
-          files[filename] = contents
+      # Commits reported before the job was parked are not scanned again
+      if jobs.is_completed(commit['hash']):
+        continue
+      try:
+        self.process_commit(base_url, commit)
+        jobs.mark_completed(commit['hash'])
+      except jobs.DeadlineExceeded as e:
+        self.report_timeout(base_url, commit, commits[0], e)
+        raise
+    logging.debug("Finished processing commits")
 
-      # Send diff to scanner and obtain results
+  def process_commit(self, base_url, commit):
+    # The repository API URL ends with /repositories/{workspace}/{repo_slug}
+    repo = base_url.split('/repositories/', 1)[-1]
+    # Get the fingerprints of the files changed by the commit
+    with jobs.stage("fetch"), tracing.span("fetch", commit=commit['hash']) as span:
+      files = self.api.get_fingerprints(base_url, commit, self.api.get_diffstat(base_url, commit) or [])
       asset_json = self.api.get_assets_json_file(base_url, commit)
-      scan_result = self.scanner.scan_files(files, asset_json)
-      if scan_result:
-        # Add a comment to the commit
-        comment = self.scanner.format_scan_results(scan_result)
-        if comment:
-
+      span.set(files=len(files))
+
+    # Send diff to scanner and obtain results
+    scan_result = self.scanner.scan_files(files, asset_json, Source(self.provider, repo, commit['hash']))
+    if scan_result:
+      # Add a comment to the commit
+      comment = self.scanner.format_scan_results(scan_result)
+      if comment:
+        with jobs.stage("report"), tracing.span("report", commit=commit['hash']):
           self.api.post_commit_comment(base_url, commit, comment['comment'])
           # Update build status for commit
           self.api.update_build_status(
               base_url, commit, comment['validation'])
-          logging.info("Updated comment and build status")
+        logging.info("Updated comment and build status")
 
-      else:
-        logging.info("The server returned no result for scan")
-    logging.debug("Finished processing commits")
+    else:
+      logging.info("The server returned no result for scan")
+
+  def report_timeout(self, base_url, commit, head, error):
+    """ Fails the build status of the commit that ran out of time and of the head commit of the push, which the
+    rest of the push is not scanned for. Bitbucket lists the commits of a push newest first, the head is the first.
+    """
+    with jobs.overtime(), tracing.span("report", commit=head['hash'], timed_out=True):
+      for commit in {c['hash']: c for c in (head, commit)}.values():
+        self.api.update_build_status(base_url, commit, False, BB_TIMEOUT_DESCRIPTION % error.stage)
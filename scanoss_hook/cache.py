@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Process wide caches shared by all the webhook providers.
+
+ - fingerprints: compact winnowing fingerprints (winnowing.Fingerprint) indexed by the MD5 of the file contents
+ - results: SCANOSS API responses indexed by the digest of the uploaded WFP and assets
+ - blobs: MD5 of the contents of files indexed by their immutable URL (e.g. at a commit), so files already
+   fingerprinted are not downloaded again
+
+In cluster mode the caches are backed by the cluster backend, so local misses are looked up in (and new entries
+are written to) the cache shared by all the nodes. When the backend fails, only the local cache is used.
+"""
+
+import collections
+import logging
+import threading
+
+from scanoss_hook import metrics
+from scanoss_hook.winnowing import Fingerprint
+
+DEFAULT_FINGERPRINTS_SIZE = 10000
+DEFAULT_RESULTS_SIZE = 1000
+DEFAULT_BLOBS_SIZE = 10000
+
+
+class LRUCache:
+  """
+  A thread safe least recently used cache.
+
+  Attributes
+  ----------
+  name : str
+    The name of the cache, used to label its metrics.
+  maxsize : int
+    The maximum number of entries.
+  backend : object
+    The shared cache backend (see scanoss_hook.cluster), None for a local only cache.
+  encode : function
+    Converts the values to JSON serializable values for the backend, None if they already are.
+  decode : function
+    Converts the values read from the backend back, None if they are used as they are.
+  """
+
+  def __init__(self, name, maxsize, encode=None, decode=None):
+    self.name = name
+    self.maxsize = maxsize
+    self.backend = None
+    self.encode = encode
+    self.decode = decode
+    self.data = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """ Returns the cached value for key, None if it is not cached.
+    """
+    with self.lock:
+      value = self.data.get(key)
+      if value is not None:
+        self.data.move_to_end(key)
+    if value is None and self.backend is not None:
+      try:
+        value = self.backend.cache_get(self.name, key)
+      except Exception as e:
+        logging.warning("Cannot read the shared %s cache: %s", self.name, e)
+        value = None
+      if value is not None:
+        if self.decode is not None:
+          value = self.decode(value)
+        self._store(key, value)
+    metrics.inc_counter("scanoss_hook_cache_%s_total" % ("hits" if value is not None else "misses"),
+                        labels={"cache": self.name})
+    return value
+
+  def put(self, key, value):
+    """ Stores value for key, evicting the least recently used entries if the cache is full.
+    """
+    self._store(key, value)
+    if self.backend is not None:
+      try:
+        self.backend.cache_set(self.name, key, self.encode(value) if self.encode is not None else value)
+      except Exception as e:
+        logging.warning("Cannot write the shared %s cache: %s", self.name, e)
+
+  def _store(self, key, value):
+    with self.lock:
+      self.data[key] = value
+      self.data.move_to_end(key)
+      while len(self.data) > self.maxsize:
+        self.data.popitem(last=False)
+      size = len(self.data)
+    metrics.set_gauge("scanoss_hook_cache_entries", size, {"cache": self.name})
+
+  def clear(self):
+    with self.lock:
+      self.data.clear()
+
+
+fingerprints = LRUCache("fingerprints", DEFAULT_FINGERPRINTS_SIZE, encode=Fingerprint.to_json,
+                        decode=Fingerprint.from_json)
+results = LRUCache("results", DEFAULT_RESULTS_SIZE)
+blobs = LRUCache("blobs", DEFAULT_BLOBS_SIZE)
+
+
+def configure(config):
+  """ Sets the cache sizes from the 'cache' configuration section.
+  """
+  if config:
+    fingerprints.maxsize = int(config.get('fingerprints', fingerprints.maxsize))
+    results.maxsize = int(config.get('results', results.maxsize))
+    blobs.maxsize = int(config.get('blobs', blobs.maxsize))
+
+
+def set_backend(backend):
+  """ Backs all the caches with a shared cluster backend, None to use local caches only.
+  """
+  fingerprints.backend = backend
+  results.backend = backend
+  blobs.backend = backend
@@ -0,0 +1,93 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Capture of webhook deliveries into a replayable corpus.
+
+When the 'capture' configuration section sets a directory, every authenticated webhook delivery is saved there as
+a JSON file with its provider, path, body and the headers in CAPTURED_HEADERS. The secret token and signature
+headers are never saved: the scanoss-hook-loadtest tool adds them again when replaying the corpus.
+
+The directory is trimmed to the newest 'max-files' deliveries every max-files / 10 captures, so it may briefly hold
+a few more.
+
+Configuration example:
+
+capture:
+  dir: /var/lib/scanoss-hook/corpus
+  max-files: 1000
+"""
+
+import itertools
+import json
+import logging
+import os
+import time
+
+DEFAULT_MAX_FILES = 1000
+# Headers saved with the deliveries (lower case): the event, delivery ID and content type
+CAPTURED_HEADERS = {'content-type', 'user-agent', 'x-github-event', 'x-github-delivery', 'x-gitlab-event',
+                    'x-gitlab-event-uuid', 'x-event-key', 'x-request-uuid', 'x-hook-uuid', 'x-attempt-number'}
+
+_settings = {"dir": None, "max-files": DEFAULT_MAX_FILES}
+_counter = itertools.count()
+
+
+def configure(config):
+  """ Sets up the capture from the 'capture' configuration section.
+  """
+  _settings["dir"] = None
+  if config and config.get('dir'):
+    _settings["dir"] = config['dir']
+    _settings["max-files"] = int(config.get('max-files', DEFAULT_MAX_FILES))
+    os.makedirs(_settings["dir"], exist_ok=True)
+
+
+def record(provider, request_handler, body):
+  """ Saves a webhook delivery in the corpus, if capture is enabled.
+
+  Parameters
+  ----------
+  provider : str
+    The provider that received the delivery.
+  request_handler : BaseHTTPRequestHandler
+    The handler of the request, used to obtain its path and headers.
+  body : bytes or str
+    The payload of the delivery.
+  """
+  directory = _settings["dir"]
+  if not directory:
+    return
+  if isinstance(body, bytes):
+    body = body.decode('utf-8', errors='replace')
+  headers = {k: v for k, v in request_handler.headers.items() if k.lower() in CAPTURED_HEADERS}
+  delivery = {"time": time.time(), "provider": provider, "path": request_handler.path, "headers": headers,
+              "body": body}
+  count = next(_counter)
+  name = "%d-%d-%06d-%s.json" % (time.time() * 1000, os.getpid(), count, provider)
+  try:
+    with open(os.path.join(directory, name), "w") as f:
+      json.dump(delivery, f)
+    if count % max(1, _settings["max-files"] // 10) == 0:
+      _prune(directory)
+  except OSError as e:
+    logging.error("Cannot capture webhook delivery: %s", e)
+
+
+def _prune(directory):
+  files = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+  for name in files[:max(0, len(files) - _settings["max-files"])]:
+    os.remove(os.path.join(directory, name))
+
+
+def load(directory):
+  """ Returns the deliveries of a corpus directory, in capture order.
+  """
+  deliveries = []
+  for name in sorted(os.listdir(directory)):
+    if name.endswith('.json'):
+      with open(os.path.join(directory, name)) as f:
+        deliveries.append(json.load(f))
+  return deliveries
@@ -0,0 +1,456 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Cluster mode for running the SCANOSS webhook on several nodes behind a load balancer.
+
+The nodes share a job queue and the fingerprint/result caches through a pluggable backend:
+ - SQLiteBackend: a SQLite database on a local or shared file system (sqlite:///path/to/cluster.db)
+ - RedisBackend: any server speaking the Redis protocol (redis://host:port/db)
+
+Jobs are routed to nodes by consistent hashing on the repository key, so the caches of a repository stay hot on
+one node and its superseded jobs are cancelled where they run.
+
+A webhook delivered more than once (to the same or to different nodes) is only scanned once: every job claims the
+delivery ID given by the git host (see jobs.DELIVERY_HEADERS) first. The claim lasts PENDING_CLAIM_TTL seconds
+while the job is queued or running, so the job can be delivered again if its node dies. Once the job completes (or
+is superseded) the claim is kept for DEFAULT_CLAIM_TTL seconds. If the job fails or times out, the claim is released
+and a redelivery scans the commits again. Deliveries without an ID are never treated as duplicates.
+
+Every backend call is bounded by 'timeout' seconds. When the backend is unavailable the node falls back to local
+behaviour: deliveries are processed without a claim on this node and the caches are used without the shared one.
+
+Configuration example:
+
+cluster:
+  node: node-a
+  nodes: [node-a, node-b, node-c]
+  backend: redis://cache.internal:6379/0
+  timeout: 5
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from urllib import parse
+
+from scanoss_hook import cache, jobs, metrics, tracing
+
+DEFAULT_REPLICAS = 100
+DEFAULT_CACHE_TTL = 7 * 24 * 3600
+DEFAULT_CLAIM_TTL = 24 * 3600
+# Seconds to connect to the backend or to wait for its answer
+DEFAULT_TIMEOUT = 5
+# Claim of a job that is queued or running, longer than the default job budget
+PENDING_CLAIM_TTL = 1800
+POLL_INTERVAL = 1.0
+
+KEY_PREFIX = "scanoss-hook"
+
+
+class HashRing:
+  """
+  A consistent hashing ring of cluster nodes.
+
+  Methods
+  -------
+  node_for(key)
+    Returns the node that owns a key.
+  """
+
+  def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+    self.ring = []
+    for node in nodes:
+      for i in range(replicas):
+        self.ring.append((self._hash("%s#%d" % (node, i)), node))
+    self.ring.sort()
+    self.points = [point for point, _ in self.ring]
+
+  @staticmethod
+  def _hash(value):
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+  def node_for(self, key):
+    index = bisect.bisect(self.points, self._hash(key)) % len(self.ring)
+    return self.ring[index][1]
+
+
+class SQLiteBackend:
+  """
+  Cluster backend stored in a SQLite database.
+
+  Attributes
+  ----------
+  path : str
+    The path of the database file.
+  """
+
+  def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+    self.path = path
+    self.timeout = timeout
+    self.local = threading.local()
+    conn = self._conn()
+    conn.executescript("""
+      PRAGMA journal_mode=WAL;
+      CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, node TEXT NOT NULL, payload TEXT NOT NULL);
+      CREATE INDEX IF NOT EXISTS jobs_node ON jobs (node, id);
+      CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL);
+    """)
+
+  def _conn(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+      self.local.conn = conn
+    return conn
+
+  def push_job(self, node, payload):
+    self._conn().execute("INSERT INTO jobs (node, payload) VALUES (?, ?)", (node, json.dumps(payload)))
+
+  def pop_job(self, node, timeout):
+    deadline = time.monotonic() + timeout
+    conn = self._conn()
+    while True:
+      conn.execute("BEGIN IMMEDIATE")
+      try:
+        row = conn.execute("SELECT id, payload FROM jobs WHERE node = ? ORDER BY id LIMIT 1", (node,)).fetchone()
+        if row:
+          conn.execute("DELETE FROM jobs WHERE id = ?", (row[0],))
+      finally:
+        conn.execute("COMMIT")
+      if row:
+        return json.loads(row[1])
+      if time.monotonic() >= deadline:
+        return None
+      time.sleep(min(POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+
+  def _get(self, key):
+    row = self._conn().execute("SELECT value FROM kv WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def cache_get(self, namespace, key):
+    return self._get("cache:%s:%s" % (namespace, key))
+
+  def cache_set(self, namespace, key, value, ttl=DEFAULT_CACHE_TTL):
+    self._conn().execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                         ("cache:%s:%s" % (namespace, key), json.dumps(value), time.time() + ttl))
+
+  def claim(self, key, ttl=DEFAULT_CLAIM_TTL):
+    conn = self._conn()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      conn.execute("DELETE FROM kv WHERE key = ? AND expires <= ?", ("claim:" + key, now))
+      cursor = conn.execute("INSERT OR IGNORE INTO kv (key, value, expires) VALUES (?, '1', ?)",
+                            ("claim:" + key, now + ttl))
+      return cursor.rowcount == 1
+    finally:
+      conn.execute("COMMIT")
+
+  def renew(self, key, ttl=DEFAULT_CLAIM_TTL):
+    self._conn().execute("UPDATE kv SET expires = ? WHERE key = ?", (time.time() + ttl, "claim:" + key))
+
+  def release(self, key):
+    self._conn().execute("DELETE FROM kv WHERE key = ?", ("claim:" + key,))
+
+
+class BackendUnavailable(Exception):
+  """ Raised when the cluster backend cannot be reached or does not answer in time.
+  """
+
+
+# The errors meaning that the backend cannot be used now
+BACKEND_ERRORS = (BackendUnavailable, sqlite3.Error)
+
+
+class RedisError(Exception):
+  """ An error reply from a Redis protocol server.
+  """
+
+
+class RedisConnection:
+  """
+  A minimal client for the Redis serialization protocol (RESP). Connecting and every command are bounded by
+  timeout seconds, a socket.timeout leaves the connection unusable.
+  """
+
+  def __init__(self, host, port, db=0, password=None, timeout=DEFAULT_TIMEOUT):
+    self.sock = socket.create_connection((host, port), timeout=timeout)
+    self.reader = self.sock.makefile('rb')
+    if password:
+      self.execute("AUTH", password)
+    if db:
+      self.execute("SELECT", db)
+
+  def execute(self, *args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+      data = arg if isinstance(arg, bytes) else str(arg).encode()
+      parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    self.sock.sendall(b"".join(parts))
+    return self._read()
+
+  def _read(self):
+    line = self.reader.readline()
+    if not line:
+      raise ConnectionError("Connection closed by the Redis server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+      return rest.decode()
+    if kind == b"-":
+      raise RedisError(rest.decode())
+    if kind == b":":
+      return int(rest)
+    if kind == b"$":
+      length = int(rest)
+      if length < 0:
+        return None
+      data = self.reader.read(length + 2)
+      return data[:-2]
+    if kind == b"*":
+      count = int(rest)
+      if count < 0:
+        return None
+      return [self._read() for _ in range(count)]
+    raise RedisError("Unexpected reply from the Redis server: %r" % line)
+
+  def close(self):
+    self.reader.close()
+    self.sock.close()
+
+
+class RedisBackend:
+  """
+  Cluster backend stored in a Redis protocol server. Every thread uses its own connection, as pop_job() blocks
+  the connection it runs on.
+
+  Attributes
+  ----------
+  url : str
+    The redis://[:password@]host:port/db URL of the server.
+  timeout : float
+    Seconds to connect to the server or to wait for an answer. BackendUnavailable is raised when it expires.
+  """
+
+  def __init__(self, url, timeout=DEFAULT_TIMEOUT):
+    self.url = parse.urlsplit(url)
+    self.timeout = timeout
+    self.local = threading.local()
+
+  def _conn(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      db = self.url.path.strip('/') or 0
+      conn = RedisConnection(self.url.hostname or 'localhost', self.url.port or 6379, db=db,
+                             password=self.url.password, timeout=self.timeout)
+      self.local.conn = conn
+    return conn
+
+  def _drop(self):
+    conn = getattr(self.local, 'conn', None)
+    self.local.conn = None
+    if conn is not None:
+      try:
+        conn.close()
+      except OSError:
+        pass
+
+  def _execute(self, *args, block=0):
+    """ Runs a command that may block the server side for 'block' seconds. Raises BackendUnavailable if the server
+    cannot be reached or does not answer in time.
+    """
+    for attempt in range(2):
+      try:
+        conn = self._conn()
+        conn.sock.settimeout(self.timeout + block)
+        return conn.execute(*args)
+      except socket.timeout as e:
+        # A hung server is not retried, the call would block again
+        self._drop()
+        raise BackendUnavailable("The Redis server did not answer %s in %s seconds" % (args[0], self.timeout)) from e
+      except (OSError, ConnectionError) as e:
+        # Reconnect once, the server may have been restarted
+        self._drop()
+        if attempt:
+          raise BackendUnavailable("Cannot reach the Redis server: %s" % e) from e
+    return None
+
+  def push_job(self, node, payload):
+    self._execute("LPUSH", "%s:jobs:%s" % (KEY_PREFIX, node), json.dumps(payload))
+
+  def pop_job(self, node, timeout):
+    block = max(1, int(timeout))
+    reply = self._execute("BRPOP", "%s:jobs:%s" % (KEY_PREFIX, node), block, block=block)
+    return json.loads(reply[1]) if reply else None
+
+  def cache_get(self, namespace, key):
+    value = self._execute("GET", "%s:cache:%s:%s" % (KEY_PREFIX, namespace, key))
+    return json.loads(value) if value is not None else None
+
+  def cache_set(self, namespace, key, value, ttl=DEFAULT_CACHE_TTL):
+    self._execute("SET", "%s:cache:%s:%s" % (KEY_PREFIX, namespace, key), json.dumps(value), "EX", int(ttl))
+
+  def claim(self, key, ttl=DEFAULT_CLAIM_TTL):
+    return self._execute("SET", "%s:claim:%s" % (KEY_PREFIX, key), 1, "NX", "EX", int(ttl)) == "OK"
+
+  def renew(self, key, ttl=DEFAULT_CLAIM_TTL):
+    self._execute("EXPIRE", "%s:claim:%s" % (KEY_PREFIX, key), int(ttl))
+
+  def release(self, key):
+    self._execute("DEL", "%s:claim:%s" % (KEY_PREFIX, key))
+
+
+def make_backend(url, timeout=DEFAULT_TIMEOUT):
+  """ Returns the cluster backend for a sqlite:// or redis:// URL.
+  """
+  scheme = parse.urlsplit(url).scheme
+  if scheme == 'sqlite':
+    return SQLiteBackend(url[len('sqlite://'):], timeout)
+  if scheme == 'redis':
+    return RedisBackend(url, timeout)
+  raise ValueError("Unsupported cluster backend: %s" % url)
+
+
+class Cluster:
+  """
+  Dispatches jobs to the node owning their repository and runs the jobs routed to this node.
+
+  Attributes
+  ----------
+  node : str
+    The name of this node.
+  ring : HashRing
+    The consistent hashing ring of all the nodes.
+  backend : object
+    The shared backend.
+
+  Methods
+  -------
+  dispatch(provider, method, key, args, priority, cost, supersede, delivery)
+    Routes a job to the node that owns its repository. Used as the jobs dispatcher.
+
+  start()
+    Starts consuming the jobs routed to this node.
+  """
+
+  def __init__(self, config, backend, logger=None):
+    cfg = config['cluster']
+    self.config = config
+    self.node = cfg['node']
+    self.ring = HashRing(cfg.get('nodes') or [self.node], replicas=int(cfg.get('replicas', DEFAULT_REPLICAS)))
+    self.backend = backend
+    self.logger = logger or logging.getLogger('scanoss-hook')
+    self.handlers = {}
+    self.consumer = None
+
+  def dispatch(self, provider, method, key, args, priority=jobs.PRIORITY_PUSH, cost=1, supersede=None,
+               delivery=None):
+    parent = tracing.current_span()
+    claim = None
+    if delivery:
+      # A delivery may hold several jobs, e.g. the changes of a Bitbucket push
+      claim = hashlib.sha1(json.dumps([provider, delivery, method, key, args], sort_keys=True).encode()).hexdigest()
+      try:
+        claimed = self.backend.claim(claim, PENDING_CLAIM_TTL)
+      except BACKEND_ERRORS as e:
+        self._unavailable("processing delivery %s without a claim" % delivery, e)
+        claim, claimed = None, True
+      if not claimed:
+        logging.info("Job for %s of delivery %s already claimed by the cluster, skipping", key, delivery)
+        metrics.inc_counter("scanoss_hook_cluster_duplicates_total", labels={"node": self.node})
+        return None
+    payload = {"provider": provider, "method": method, "key": key, "args": list(args),
+               "priority": priority, "cost": cost, "supersede": list(supersede) if supersede else None,
+               "trace": [parent.trace_id, parent.span_id] if parent else None, "claim": claim}
+    owner = self.ring.node_for(key)
+    if owner == self.node:
+      return self.run(payload)
+    logging.debug("Routing job for %s to node %s", key, owner)
+    try:
+      self.backend.push_job(owner, payload)
+    except BACKEND_ERRORS as e:
+      self._unavailable("running the job for %s on this node" % key, e)
+      return self.run(payload)
+    metrics.inc_counter("scanoss_hook_cluster_routed_total", labels={"node": self.node, "to": owner})
+    return None
+
+  def run(self, payload):
+    """ Queues a job payload in the local scheduler.
+    """
+    provider = payload["provider"]
+    handler = self.handlers.get(provider)
+    if handler is None:
+      # Imported here as the router imports the handlers, which dispatch through this module
+      from scanoss_hook.router import make_handler
+      handler = make_handler(provider, self.config, self.logger)
+      if handler is None:
+        logging.error("Cannot run job for %s, provider %s is not configured", payload["key"], provider)
+        return None
+      self.handlers[provider] = handler
+    supersede = tuple(payload["supersede"]) if payload.get("supersede") else None
+    # Keep the trace of the node that received the webhook
+    parent = tracing.remote_parent(*payload["trace"]) if payload.get("trace") else tracing.current_span()
+    claim = payload.get("claim")
+    with tracing.activate(parent):
+      return jobs.get_scheduler(self.config).submit(payload["key"], getattr(handler, payload["method"]),
+                                                    *payload["args"], priority=payload["priority"],
+                                                    cost=payload["cost"], supersede=supersede,
+                                                    on_done=(lambda job: self._settle(claim, job)) if claim else None)
+
+  def _settle(self, claim, job):
+    """ Keeps the claim of a job that completed or was superseded, releases it so the delivery can be scanned
+    again otherwise.
+    """
+    try:
+      if job.outcome in (jobs.OUTCOME_COMPLETED, jobs.OUTCOME_SUPERSEDED):
+        self.backend.renew(claim)
+      else:
+        logging.info("Releasing the claim of job %d for %s, it has %s", job.id, job.key, job.outcome)
+        self.backend.release(claim)
+    except BACKEND_ERRORS as e:
+      # The pending claim expires by itself
+      self._unavailable("leaving the claim of job %d to expire" % job.id, e)
+
+  def _unavailable(self, fallback, error):
+    logging.warning("The cluster backend is unavailable, %s: %s", fallback, error)
+    metrics.inc_counter("scanoss_hook_cluster_backend_errors_total", labels={"node": self.node})
+
+  def _consume(self):
+    while True:
+      try:
+        payload = self.backend.pop_job(self.node, POLL_INTERVAL * 5)
+      except Exception:
+        logging.exception("Error reading the cluster job queue")
+        time.sleep(POLL_INTERVAL)
+        continue
+      if payload:
+        metrics.inc_counter("scanoss_hook_cluster_received_total", labels={"node": self.node})
+        self.run(payload)
+
+  def start(self):
+    """ Registers the cluster as jobs dispatcher and cache backend, and starts consuming this node's queue.
+    """
+    jobs.set_dispatcher(self)
+    cache.set_backend(self.backend)
+    if self.consumer is None:
+      self.consumer = threading.Thread(target=self._consume, name="cluster-consumer", daemon=True)
+      self.consumer.start()
+    logging.info("Cluster node %s started with %d nodes", self.node, len(set(n for _, n in self.ring.ring)))
+
+
+def start_cluster(config, logger=None):
+  """ Starts cluster mode if the configuration has a 'cluster' section. Returns the Cluster or None.
+  """
+  if not config.get('cluster'):
+    return None
+  cfg = config['cluster']
+  cluster = Cluster(config, make_backend(cfg['backend'], float(cfg.get('timeout', DEFAULT_TIMEOUT))), logger)
+  cluster.start()
+  return cluster
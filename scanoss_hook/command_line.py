@@ -4,25 +4,20 @@
 # license that can be found in the LICENSE file.
 import yaml
 import logging
-import logging.handlers as handlers
 import os
 import sys
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, FileType
-from http.server import HTTPServer
+from scanoss_hook import (cache, capture, cluster, fingerprinting, logs, memory, profiling, ratelimit, results_store,
+                          server, tracing)
 from scanoss_hook.bitbucket import BitbucketRequestHandler
 from scanoss_hook.gitlab import GitLabRequestHandler
 from scanoss_hook.github import GitHubRequestHandler
+from scanoss_hook.router import RoutingRequestHandler
 from functools import partial
 
 os.environ["PYTHONUNBUFFERED"] = "1"
 
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
-                    level=logging.DEBUG,
-                    stream=sys.stdout)
-
 logger = logging.getLogger('scanoss-hook')
-logger.setLevel(logging.DEBUG)
-log_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
 def get_parser():
   """Returns the command line parser for the SCANOSS webhook.
@@ -40,8 +35,26 @@ def get_parser():
                       default=8888,
                       metavar="PORT",
                       help="port where it listens")
-  parser.add_argument("--handler", dest="handler", choices=['gitlab', 'github', 'bitbucket'],
-                      default="gitlab", metavar="HANDLER", help="webhook handler")
+  parser.add_argument("--handler", dest="handler", choices=['gitlab', 'github', 'bitbucket', 'routed'],
+                      default="gitlab", metavar="HANDLER",
+                      help="webhook handler, 'routed' serves all the configured providers on /gitlab, /github and /bitbucket")
+
+  parser.add_argument("--workers",
+                      dest="workers",
+                      type=int,
+                      default=1,
+                      metavar="N",
+                      help="number of worker processes, more than one runs a pre-forked supervisor")
+  parser.add_argument("--reuse-port",
+                      dest="reuse_port",
+                      action="store_true",
+                      help="bind one SO_REUSEPORT socket per worker instead of sharing the listening socket")
+  parser.add_argument("--drain-timeout",
+                      dest="drain_timeout",
+                      type=float,
+                      default=server.DEFAULT_DRAIN_TIMEOUT,
+                      metavar="SECONDS",
+                      help="time to wait for running scans when stopping")
 
   parser.add_argument("--cfg",
                       dest="cfg",
@@ -62,10 +75,15 @@ def main():
     sys.exit(1)
 
   config = yaml.safe_load(args.cfg)
-
-  handler = handlers.TimedRotatingFileHandler("/var/log/scanoss-hook.log", when='midnight', interval=1)
-  handler.setFormatter(log_format)
-  logger.addHandler(handler)
+  logs.configure(config.get('logging'))
+  ratelimit.configure(config.get('ratelimit'))
+  cache.configure(config.get('cache'))
+  memory.configure(config.get('memory'))
+  fingerprinting.configure(config.get('fingerprinting'))
+  tracing.configure(config.get('tracing'))
+  profiling.configure(config.get('profiling'))
+  capture.configure(config.get('capture'))
+  results_store.configure(config.get('results-store'))
 
   if args.handler == 'gitlab':
     handler = partial(GitLabRequestHandler, config)
@@ -73,10 +91,15 @@ def main():
     handler = partial(GitHubRequestHandler, config, logger)
   elif args.handler == 'bitbucket':
     handler = partial(BitbucketRequestHandler, config)
+  elif args.handler == 'routed':
+    handler = partial(RoutingRequestHandler, config, logger)
 
-  httpd = HTTPServer((args.addr, args.port),
-                     handler)
-  httpd.serve_forever()
+  on_start = partial(cluster.start_cluster, config, logger)
+  if args.workers > 1:
+    server.serve_prefork(args.addr, args.port, handler, args.workers, reuse_port=args.reuse_port,
+                         drain_timeout=args.drain_timeout, on_start=on_start)
+  else:
+    server.serve(args.addr, args.port, handler, drain_timeout=args.drain_timeout, on_start=on_start)
 
 
 if __name__ == '__main__':
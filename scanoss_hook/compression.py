@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Compressed transport helpers.
+
+ - Request bodies (the WFP uploads) are compressed with gzip or, if the zstandard package is installed, zstd.
+   An endpoint answering an encoded body with 415, or with a 400 whose body names the encoding, is sent plain bodies
+   for the next REJECTION_TTL seconds.
+ - Responses are requested with every encoding urllib3 can decode and are decoded as they are read.
+ - The bytes sent and received on the wire and their logical (uncompressed) size are counted by host in the
+   scanoss_hook_transfer_wire_bytes_total and scanoss_hook_transfer_logical_bytes_total metrics.
+"""
+
+import tempfile
+import threading
+import time
+import zlib
+
+import requests
+from urllib3.util.request import ACCEPT_ENCODING
+
+from scanoss_hook import jobs, metrics
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Compressed bodies are kept in memory up to this size, then spilled to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+# Seconds during which an endpoint rejecting an encoding is sent plain bodies, before trying the encoding again
+REJECTION_TTL = 3600
+CHUNK_SIZE = 64 * 1024
+
+# (url, encoding) -> time.monotonic() until which url is sent plain bodies
+_rejected = {}
+_rejected_lock = threading.Lock()
+
+
+def available(encoding):
+  """ Returns True if request bodies can be compressed with encoding.
+  """
+  if encoding == 'gzip':
+    return True
+  if encoding == 'zstd':
+    return zstandard is not None
+  return False
+
+
+def _compressor(encoding):
+  if encoding == 'gzip':
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+  return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+class CompressedBody:
+  """
+  A compressed request body, kept in memory or spilled to a temporary file when large.
+
+  It is sent by requests as an iterable with a known length, so it is streamed with a Content-Length header.
+  """
+
+  def __init__(self, chunks, encoding):
+    compressor = _compressor(encoding)
+    self.encoding = encoding
+    self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in chunks:
+      self.file.write(compressor.compress(chunk))
+    self.file.write(compressor.flush())
+    self.size = self.file.tell()
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    self.file.seek(0)
+    while True:
+      chunk = self.file.read(CHUNK_SIZE)
+      if not chunk:
+        return
+      yield chunk
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def compress(chunks, encoding):
+  """ Compresses an iterable of byte chunks with encoding ('gzip' or 'zstd'). Returns a CompressedBody.
+  """
+  return CompressedBody(chunks, encoding)
+
+
+def rejected(response, encoding):
+  """ Returns True if response rejects a request body compressed with encoding: a 415, or a 400 whose body names
+  the encoding. Other 400s are about the request itself and would fail the same way uncompressed.
+  """
+  if response.status_code == 415:
+    return True
+  if response.status_code != 400:
+    return False
+  text = response.text.lower()
+  return encoding in text or 'content-encoding' in text
+
+
+def accepts(url, encoding):
+  """ Returns False if url has rejected bodies compressed with encoding in the last REJECTION_TTL seconds.
+  """
+  with _rejected_lock:
+    until = _rejected.get((url, encoding))
+    if until is None:
+      return True
+    if time.monotonic() < until:
+      return False
+    del _rejected[(url, encoding)]
+    return True
+
+
+def reject(url, encoding, ttl=REJECTION_TTL):
+  """ Remembers that url does not accept bodies compressed with encoding for the next ttl seconds.
+  """
+  with _rejected_lock:
+    _rejected[(url, encoding)] = time.monotonic() + ttl
+
+
+def record(host, direction, wire, logical):
+  """ Counts a transfer of 'logical' bytes that took 'wire' bytes. Direction is 'in' or 'out'.
+  """
+  labels = {"host": host, "direction": direction}
+  metrics.inc_counter("scanoss_hook_transfer_wire_bytes_total", wire, labels)
+  metrics.inc_counter("scanoss_hook_transfer_logical_bytes_total", logical, labels)
+
+
+def record_response(host, response):
+  """ Counts the transfer of a response whose body has been read in full.
+  """
+  logical = len(response.content)
+  wire = logical
+  tell = getattr(response.raw, 'tell', None)
+  if tell is not None:
+    try:
+      wire = tell() or logical
+    except (OSError, ValueError):
+      pass
+  record(host, "in", wire, logical)
+
+
+def iter_response(host, response, chunk_size=CHUNK_SIZE):
+  """ Yields the decoded body of a streamed response chunk by chunk and counts its transfer. Raises
+  jobs.DeadlineExceeded if the job reading it runs out of time.
+  """
+  logical = 0
+  try:
+    for chunk in response.iter_content(chunk_size):
+      jobs.check_cancelled()
+      logical += len(chunk)
+      yield chunk
+  except requests.RequestException:
+    jobs.check_cancelled()
+    raise
+  wire = logical
+  try:
+    wire = response.raw.tell() or logical
+  except (AttributeError, OSError, ValueError):
+    pass
+  record(host, "in", wire, logical)
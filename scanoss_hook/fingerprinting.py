@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Parallel fingerprinting of large files.
+
+Files of 'parallel-threshold' bytes or more are split into segments of at least 'segment-size' bytes, which are
+fingerprinted at the same time by a pool of 'processes' worker processes (one per CPU by default, 0 or 1 disable
+the pool). The workers read the contents from the spill file of the memory.Blob holding them through mmap, or from
+a shared memory copy for contents held in memory, so the contents are never pickled.
+
+Every segment is preceded by a warm up (see winnowing.warmup_start) that restores the state of the algorithm at its
+start, so the stitched fingerprint is identical to the one computed serially. The segments are waited for until the
+deadline of the calling job (see jobs.deadline).
+
+Configuration example:
+
+fingerprinting:
+  parallel-threshold: 4194304
+  segment-size: 1048576
+  processes: 4
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, shared_memory
+import array
+import concurrent.futures
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+
+from scanoss_hook import jobs, memory, metrics, winnowing
+
+DEFAULT_PARALLEL_THRESHOLD = 4 * 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+_settings = {"parallel-threshold": DEFAULT_PARALLEL_THRESHOLD, "segment-size": DEFAULT_SEGMENT_SIZE,
+             "processes": DEFAULT_PROCESSES}
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(config):
+  """ Sets the parallel fingerprinting settings from the 'fingerprinting' configuration section.
+  """
+  global _pool
+  if config:
+    for name in ("parallel-threshold", "segment-size", "processes"):
+      if name in config:
+        _settings[name] = int(config[name])
+  with _pool_lock:
+    if _pool is not None:
+      _pool.shutdown(wait=False)
+      _pool = None
+
+
+def _get_pool():
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      # Forking a process with several threads running is unsafe, the workers are started from scratch instead
+      _pool = ProcessPoolExecutor(_settings["processes"], mp_context=get_context("spawn"))
+    return _pool
+
+
+def _reset_pool(pool):
+  global _pool
+  with _pool_lock:
+    if _pool is pool:
+      _pool = None
+  pool.shutdown(wait=False)
+
+
+def is_parallel(size):
+  """ Returns True if contents of the given size are fingerprinted in parallel.
+  """
+  return _settings["processes"] > 1 and size >= max(_settings["parallel-threshold"], 2 * _settings["segment-size"])
+
+
+def _fingerprint_segment(source, size, warmup, start, end):
+  """ Runs in the worker processes. Source is ('file', path) or ('shm', name).
+  """
+  kind, name = source
+  if kind == 'file':
+    with open(name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      lines, crcs, warmup_lines, segment_lines = winnowing.fingerprint_segment(data, warmup, start, end)
+  else:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+      with shm.buf[:size] as data:
+        lines, crcs, warmup_lines, segment_lines = winnowing.fingerprint_segment(data, warmup, start, end)
+    finally:
+      shm.close()
+  return lines.tobytes(), crcs.tobytes(), warmup_lines, segment_lines
+
+
+def _unpack(part):
+  lines, crcs, warmup_lines, segment_lines = part
+  return array.array('I', lines), array.array('I', crcs), warmup_lines, segment_lines
+
+
+def fingerprint(contents, path=None):
+  """ Returns the winnowing.Fingerprint of contents, fingerprinting their segments in parallel if they are large.
+
+  Parameters
+  ----------
+  contents : bytes
+    The contents of the file as bytes or any buffer supporting slicing, like an mmap.
+  path : str
+    The path of a file with the same contents, read by the worker processes instead of a shared memory copy.
+  """
+  size = len(contents)
+  if not is_parallel(size):
+    return winnowing.fingerprint(contents)
+  start = time.monotonic()
+  segments = winnowing.split(contents, min(_settings["processes"], size // _settings["segment-size"]))
+  shm = None
+  if path is None:
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    shm.buf[:size] = contents
+    source = ('shm', shm.name)
+  else:
+    source = ('file', path)
+  pool = _get_pool()
+  try:
+    futures = [pool.submit(_fingerprint_segment, source, size, *segment) for segment in segments]
+    end = jobs.deadline()
+    parts = [_unpack(future.result(None if end is None else max(end - time.monotonic(), 0))) for future in futures]
+  except concurrent.futures.TimeoutError:
+    for future in futures:
+      future.cancel()
+    jobs.check_cancelled()
+    raise
+  except BrokenProcessPool:
+    logging.error("The fingerprinting processes have died, fingerprinting %d bytes serially", size)
+    _reset_pool(pool)
+    return winnowing.fingerprint(contents)
+  finally:
+    if shm is not None:
+      shm.close()
+      shm.unlink()
+  result = winnowing.stitch(hashlib.md5(contents).hexdigest(), size, parts)
+  metrics.inc_counter("scanoss_hook_parallel_fingerprints_total")
+  metrics.observe("scanoss_hook_parallel_fingerprint_seconds", time.monotonic() - start)
+  return result
+
+
+def fingerprint_stream(chunks, size=None):
+  """ Returns the winnowing.Fingerprint of the contents yielded by chunks. Contents of a known size large enough to
+  be fingerprinted in parallel are buffered in a memory.Blob, the rest are fingerprinted as they are read.
+  """
+  if size is None or not is_parallel(size):
+    winnower = winnowing.Winnower()
+    for chunk in chunks:
+      jobs.check_cancelled()
+      winnower.update(chunk)
+    return winnower.finish()
+  blob = memory.Blob()
+  try:
+    for chunk in chunks:
+      blob.write(chunk)
+    with blob.view() as data:
+      return fingerprint(data, blob.path)
+  finally:
+    blob.close()
@@ -5,12 +5,18 @@
 
 from http.server import BaseHTTPRequestHandler
 from typing import Any
-from github import Github
+from github import Github, GithubException
 import json
+import requests
 import logging
 import hmac
 import hashlib
+import threading
+from urllib import parse
 from github.Repository import Repository
+from scanoss_hook import admin, api_client, capture, compression, jobs, logs, memory, tracing
+from scanoss_hook.ratelimit import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, get_limiter
+from scanoss_hook.results_store import Source
 from scanoss_hook.scanner import Scanner
 
 # CONSTANTS
@@ -27,37 +33,234 @@ GH_CONTENTS_PATH = '{+path}'
 GH_STATUS_SUCC = 'success'
 GH_STATUS_FAIL = 'failure'
 
+# Blobs fetched per GraphQL query by the bulk fetch path
+GH_GRAPHQL_BATCH = 50
+GH_FILES_PER_PAGE = 100
+
 MSG_VALIDATED = "Automated code review complete"
 MSG_NO_VALIDATED = "You PR/commit has been forwarded to AWS Trusted Committers for review."
+MSG_TIMED_OUT = "The SCANOSS scan timed out in the %s stage, the changes have not been scanned."
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_base, api_key):
+  """ Returns the shared PyGithub client for an API base URL and key, so its connection pool is reused.
+  """
+  with _clients_lock:
+    client = _clients.get((api_base, api_key))
+    if client is None:
+      client = Github(base_url = api_base, login_or_token= api_key)
+      _clients[(api_base, api_key)] = client
+    return client
+
+class GitHubAPI:
+  """
+  GitHub REST and GraphQL API functions used by the bulk fetch path.
+
+  The files of a commit or a push range are listed with the commits or compare API, and their contents are
+  fetched in batches of GH_GRAPHQL_BATCH blobs per GraphQL query. Binary, truncated or non UTF-8 blobs are
+  fetched with the git blobs API, which also serves files larger than the 1 MB limit of the contents API.
+
+  Attributes
+  ----------
+  base_url : str
+    The GitHub REST API base URL.
+  graphql_url : str
+    The GitHub GraphQL API URL.
+  """
+
+  def __init__(self, api_base, api_key):
+    self.api_key = api_key
+    self.base_url = api_base.rstrip('/')
+    if self.base_url.endswith('/api/v3'):
+      # GitHub Enterprise Server
+      self.graphql_url = self.base_url[:-len('/v3')] + '/graphql'
+    else:
+      self.graphql_url = self.base_url + '/graphql'
+    self.headers = {'Authorization': 'token %s' % api_key, 'Accept': 'application/vnd.github.v3+json'}
+
+  def _request(self, method, url, priority, headers=None, **kwargs):
+    return api_client.request(method, url, token=self.api_key, priority=priority,
+                              headers=dict(self.headers, **(headers or {})), **kwargs)
+
+  def _get_files(self, url):
+    files = []
+    page = 1
+    while True:
+      r = self._request("GET", url, PRIORITY_HIGH, params={"per_page": GH_FILES_PER_PAGE, "page": page})
+      if r.status_code != 200:
+        logging.error("There was an error trying to obtain the files of %s, the server returned status %d", url,
+                      r.status_code)
+        return None
+      page_files = r.json().get('files') or []
+      files += page_files
+      if 'next' not in r.links or not page_files:
+        return files
+      page += 1
+
+  def get_commit_files(self, full_name, sha):
+    """ Returns the files changed by a commit.
+    """
+    return self._get_files("%s/repos/%s/commits/%s" % (self.base_url, full_name, sha))
+
+  def get_compare_files(self, full_name, base, head):
+    """ Returns the files changed between two commits, e.g. by a push.
+    """
+    return self._get_files("%s/repos/%s/compare/%s...%s" % (self.base_url, full_name, base, head))
+
+  def get_pull_commits(self, full_name, number):
+    """ Returns the SHAs of the commits of a pull request.
+    """
+    shas = []
+    page = 1
+    while True:
+      r = self._request("GET", "%s/repos/%s/pulls/%d/commits" % (self.base_url, full_name, number), PRIORITY_NORMAL,
+                        params={"per_page": GH_FILES_PER_PAGE, "page": page})
+      if r.status_code != 200:
+        logging.error("There was an error trying to obtain the commits of PR %d, the server returned status %d",
+                      number, r.status_code)
+        return shas
+      commits = r.json()
+      shas += [c['sha'] for c in commits]
+      if 'next' not in r.links or not commits:
+        return shas
+      page += 1
+
+  def get_blob(self, full_name, sha, priority=PRIORITY_HIGH):
+    """ Returns the raw contents of a blob as a memory.Blob, None if it cannot be fetched.
+    """
+    url = "%s/repos/%s/git/blobs/%s" % (self.base_url, full_name, sha)
+    r = self._request("GET", url, priority, headers={'Accept': 'application/vnd.github.raw'}, stream=True)
+    with r:
+      if r.status_code != 200:
+        logging.error("There was an error trying to obtain blob %s, the server returned status %d", sha,
+                      r.status_code)
+        return None
+      blob = memory.Blob()
+      for chunk in compression.iter_response(parse.urlsplit(url).netloc, r):
+        blob.write(chunk)
+    return blob
+
+  def get_contents(self, full_name, ref, files, priority=PRIORITY_HIGH):
+    """ Returns a dictionary with the contents (memory.Blob) at ref of a list of files (dictionaries with the
+    'filename' and, if known, the blob 'sha'). Files that do not exist are left out.
+    """
+    owner, name = full_name.split('/', 1)
+    contents = {}
+    for start in range(0, len(files), GH_GRAPHQL_BATCH):
+      jobs.check_cancelled()
+      batch = files[start:start + GH_GRAPHQL_BATCH]
+      fields = ''.join('f%d: object(expression: %s) { ... on Blob { oid text isBinary isTruncated byteSize } } ' % (
+          i, json.dumps("%s:%s" % (ref, f['filename']))) for i, f in enumerate(batch))
+      query = "query($owner: String!, $name: String!) { repository(owner: $owner, name: $name) { %s} }" % fields
+      r = self._request("POST", self.graphql_url, priority,
+                        json={"query": query, "variables": {"owner": owner, "name": name}})
+      blobs = {}
+      if r.status_code == 200:
+        blobs = ((r.json().get('data') or {}).get('repository')) or {}
+      else:
+        logging.error("There was an error in a GraphQL query, the server returned status %d", r.status_code)
+      for i, f in enumerate(batch):
+        blob = blobs.get('f%d' % i)
+        text = blob.get('text') if blob else None
+        if text is not None and not blob.get('isBinary') and not blob.get('isTruncated'):
+          data = text.encode('utf-8')
+          # The text of a non UTF-8 blob is lossy, its size does not match
+          if len(data) == blob.get('byteSize'):
+            contents[f['filename']] = memory.from_bytes(data)
+            continue
+        sha = (blob or {}).get('oid') or f.get('sha')
+        if sha and (blob or r.status_code != 200):
+          data = self.get_blob(full_name, sha, priority)
+          if data is not None:
+            contents[f['filename']] = data
+    return contents
+
+  def post_commit_comment(self, full_name, sha, comment):
+    r = self._request("POST", "%s/repos/%s/commits/%s/comments" % (self.base_url, full_name, sha), PRIORITY_LOW,
+                      json={"body": comment})
+    if r.status_code >= 400:
+      logging.error("There was an error posting a comment for commit %s, the server returned status %d", sha,
+                    r.status_code)
+
+  def post_issue_comment(self, full_name, number, comment):
+    r = self._request("POST", "%s/repos/%s/issues/%d/comments" % (self.base_url, full_name, number), PRIORITY_LOW,
+                      json={"body": comment})
+    if r.status_code >= 400:
+      logging.error("There was an error posting a comment for PR %d, the server returned status %d", number,
+                    r.status_code)
+
+
 class GitHubRequestHandler(BaseHTTPRequestHandler):
   """A Github webhook request handler.
 
   """
 
+  provider = 'github'
+
   def __init__(self, config, logger: logging, *args: Any) -> None:
+    if not self.configure(config, logger):
+      return
+    BaseHTTPRequestHandler.__init__(self, *args)
+
+  def configure(self, config, logger: logging) -> bool:
+    """ Sets up the handler for the given configuration, also used by the routed mode.
+    Returns False if the github section of the configuration is not valid.
+    """
     self.config = config
     self.scanner = Scanner(config)
     self.logger = logger
     self.sbom_file = "SBOM.json"
+    self.comment_always = False
     try:
       self.api_base = config['github']['api-base']
       self.api_key = config['github']['api-key']
-      self.g = Github(base_url = self.api_base, login_or_token= self.api_key)
+      self.g = get_client(self.api_base, self.api_key)
+      self.limiter = get_limiter(parse.urlsplit(self.api_base).netloc, self.api_key)
+      self.api = GitHubAPI(self.api_base, self.api_key)
+      self.bulk_fetch = bool(config['github'].get('bulk-fetch'))
     except Exception:
       self.logger.error("There is an error in the github section in the config file")
-      return
+      return False
     try:
         self.secret_token = config['github']['secret-token']
         self.comment_always = config['scanoss']['comment_always']
         self.sbom_file = config['scanoss']['sbom_filename']
     except Exception:
         self.logger.error("There is an error in the scanoss section in the config file")
+    return True
 
-    BaseHTTPRequestHandler.__init__(self, *args)
+  def call_api(self, priority, fn, *args, **kwargs):
+    """ Calls a PyGithub function scheduling it through the rate limiter of the API token.
+    """
+    jobs.check_cancelled()
+    self.limiter.acquire(priority)
+    jobs.check_cancelled()
+    with tracing.span("github %s" % getattr(fn, '__name__', 'call')):
+      try:
+        result = fn(*args, **kwargs)
+      except requests.Timeout:
+        # Timed out by the deadline of the job rather than by a slow host
+        jobs.check_cancelled()
+        raise
+    # The rate limit headers of the last response: Github.rate_limiting calls GET /rate_limit when there are none,
+    # which does not exist when GitHub Enterprise has rate limiting disabled
+    requester = getattr(self.g, 'requester', None) or self.g._Github__requester
+    remaining, limit = requester.rate_limiting
+    if remaining >= 0 and limit >= 0:
+      headers = {'X-RateLimit-Remaining': remaining, 'X-RateLimit-Limit': limit}
+      if requester.rate_limiting_resettime:
+        headers['X-RateLimit-Reset'] = requester.rate_limiting_resettime
+      self.limiter.update(200, headers)
+    return result
 
   def do_GET(self):
+    if admin.handle_get(self):
+      return
     self.logger.info("PING received")
-    repo_list = self.g.get_repos().get_page(0)
+    repo_list = self.call_api(PRIORITY_NORMAL, self.g.get_repos().get_page, 0)
     self.logger.debug(repo_list[0])
     resp = {"version":GH_VERSION, "gh_api_test":repo_list[:10]}
     self.send_response(200, resp)
@@ -69,12 +272,13 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
                               payload.encode('utf-8'), hashlib.sha1).hexdigest()
     return digest == gh_token
 
+  @tracing.traced("github.webhook", new_trace=True)
   def do_POST(self):
+    if admin.handle_post(self):
+      return
     # get payload
     header_length = int(self.headers['Content-Length'])
     json_payload = self.rfile.read(header_length).decode()
-    with open('/tmp/gh_payload', 'w') as f:
-      f.write(json_payload)
     json_params = {}
     if len(json_payload) > 0:
       json_params = json.loads(json_payload)
@@ -86,6 +290,7 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
       self.send_response(401, "Invalid Github signature")
       self.end_headers()
       return
+    capture.record(self.provider, self, json_payload)
 
     # Get the contents url from the json
     try:
@@ -104,7 +309,9 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
     if event == GH_EVENT_PR:
       pr = json_params.get("pull_request")
       if pr.get("state") == "open":
-        self.process_pr(repository, pr)
+        key = "github:%s" % repository.get('full_name')
+        jobs.dispatch(self, 'process_pr', key, repository, pr, priority=jobs.PRIORITY_PR,
+                      cost=pr.get('commits', 1), supersede=(key, pr.get('number')))
     elif event == GH_EVENT_PUSH:
           # If there are no commits, return
       commits = json_params.get("commits")
@@ -114,7 +321,12 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         return
 
-      self.process_commits_diff(repository, commits)
+      priority = jobs.PRIORITY_PUSH
+      if json_params.get('ref') == "refs/heads/%s" % repository.get('default_branch'):
+        priority = jobs.PRIORITY_DEFAULT_BRANCH
+      key = "github:%s" % repository.get('full_name')
+      jobs.dispatch(self, 'process_commits_diff', key, repository, commits, json_params.get('before'),
+                    priority=priority, cost=len(commits), supersede=(key, json_params.get('ref')))
     else:
       self.send_response(200, "OK")
       self.end_headers()
@@ -124,32 +336,53 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
     repo_name = repository.get('name')
     repo_own = repository.get('owner')
     repo_type = repo_own.get('type')
-    self.logger.debug(repo_own)
+    self.logger.debug("%s", logs.payload(repo_own))
     logging.debug(repo_own.get('name'))
     self.logger.debug(repo_type)
     if repo_type == "Organization":
-      repo = self.g.get_organization(repo_own.get('login')).get_repo(repo_name)
+      org = self.call_api(PRIORITY_NORMAL, self.g.get_organization, repo_own.get('login'))
+      repo = self.call_api(PRIORITY_NORMAL, org.get_repo, repo_name)
       logging.info("Organization mode")
     else:
-      repo = self.g.get_user(repo_own.get('name')).get_repo(repo_name)
+      user = self.call_api(PRIORITY_NORMAL, self.g.get_user, repo_own.get('name'))
+      repo = self.call_api(PRIORITY_NORMAL, user.get_repo, repo_name)
       logging.info("User mode")
     return repo
   
   def process_pr(self,repository, pr):
-    self.logger.info("Processing PR")
-    repo = self.process_gh_request(repository)
-    pull_resquest = repo.get_pull(pr.get('number'))
-    commits = pull_resquest.get_commits()
-    summary_list = []
-    for commit in commits:
-      self.logger.debug(commit.sha)
-      result, comment = self.process_commit(repo,commit.sha)
-      if result is False or self.comment_always:
-        pull_resquest.create_issue_comment(comment)
-    self.logger.debug(summary_list)
+    try:
+      self.logger.info("Processing PR")
+      if self.bulk_fetch:
+        full_name = repository.get('full_name')
+        for sha in self.api.get_pull_commits(full_name, pr.get('number')):
+          # Commits reported before the job was parked are not scanned again
+          if jobs.is_completed(sha):
+            continue
+          result, comment = self.process_range(full_name, None, sha, post=False)
+          if comment:
+            self.api.post_issue_comment(full_name, pr.get('number'), comment)
+          jobs.mark_completed(sha)
+        self.logger.info("Finished processing PR")
+        return
+      repo = self.process_gh_request(repository)
+      pull_resquest = self.call_api(PRIORITY_NORMAL, repo.get_pull, pr.get('number'))
+      commits = self.call_api(PRIORITY_NORMAL, list, pull_resquest.get_commits())
+      summary_list = []
+      for commit in commits:
+        self.logger.debug(commit.sha)
+        if jobs.is_completed(commit.sha):
+          continue
+        result, comment = self.process_commit(repo,commit.sha)
+        if result is False or self.comment_always:
+          self.call_api(PRIORITY_LOW, pull_resquest.create_issue_comment, comment)
+        jobs.mark_completed(commit.sha)
+      self.logger.debug(summary_list)
   
-    self.logger.info("Finished processing PR")
-    return
+      self.logger.info("Finished processing PR")
+      return
+    except jobs.DeadlineExceeded as e:
+      self.report_timeout(repository.get('full_name'), pr.get('head', {}).get('sha'), e, pr.get('number'))
+      raise
 
 
 
@@ -157,54 +390,118 @@ class GitHubRequestHandler(BaseHTTPRequestHandler):
     files = {}
     files_content = {}
     scan_result = {}
-    commit_data = repo.get_commit(sha=commit_id)
-    files = commit_data.raw_data.get('files')
-    for file in files:
-      code = (file['patch'])
-      lines = code.split("\n")
-      file_scan = False
-      for line in lines: #if one line was added or changed scan the full file.
-        if line[0] == '+' or line[0] == 'M':
-          file_scan = True
-          break
-      #wfp calculation
-      if file_scan:
-        contents = repo.get_contents(file['filename'], ref=commit_id)
-        if contents:
-          files_content[file['filename']] = contents.decoded_content
+    with jobs.stage("fetch"), tracing.span("fetch", commit=commit_id) as span:
+      commit_data = self.call_api(PRIORITY_HIGH, repo.get_commit, sha=commit_id)
+      files = commit_data.raw_data.get('files')
+      for file in files:
+        code = (file['patch'])
+        lines = code.split("\n")
+        file_scan = False
+        for line in lines: #if one line was added or changed scan the full file.
+          if line[0] == '+' or line[0] == 'M':
+            file_scan = True
+            break
+        #wfp calculation
+        if file_scan:
+          # Streamed into a memory.Blob, the contents API would decode the whole file in memory first
+          contents = self.api.get_blob(repo.full_name, file['sha']) if file.get('sha') else None
+          if contents is not None:
+            files_content[file['filename']] = contents
 
-    try:
-      asset_json = repo.get_contents(self.sbom_file).decoded_content
-    except Exception:
-      self.logger.info("No assets")
-      asset_json = {}
+      try:
+        asset_json = self.call_api(PRIORITY_LOW, repo.get_contents, self.sbom_file).decoded_content
+      except GithubException:
+        # Also raised as UnknownObjectException when the repository has no SBOM file
+        self.logger.info("No assets")
+        asset_json = {}
+      span.set(files=len(files_content))
     
-    self.logger.debug(asset_json)
-    scan_result = self.scanner.scan_files(files_content, asset_json)
+    scan_result = self.scanner.scan_files(files_content, asset_json, Source(self.provider, repo.full_name, commit_id))
+    validation, comment = self.format_comment(scan_result, asset_json)
+    if comment:
+      with jobs.stage("report"), tracing.span("report", commit=commit_id):
+        self.call_api(PRIORITY_LOW, commit_data.create_comment, comment)
+    return validation, comment
+
+  def format_comment(self, scan_result, asset_json):
+    """ Returns the validation flag of a scan and the comment to post, None if no comment has to be posted.
+    """
     result = {'comment': 'No results', 'validation': True, 'cyclondx' : {}}
-    
     if scan_result:
       result = self.scanner.format_scan_results(scan_result)
-    # Add a comment to the commit
-    if (not result['validation'] or self.comment_always) and result['comment']:
-      full_comment = result['comment']
-      if result['cyclondx']:
-        full_comment += "\n Please find the CycloneDX component details to add to your %s to declare the missing components here:\n" % self.sbom_file
-        if asset_json:
-          full_comment += "```\n"+ json.dumps(result['cyclondx']['components'], indent=2) + "\n```"
-        else:
-          full_comment += "```\n"+ json.dumps(result['cyclondx'], indent=2) + "\n```"
-      
-      self.logger.debug(full_comment)
-      commit_data.create_comment(full_comment)
+    if (result['validation'] and not self.comment_always) or not result['comment']:
+      return result['validation'], None
+    full_comment = self.scanner.format_sbom_comment(result, asset_json, self.sbom_file)
+    self.logger.debug("%s", logs.payload(full_comment))
     return result['validation'], full_comment
 
+  @staticmethod
+  def has_additions(file):
+    """ Returns True if a changed file (from the commits or compare API) has added or changed lines.
+    """
+    if file.get('status') == 'removed':
+      return False
+    patch = file.get('patch')
+    # The patch is left out for binary files and very large diffs
+    if patch is None:
+      return True
+    return any(line.startswith('+') or line.startswith('M') for line in patch.split("\n"))
+
+  def process_range(self, full_name, base, head, post=True):
+    """ Scans the files changed by a commit (base is None) or a range of commits with the bulk fetch path, and
+    comments on the head commit if post is set. Returns the validation flag and the comment.
+    """
+    with jobs.stage("fetch"), tracing.span("fetch", commit=head, base=base or '') as span:
+      if base:
+        files = self.api.get_compare_files(full_name, base, head)
+      else:
+        files = self.api.get_commit_files(full_name, head)
+      files = [f for f in files or [] if self.has_additions(f)]
+      contents = self.api.get_contents(full_name, head, files + [{'filename': self.sbom_file}])
+      assets = contents.pop(self.sbom_file, None)
+      asset_json = assets.getvalue() if assets else {}
+      span.set(files=len(contents))
+    scan_result = self.scanner.scan_files(contents, asset_json, Source(self.provider, full_name, head, base))
+    validation, comment = self.format_comment(scan_result, asset_json)
+    if comment and post:
+      with jobs.stage("report"), tracing.span("report", commit=head):
+        self.api.post_commit_comment(full_name, head, comment)
+    return validation, comment
+
+  def process_commits_diff(self, repository, commits, before=None):
+    try:
+      self.logger.info("Processing commits")
+      if self.bulk_fetch:
+        full_name = repository.get('full_name')
+        # A push of several commits is scanned as a whole, commenting on its last commit
+        if len(commits) > 1 and before and before.strip('0'):
+          self.process_range(full_name, before, commits[-1]['id'])
+        else:
+          for commit in commits:
+            # Commits reported before the job was parked are not scanned again
+            if not jobs.is_completed(commit['id']):
+              self.process_range(full_name, None, commit['id'])
+              jobs.mark_completed(commit['id'])
+        self.logger.info("Finished processing commits")
+        return
+      repo = self.process_gh_request(repository)
+      for commit in commits:
+        #get commit
+        if not jobs.is_completed(commit['id']):
+          self.process_commit(repo, commit['id'])
+          jobs.mark_completed(commit['id'])
 
-  def process_commits_diff(self, repository, commits):
-    self.logger.info("Processing commits")
-    repo = self.process_gh_request(repository)
-    for commit in commits:
-      #get commit
-      self.process_commit(repo, commit['id'])
+      self.logger.info("Finished processing commits")
+    except jobs.DeadlineExceeded as e:
+      self.report_timeout(repository.get('full_name'), commits[-1]['id'], e)
+      raise
 
-    self.logger.info("Finished processing commits")
\ No newline at end of file
+  def report_timeout(self, full_name, sha, error, number=None):
+    """ Comments on the head commit (or pull request) that the scan ran out of time in the given stage.
+    """
+    comment = MSG_TIMED_OUT % error.stage
+    with jobs.overtime(), tracing.span("report", commit=sha or '', timed_out=True):
+      if number is None:
+        self.api.post_commit_comment(full_name, sha, comment)
+      else:
+        self.api.post_issue_comment(full_name, number, comment)
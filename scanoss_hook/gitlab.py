@@ -6,12 +6,13 @@
 from http.server import BaseHTTPRequestHandler
 
 import base64
-from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
-import requests
 from urllib import parse
 from typing import Any
+from . import admin, api_client, capture, compression, fingerprinting, jobs, logs, tracing
+from .ratelimit import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+from .results_store import Source
 from .scanner import Scanner
 
 # CONSTANTS
@@ -22,7 +23,7 @@ GL_HEADER_TOTAL_PAGES = 'x-total-pages'
 GL_PUSH_EVENT = 'Push Hook'
 GL_MERGE_REQUEST_EVENT = 'Merge Request Hook'
 
-executor = ThreadPoolExecutor(max_workers=10)
+GL_TIMEOUT_DESCRIPTION = 'SCANOSS scan timed out in the %s stage'
 
 
 class GitLabAPI:
@@ -47,6 +48,8 @@ class GitLabAPI:
   get_files_in_commit_diff(project, commit)
     Returns the list of files in a commit diff
 
+  get_file_fingerprint(project, commit, filename)
+    Streams the raw contents of a file into the fingerprinter and returns its fingerprint.
 
   """
 
@@ -55,6 +58,10 @@ class GitLabAPI:
     self.base_url = config['gitlab']['api-base']
     self.auth_headers = {'PRIVATE-TOKEN': self.api_key}
 
+  def _request(self, method, url, priority, **kwargs):
+    return api_client.request(method, url, token=self.api_key, priority=priority,
+                              headers=self.auth_headers, **kwargs)
+
   def get_diff_json(self, project, commit):
     pg = 1
     tot_page = 1
@@ -64,7 +71,7 @@ class GitLabAPI:
       request_url = "%s/projects/%d/repository/commits/%s/diff?page=%d" % (
           self.base_url, project['id'], commit['id'], pg)
 
-      r = requests.get(request_url, headers=self.auth_headers)
+      r = self._request("GET", request_url, PRIORITY_HIGH)
       if r.status_code != 200:
         logging.error(
             "There was an error trying to obtain diff for commit, the server returned status %d", r.status_code)
@@ -98,31 +105,48 @@ class GitLabAPI:
     comments_url = "%s/projects/%d/repository/commits/%s/comments" % (
         self.base_url, project['id'], commit['id'])
     logging.debug("Post comment to URL: %s", comments_url)
-    r = requests.post(comments_url, json=comment, headers=self.auth_headers)
+    r = self._request("POST", comments_url, PRIORITY_LOW, json=comment)
     if r.status_code >= 400:
       logging.error(
           "There was an error posting a comment for commit, the server returned status %d", r.status_code)
 
   def get_assets_json_file(self, project, commit):
-    return self.get_file_contents(project, commit, "oss_assets.json")
+    return self.get_file_contents(project, commit, "oss_assets.json", PRIORITY_LOW)
 
-  def get_file_contents(self, project, commit, filename):
+  def get_file_contents(self, project, commit, filename, priority=PRIORITY_HIGH):
     url = "%s/projects/%d/repository/files/%s" % (
         self.base_url, project['id'], parse.quote_plus(filename))
-    r = requests.get(url, headers=self.auth_headers,
-                     params={"ref": commit["id"]})
+    r = self._request("GET", url, priority, params={"ref": commit["id"]})
     if r.status_code == 200:
       file_json = r.json()
       return base64.b64decode(file_json['content'])
     return None
 
-  def update_build_status(self, project, commit, status=False):
+  def get_file_fingerprint(self, project, commit, filename, priority=PRIORITY_HIGH):
+    """ Returns the winnowing.Fingerprint of a file, None if it cannot be fetched. The raw contents are fingerprinted
+    as they are downloaded from the raw file endpoint, so the file is never held in memory.
+    """
+    url = "%s/projects/%d/repository/files/%s/raw" % (self.base_url, project['id'], parse.quote(filename, safe=''))
+    logs.sampled_debug("file", "Fetching %s at %s", filename, commit["id"])
+    r = self._request("GET", url, priority, params={"ref": commit["id"]}, stream=True)
+    with r:
+      if r.status_code != 200:
+        logging.error("There was an error trying to obtain %s, the server returned status %d", filename,
+                      r.status_code)
+        return None
+      size = r.headers.get('Content-Length')
+      return fingerprinting.fingerprint_stream(compression.iter_response(parse.urlsplit(url).netloc, r),
+                                               int(size) if size else None)
+
+  def update_build_status(self, project, commit, status=False, description=None):
     # POST /projects/:id/statuses/:sha
     logging.debug("Updating build status for commit %s", commit['id'])
     url = "%s/projects/%d/statuses/%s" % (self.base_url,
                                           project['id'], commit['id'])
     data = {"state": "success" if status else "failed"}
-    r = requests.post(url, json=data, headers=self.auth_headers)
+    if description:
+      data["description"] = description
+    r = self._request("POST", url, PRIORITY_NORMAL, json=data)
     if r.status_code >= 400:
       logging.error(
           "There was an error updating build status for commit %s", commit['id'])
@@ -143,7 +167,15 @@ class GitLabRequestHandler(BaseHTTPRequestHandler):
 
   """
 
+  provider = 'gitlab'
+
   def __init__(self, config, *args: Any) -> None:
+    self.configure(config)
+    BaseHTTPRequestHandler.__init__(self, *args)
+
+  def configure(self, config) -> bool:
+    """ Sets up the handler for the given configuration, also used by the routed mode.
+    """
     self.config = config
     self.scanner = Scanner(config)
     self.api_key = self.config['gitlab']['api-key']
@@ -151,12 +183,23 @@ class GitLabRequestHandler(BaseHTTPRequestHandler):
     self.api = GitLabAPI(config)
     logging.debug("Starting GitLabRequestHandler with base_url: %s",
                   self.base_url)
-    BaseHTTPRequestHandler.__init__(self, *args)
+    return True
+
+  def do_GET(self):
+    """ Serves the metrics and administration endpoints.
+    """
+    if admin.handle_get(self):
+      return
+    self.send_response(404, "Not Found")
+    self.end_headers()
 
+  @tracing.traced("gitlab.webhook", new_trace=True)
   def do_POST(self):
     """ Handles the webhook post event.
 
     """
+    if admin.handle_post(self):
+      return
     # We are only interested in push events
     if self.headers.get(GL_HEADER_EVENT) != GL_PUSH_EVENT:
       self.send_response(200, "OK")
@@ -187,6 +230,7 @@ class GitLabRequestHandler(BaseHTTPRequestHandler):
       self.send_response(401, "Gitlab Token not authorized")
       self.end_headers()
       return
+    capture.record(self.provider, self, json_payload)
 
     # Get the project from the json
     try:
@@ -199,34 +243,62 @@ class GitLabRequestHandler(BaseHTTPRequestHandler):
     logging.debug("Returning 200 OK")
     self.send_response(200, "OK")
     self.end_headers()
-    executor.submit(self.process_commits_diff(project, commits))
+    priority = jobs.PRIORITY_PUSH
+    if json_params.get('ref') == "refs/heads/%s" % project.get('default_branch'):
+      priority = jobs.PRIORITY_DEFAULT_BRANCH
+    key = "gitlab:%s" % project.get('id')
+    jobs.dispatch(self, 'process_commits_diff', key, project, commits, priority=priority,
+                  cost=len(commits), supersede=(key, json_params.get('ref')))
 
   def process_commits_diff(self, project, commits):
     logging.debug("Processing commits")
     # For each commit in push
-    for commit in commits:
-      files = {}
-
-      # Get the contents of files in the commit
-      for filename in self.api.get_files_in_commit_diff(project, commit):
+    for index, commit in enumerate(commits):
+      # Commits reported before the job was parked are not scanned again
+      if jobs.is_completed(commit['id']):
+        continue
+      try:
+        self.process_commit(project, commit)
+        jobs.mark_completed(commit['id'])
+      except jobs.DeadlineExceeded as e:
+        self.report_timeout(project, commits[index:], e)
+        raise
+    logging.debug("Finished processing commits")
 
-        contents = self.api.get_file_contents(project, commit, filename)
-        if contents:
-          files[filename] = contents
+  def process_commit(self, project, commit):
+    files = {}
 
-      # Send diff to scanner and obtain results
+    # Get the contents of files in the commit
+    with jobs.stage("fetch"), tracing.span("fetch", commit=commit['id']) as span:
+      for filename in self.api.get_files_in_commit_diff(project, commit):
+        jobs.check_cancelled()
+        fingerprint = self.api.get_file_fingerprint(project, commit, filename)
+        if fingerprint:
+          files[filename] = fingerprint
       asset_json = self.api.get_assets_json_file(project, commit)
-      scan_result = self.scanner.scan_files(files, asset_json)
-      if scan_result:
-        # Add a comment to the commit
-        comment = self.scanner.format_scan_results(scan_result)
-        if comment:
+      span.set(files=len(files))
+
+    # Send diff to scanner and obtain results
+    source = Source(self.provider, project.get('path_with_namespace') or str(project['id']), commit['id'])
+    scan_result = self.scanner.scan_files(files, asset_json, source)
+    if scan_result:
+      # Add a comment to the commit
+      comment = self.scanner.format_scan_results(scan_result)
+      if comment:
+        with jobs.stage("report"), tracing.span("report", commit=commit['id']):
           note = {'note': comment['comment']}
           self.api.post_commit_comment(project, commit, note)
           # Update build status for commit
           self.api.update_build_status(project, commit, comment['validation'])
-          logging.info("Updated comment and build status")
+        logging.info("Updated comment and build status")
 
-      else:
-        logging.info("The server returned no result for scan")
-    logging.debug("Finished processing commits")
+    else:
+      logging.info("The server returned no result for scan")
+
+  def report_timeout(self, project, commits, error):
+    """ Fails the build status of the commit that ran out of time and of the head commit, which the rest of the
+    push is not scanned for.
+    """
+    with jobs.overtime(), tracing.span("report", commit=commits[-1]['id'], timed_out=True):
+      for commit in {c['id']: c for c in (commits[0], commits[-1])}.values():
+        self.api.update_build_status(project, commit, False, GL_TIMEOUT_DESCRIPTION % error.stage)
@@ -0,0 +1,580 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Per-repository fair scheduling of scan jobs.
+
+Webhook handlers submit the work they would otherwise run inline (process_commits_diff, process_pr) as jobs
+keyed by repository. The scheduler dispatches jobs to a fixed pool of worker threads using self-clocked weighted
+fair queuing between repositories:
+ - each job gets a finish tag: max(virtual time, last finish tag of its repository) + cost / weight
+ - the queued job with the lowest finish tag is dispatched first
+ - a repository never runs more than 'max-per-repo' jobs at the same time
+
+Optionally, jobs are split into priority classes (pull requests ahead of branch pushes, ahead of default branch
+pushes). Higher priority classes are always dispatched first.
+
+Jobs may be submitted with a supersede key, typically (repository, ref) or (repository, pull request). A new job
+with the same supersede key cancels the older ones: queued jobs are dropped and running jobs are flagged, so the
+next check_cancelled() call in the job (performed before every git host API call) aborts it. Jobs can also wait
+for a quiet period before starting, so a burst of pushes to the same branch only scans the newest head. A job in its
+quiet period does not hold back the jobs of its repository with other supersede keys.
+
+A job raising RetryLater (e.g. because the SCANOSS API is unavailable) is parked: it is queued again, ahead of the
+other jobs of its repository, and starts after the delay given by the exception, up to 'max-parked' times. It runs
+again from the start, skipping the items (e.g. commits) it recorded as completed with mark_completed().
+
+Every run of a job has a time budget of 'budget' seconds (0 disables it), split across its stages (fetch,
+fingerprint, scan and report) by 'stage-shares'. A stage may run until the job deadline minus the shares of the
+stages after it, so time left over by a stage is available to the next ones. Blocking calls take their timeout from
+the remaining time (see timeout() and deadline()) and check_cancelled() raises DeadlineExceeded once it is over. The
+handlers then get 'overtime' more seconds to report that the scan timed out (see overtime()).
+"""
+
+import collections
+import contextlib
+import functools
+import itertools
+import logging
+import threading
+import time
+
+from scanoss_hook import memory, metrics, profiling, tracing
+
+# Priority classes, lower values are dispatched first
+PRIORITY_PR = 0
+PRIORITY_PUSH = 1
+PRIORITY_DEFAULT_BRANCH = 2
+
+DEFAULT_WORKERS = 10
+DEFAULT_MAX_PER_REPO = 2
+DEFAULT_QUIET_PERIOD = 0
+DEFAULT_MAX_PARKED = 5
+DEFAULT_BUDGET = 900
+DEFAULT_OVERTIME = 30
+# The stages of a job, in the order they run, and the share of the budget reserved for each of them
+STAGES = ("fetch", "fingerprint", "scan", "report")
+DEFAULT_STAGE_SHARES = {"fetch": 0.4, "fingerprint": 0.2, "scan": 0.3, "report": 0.1}
+# Headers identifying a webhook delivery: GitHub, GitLab and Bitbucket
+DELIVERY_HEADERS = ('X-GitHub-Delivery', 'X-Gitlab-Event-UUID', 'X-Request-UUID')
+
+# Outcomes of a finished job
+OUTCOME_COMPLETED = 'completed'
+OUTCOME_SUPERSEDED = 'superseded'
+OUTCOME_TIMED_OUT = 'timed-out'
+OUTCOME_FAILED = 'failed'
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+  """ Raised inside a job that has been superseded by a newer one.
+  """
+
+
+class DeadlineExceeded(JobCancelled):
+  """ Raised inside a job that has run out of its time budget. 'stage' is the stage it was running.
+  """
+
+  def __init__(self, message, stage):
+    super().__init__(message)
+    self.stage = stage
+
+
+class RetryLater(Exception):
+  """ Raised inside a job that cannot make progress now. The job is queued again to be retried after 'delay'
+  seconds.
+  """
+
+  def __init__(self, message, delay):
+    super().__init__(message)
+    self.delay = delay
+
+
+def current_job():
+  """ Returns the Job running in the current thread, None outside of a scheduler worker.
+  """
+  return getattr(_local, 'job', None)
+
+
+def add_stats(**stats):
+  """ Adds the given values to the statistics of the job running in the current thread.
+  """
+  job = current_job()
+  if job is not None:
+    for name, value in stats.items():
+      job.stats[name] = job.stats.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def activate(job):
+  """ Makes job the current job of the thread, e.g. in helper threads doing work for it.
+  """
+  previous = current_job()
+  _local.job = job
+  try:
+    yield job
+  finally:
+    _local.job = previous
+
+
+def bind(fn):
+  """ Returns fn wrapped to run within the current job and span of the calling thread, to be run by helper
+  threads. Cancelling the job also aborts the helper threads at their next check_cancelled().
+  """
+  job = current_job()
+  span = tracing.current_span()
+
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    with activate(job), tracing.activate(span):
+      return fn(*args, **kwargs)
+  return wrapper
+
+
+def mark_completed(item):
+  """ Records that the job running in the current thread has processed and reported item (e.g. a commit), so it is
+  skipped if the job is parked and runs again.
+  """
+  job = current_job()
+  if job is not None:
+    job.completed.add(item)
+
+
+def is_completed(item):
+  """ Returns True if the job running in the current thread processed item in a previous run.
+  """
+  job = current_job()
+  return job is not None and item in job.completed
+
+
+def check_cancelled():
+  """ Raises JobCancelled if the job running in the current thread has been cancelled, DeadlineExceeded if the
+  deadline of its current stage has passed.
+  """
+  job = current_job()
+  if job is None:
+    return
+  if job.cancelled.is_set():
+    raise JobCancelled("Job %d for %s has been superseded" % (job.id, job.key))
+  if job.stage_deadline is not None and time.monotonic() >= job.stage_deadline:
+    raise DeadlineExceeded("Job %d for %s ran out of time in the %s stage" % (job.id, job.key, job.stage or "job"),
+                           job.stage or "job")
+
+
+def deadline():
+  """ Returns the monotonic time the current stage of the job running in the current thread must end by, None if
+  there is no deadline.
+  """
+  job = current_job()
+  return job.stage_deadline if job is not None else None
+
+
+def timeout(default):
+  """ Returns the timeout of a blocking call of the current job: default, or less if the deadline of its stage is
+  closer. Raises DeadlineExceeded if the deadline has already passed.
+  """
+  check_cancelled()
+  end = deadline()
+  return default if end is None else min(default, end - time.monotonic())
+
+
+@contextlib.contextmanager
+def stage(name):
+  """ Runs the enclosed code as the given stage (one of STAGES) of the current job, bounded by the job deadline
+  minus the budget shares of the stages after it.
+  """
+  job = current_job()
+  if job is None:
+    yield
+    return
+  previous = job.stage, job.stage_deadline
+  job.stage = name
+  if job.deadline is not None:
+    later = STAGES[STAGES.index(name) + 1:]
+    job.stage_deadline = job.deadline - job.budget * sum(job.stage_shares.get(s, 0) for s in later)
+  started = time.monotonic()
+  try:
+    yield
+  finally:
+    job.stage, job.stage_deadline = previous
+    metrics.observe("scanoss_hook_job_stage_seconds", time.monotonic() - started, {"stage": name})
+
+
+@contextlib.contextmanager
+def overtime(seconds=None):
+  """ Gives the current job 'seconds' (by default the configured overtime) past its deadline, e.g. to report that
+  it has timed out.
+  """
+  job = current_job()
+  if job is None or job.deadline is None:
+    yield
+    return
+  previous = job.stage_deadline
+  job.stage_deadline = time.monotonic() + (job.overtime if seconds is None else seconds)
+  try:
+    yield
+  finally:
+    job.stage_deadline = previous
+
+
+class Job:
+  """
+  A unit of work submitted to the JobScheduler.
+
+  Attributes
+  ----------
+  id : int
+    A process unique identifier.
+  key : str
+    The repository the job belongs to.
+  priority : int
+    The priority class of the job.
+  cost : float
+    The relative cost of the job, typically the number of commits to scan.
+  enqueued_at : float
+    The monotonic time the job was submitted.
+  started_at : float
+    The monotonic time the job started running, None if it is still queued.
+  supersede : tuple
+    Jobs with the same supersede key cancel the older ones, None if the job cannot be superseded.
+  not_before : float
+    The monotonic time before which the job must not start.
+  cancelled : threading.Event
+    Set when the job has been superseded.
+  stats : dict
+    Counters updated while the job runs, e.g. files and bytes fingerprinted.
+  parked : int
+    The times the job has been queued again after raising RetryLater.
+  completed : set
+    The items (e.g. commits) already processed, skipped when a parked job runs again.
+  outcome : str
+    How the job finished (OUTCOME_COMPLETED, OUTCOME_SUPERSEDED, OUTCOME_TIMED_OUT or OUTCOME_FAILED), None until
+    it is done.
+  on_done : callable
+    Called with the job once it is done, None if not needed.
+  deadline : float
+    The monotonic time the current run of the job must end by, None if it has no time budget.
+  stage : str
+    The stage the job is running, None outside of a stage.
+  stage_deadline : float
+    The monotonic time the current stage must end by, None if the job has no time budget.
+  """
+
+  _ids = itertools.count(1)
+
+  def __init__(self, key, fn, args, kwargs, priority, cost, supersede=None, not_before=0.0, on_done=None):
+    self.id = next(self._ids)
+    self.key = key
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+    self.priority = priority
+    self.cost = cost
+    self.finish_tag = 0.0
+    self.enqueued_at = time.monotonic()
+    self.started_at = None
+    self.supersede = supersede
+    self.not_before = not_before
+    self.cancelled = threading.Event()
+    self.done = threading.Event()
+    self.stats = {}
+    self.parked = 0
+    self.completed = set()
+    self.outcome = None
+    self.on_done = on_done
+    self.budget = 0
+    self.stage_shares = {}
+    self.overtime = 0
+    self.deadline = None
+    self.stage = None
+    self.stage_deadline = None
+    # Jobs run as part of the trace of the webhook delivery that submitted them
+    self.trace = tracing.current_span()
+
+  def run(self):
+    return self.fn(*self.args, **self.kwargs)
+
+  def finish(self, outcome):
+    """ Marks the job as done with the given outcome and calls its on_done callback.
+    """
+    self.outcome = outcome
+    if self.on_done is not None:
+      try:
+        self.on_done(self)
+      except Exception:
+        logging.exception("Error finishing job %d for %s", self.id, self.key)
+    self.done.set()
+
+
+class JobScheduler:
+  """
+  Weighted fair queuing scheduler of scan jobs.
+
+  Methods
+  -------
+  submit(key, fn, *args, priority, cost, supersede, **kwargs)
+    Queues a job for the given repository key.
+
+  queued(key)
+    Returns the number of queued jobs of a repository.
+
+  drain(timeout)
+    Waits for all the queued and running jobs to finish.
+  """
+
+  def __init__(self, workers=DEFAULT_WORKERS, max_per_repo=DEFAULT_MAX_PER_REPO, weights=None,
+               priority_classes=True, quiet_period=DEFAULT_QUIET_PERIOD, max_parked=DEFAULT_MAX_PARKED,
+               budget=0, stage_shares=None, overtime=DEFAULT_OVERTIME):
+    self.workers = workers
+    self.budget = budget
+    self.stage_shares = dict(DEFAULT_STAGE_SHARES, **(stage_shares or {}))
+    self.overtime = overtime
+    self.max_parked = max_parked
+    self.max_per_repo = max_per_repo
+    self.weights = weights or {}
+    self.priority_classes = priority_classes
+    self.quiet_period = quiet_period
+    self.active = {}
+    self.queues = collections.defaultdict(collections.deque)
+    self.running = collections.Counter()
+    self.last_finish = {}
+    self.virtual_time = 0.0
+    self.cond = threading.Condition()
+    self.threads = []
+
+  def submit(self, key, fn, *args, priority=PRIORITY_PUSH, cost=1, supersede=None, on_done=None, **kwargs):
+    """ Queues fn(*args, **kwargs) as a job of the repository identified by key. Returns the Job.
+
+    If supersede is given, the queued and running jobs with the same supersede key are cancelled and the new
+    job waits for the configured quiet period before starting. on_done is called with the job once it is done.
+    """
+    not_before = time.monotonic() + self.quiet_period if supersede is not None else 0.0
+    job = Job(key, fn, args, kwargs, priority if self.priority_classes else PRIORITY_PUSH, max(cost, 1),
+              supersede=supersede, not_before=not_before, on_done=on_done)
+    with self.cond:
+      if supersede is not None:
+        self._supersede(supersede)
+        self.active.setdefault(supersede, []).append(job)
+      start = max(self.virtual_time, self.last_finish.get(key, 0.0))
+      job.finish_tag = start + job.cost / float(self.weights.get(key, 1))
+      self.last_finish[key] = job.finish_tag
+      self.queues[key].append(job)
+      self._publish(key)
+      self._start_workers()
+      self.cond.notify()
+    logging.debug("Queued job %d for %s", job.id, key)
+    return job
+
+  def _supersede(self, supersede):
+    for old in self.active.pop(supersede, []):
+      old.cancelled.set()
+      queue = self.queues.get(old.key)
+      if queue and old in queue:
+        queue.remove(old)
+        if not queue:
+          del self.queues[old.key]
+        old.finish(OUTCOME_SUPERSEDED)
+        self._publish(old.key)
+      logging.info("Job %d for %s superseded", old.id, old.key)
+      metrics.inc_counter("scanoss_hook_jobs_superseded_total", labels={"repo": old.key})
+
+  def _forget(self, job):
+    active = self.active.get(job.supersede)
+    if active and job in active:
+      active.remove(job)
+      if not active:
+        del self.active[job.supersede]
+
+  def _park(self, job, error):
+    """ Queues a job that raised RetryLater again, to start after the delay it asked for. Returns None if the job
+    has been parked, otherwise its outcome: OUTCOME_SUPERSEDED if a newer job supersedes it, OUTCOME_FAILED if it
+    has been parked too many times.
+    """
+    with self.cond:
+      if job.cancelled.is_set():
+        logging.info("Job %d for %s not retried, a newer job supersedes it", job.id, job.key)
+        return OUTCOME_SUPERSEDED
+      if job.parked >= self.max_parked:
+        logging.error("Job %d for %s failed after %d retries: %s", job.id, job.key, job.parked, error)
+        return OUTCOME_FAILED
+      job.parked += 1
+      job.not_before = time.monotonic() + error.delay
+      job.enqueued_at = time.monotonic()
+      # Ahead of the newer jobs of the repository, which keep waiting for it
+      self.queues[job.key].appendleft(job)
+      self._publish(job.key)
+    logging.warning("Job %d for %s parked for %.0f seconds: %s", job.id, job.key, error.delay, error)
+    metrics.inc_counter("scanoss_hook_jobs_parked_total", labels={"repo": job.key})
+    return None
+
+  def drain(self, timeout=None):
+    """ Waits until there are no queued or running jobs. Returns False if the timeout expired first.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with self.cond:
+      while self.queues or self.running:
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+          return False
+        self.cond.wait(remaining)
+    return True
+
+  def queued(self, key):
+    with self.cond:
+      return len(self.queues.get(key, ()))
+
+  def _start_workers(self):
+    while len(self.threads) < self.workers:
+      t = threading.Thread(target=self._worker, name="scan-worker-%d" % len(self.threads), daemon=True)
+      self.threads.append(t)
+      t.start()
+
+  def _first_eligible(self, queue, now):
+    """ Returns the first job of a repository queue that can start now, None if there is none, and the time to
+    wait for the first job that cannot. A job in its quiet period only holds back the later jobs with the same
+    supersede key, a parked job holds back the whole queue.
+    """
+    wait = None
+    held = set()
+    for job in queue:
+      if job.supersede is not None and job.supersede in held:
+        continue
+      if job.not_before <= now:
+        return job, wait
+      wait = job.not_before - now if wait is None else min(wait, job.not_before - now)
+      if job.parked or job.supersede is None:
+        break
+      held.add(job.supersede)
+    return None, wait
+
+  def _next_job(self):
+    """ Returns the eligible job with the best (priority class, finish tag) and the time to wait for the
+    next job that is still in its quiet period or parked.
+    """
+    best = None
+    wait = None
+    now = time.monotonic()
+    for key, queue in self.queues.items():
+      if not queue or self.running[key] >= self.max_per_repo:
+        continue
+      job, job_wait = self._first_eligible(queue, now)
+      if job_wait is not None:
+        wait = job_wait if wait is None else min(wait, job_wait)
+      if job is None:
+        continue
+      if best is None or (job.priority, job.finish_tag) < (best.priority, best.finish_tag):
+        best = job
+    return best, wait
+
+  def _worker(self):
+    while True:
+      with self.cond:
+        job, wait = self._next_job()
+        while job is None:
+          self.cond.wait(wait)
+          job, wait = self._next_job()
+        self.queues[job.key].remove(job)
+        if not self.queues[job.key]:
+          del self.queues[job.key]
+        self.running[job.key] += 1
+        self.virtual_time = max(self.virtual_time, job.finish_tag - job.cost / float(self.weights.get(job.key, 1)))
+        self._publish(job.key)
+      job.started_at = time.monotonic()
+      job.budget, job.stage_shares, job.overtime = self.budget, self.stage_shares, self.overtime
+      job.deadline = job.started_at + self.budget if self.budget else None
+      job.stage, job.stage_deadline = None, job.deadline
+      metrics.observe("scanoss_hook_job_queue_wait_seconds", job.started_at - job.enqueued_at, {"repo": job.key})
+      _local.job = job
+      parked = False
+      outcome = OUTCOME_FAILED
+      try:
+        with memory.job_budget(job), tracing.activate(job.trace), \
+             tracing.span("job", repo=job.key, job=job.id), profiling.profile_job(job):
+          job.run()
+        outcome = OUTCOME_COMPLETED
+      except DeadlineExceeded as e:
+        outcome = OUTCOME_TIMED_OUT
+        logging.error("Job %d for %s timed out after %.0f seconds in the %s stage", job.id, job.key,
+                      time.monotonic() - job.started_at, e.stage)
+        metrics.inc_counter("scanoss_hook_jobs_timed_out_total", labels={"repo": job.key, "stage": e.stage})
+      except JobCancelled:
+        outcome = OUTCOME_SUPERSEDED
+        logging.info("Job %d for %s aborted, a newer job supersedes it", job.id, job.key)
+      except RetryLater as e:
+        outcome = self._park(job, e)
+        parked = outcome is None
+      except Exception:
+        logging.exception("Job %d for %s failed", job.id, job.key)
+      finally:
+        _local.job = None
+        metrics.observe("scanoss_hook_job_run_seconds", time.monotonic() - job.started_at, {"repo": job.key})
+        if not parked:
+          job.finish(outcome)
+        with self.cond:
+          if not parked:
+            self._forget(job)
+          self.running[job.key] -= 1
+          if not self.running[job.key]:
+            del self.running[job.key]
+          self._publish(job.key)
+          self.cond.notify_all()
+
+  def _publish(self, key):
+    metrics.set_gauge("scanoss_hook_jobs_queued", len(self.queues.get(key, ())), {"repo": key})
+    metrics.set_gauge("scanoss_hook_jobs_running", self.running.get(key, 0), {"repo": key})
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_dispatcher = None
+
+
+def get_scheduler(config=None):
+  """ Returns the process wide JobScheduler, creating it from the 'jobs' configuration section if needed.
+  """
+  global _scheduler
+  with _scheduler_lock:
+    if _scheduler is None:
+      cfg = (config or {}).get('jobs') or {}
+      _scheduler = JobScheduler(workers=int(cfg.get('workers', DEFAULT_WORKERS)),
+                                max_per_repo=int(cfg.get('max-per-repo', DEFAULT_MAX_PER_REPO)),
+                                weights=cfg.get('weights'),
+                                priority_classes=bool(cfg.get('priority-classes', True)),
+                                quiet_period=float(cfg.get('quiet-period', DEFAULT_QUIET_PERIOD)),
+                                max_parked=int(cfg.get('max-parked', DEFAULT_MAX_PARKED)),
+                                budget=float(cfg.get('budget', DEFAULT_BUDGET) or 0),
+                                stage_shares=cfg.get('stage-shares'),
+                                overtime=float(cfg.get('overtime', DEFAULT_OVERTIME)))
+    return _scheduler
+
+
+def set_dispatcher(dispatcher):
+  """ Sets the object jobs are dispatched through, e.g. a scanoss_hook.cluster.Cluster. None to run jobs locally.
+  """
+  global _dispatcher
+  _dispatcher = dispatcher
+
+
+def delivery_id(handler):
+  """ Returns the ID the git host gave to the webhook delivery being handled, None if it has none.
+  """
+  headers = getattr(handler, 'headers', None)
+  if headers is None:
+    return None
+  return next((headers.get(name) for name in DELIVERY_HEADERS if headers.get(name)), None)
+
+
+def dispatch(handler, method, key, *args, priority=PRIORITY_PUSH, cost=1, supersede=None):
+  """ Submits handler.method(*args) as a job of the repository identified by key.
+
+  Without a dispatcher the job is queued in the local scheduler. In cluster mode the dispatcher may send it to
+  the node that owns the repository, so the arguments must be JSON serializable.
+  """
+  if _dispatcher is not None:
+    return _dispatcher.dispatch(handler.provider, method, key, args, priority=priority, cost=cost,
+                                supersede=supersede, delivery=delivery_id(handler))
+  return get_scheduler(handler.config).submit(key, getattr(handler, method), *args, priority=priority,
+                                              cost=cost, supersede=supersede)
@@ -0,0 +1,309 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Load generator for the SCANOSS webhook.
+
+scanoss-hook-loadtest mock       Runs the mock git hosts and SCANOSS API (see mock_servers).
+scanoss-hook-loadtest generate   Writes a synthetic corpus of push deliveries pointing to the mocks.
+scanoss-hook-loadtest replay     Replays a corpus (captured or generated) against a running webhook, at a fixed
+                                 rate or concurrency, and reports the throughput and the latency percentiles. With
+                                 --mock it also waits for the scans to complete and reports the end to end
+                                 throughput.
+
+Typical session, with the webhook configured to use the mocks (and 'comment_always: 1' in the scanoss
+section for GitHub, as it only reports the scans by posting comments):
+
+  scanoss-hook-loadtest mock --port 8899 --files 50 --latency 0.02
+  scanoss-hook-loadtest generate --provider gitlab --count 200 --mock http://localhost:8899 --out /tmp/corpus
+  scanoss-hook-loadtest replay --corpus /tmp/corpus --target http://localhost:8888 --rate 20 \\
+    --mock http://localhost:8899
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from scanoss_hook import capture, jobs
+from scanoss_hook.mock_servers import MockServer
+
+# Headers that must not be replayed as captured
+HOP_HEADERS = {'host', 'content-length', 'connection', 'transfer-encoding', 'accept-encoding'}
+REPLAY_TIMEOUT = 30
+
+
+def percentile(values, p):
+  """ Returns the nearest-rank p-th percentile of a list of values.
+  """
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  rank = max(1, math.ceil(p / 100.0 * len(ordered)))
+  return ordered[min(rank, len(ordered)) - 1]
+
+
+def _sha(*parts):
+  return hashlib.sha1(":".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def generate(provider, count, mock_url, commits=1, secret=None):
+  """ Returns a list of synthetic push deliveries for a provider, with API URLs pointing to the mocks.
+  """
+  deliveries = []
+  for i in range(count):
+    shas = [_sha(provider, i, c) for c in range(commits)]
+    repo = "repo-%d" % (i % 10)
+    headers = {"Content-Type": "application/json"}
+    if provider == 'gitlab':
+      path = "/gitlab"
+      body = {"object_kind": "push", "ref": "refs/heads/branch-%d" % i,
+              "project": {"id": 1000 + i % 10, "name": repo, "default_branch": "main"},
+              "commits": [{"id": sha} for sha in shas]}
+      headers.update({"X-Gitlab-Event": "Push Hook", "X-Gitlab-Token": secret or ""})
+    elif provider == 'github':
+      path = "/github"
+      body = {"ref": "refs/heads/branch-%d" % i,
+              "repository": {"name": repo, "full_name": "loadtest/%s" % repo, "default_branch": "main",
+                             "owner": {"login": "loadtest", "name": "loadtest", "type": "User"}},
+              "commits": [{"id": sha} for sha in shas]}
+      headers["X-GitHub-Event"] = "push"
+    elif provider == 'bitbucket':
+      path = "/bitbucket"
+      base = "%s/bitbucket/2.0/repositories/loadtest/%s" % (mock_url.rstrip('/'), repo)
+      body = {"repository": {"full_name": "loadtest/%s" % repo},
+              "push": {"changes": [{"new": {"name": "branch-%d" % i},
+                                    "links": {"diff": {"href": "%s/diff/%s" % (base, shas[-1])}},
+                                    "commits": [{"hash": sha} for sha in shas]}]}}
+      headers["X-Event-Key"] = "repo:push"
+    else:
+      raise ValueError("Unknown provider: %s" % provider)
+    deliveries.append({"time": time.time(), "provider": provider, "path": path, "headers": headers,
+                       "body": json.dumps(body)})
+  return deliveries
+
+
+def prepare(delivery, rewrites=(), github_secret=None, gitlab_secret=None):
+  """ Returns the path, headers and body to replay a delivery, applying the URL rewrites, re-signing GitHub
+  deliveries and adding the token of GitLab deliveries when a secret is given (captured deliveries have neither).
+  Delivery IDs are replaced by new ones, so a cluster does not skip the replays as duplicates.
+  """
+  body = delivery["body"]
+  for old, new in rewrites:
+    body = body.replace(old, new)
+  headers = {k: v for k, v in delivery["headers"].items() if k.lower() not in HOP_HEADERS}
+  delivery_headers = {name.lower() for name in jobs.DELIVERY_HEADERS}
+  headers = {k: str(uuid.uuid4()) if k.lower() in delivery_headers else v for k, v in headers.items()}
+  if github_secret is not None and delivery.get("provider") == 'github':
+    headers = {k: v for k, v in headers.items() if k.lower() != 'x-hub-signature'}
+    headers["X-Hub-Signature"] = "sha1=" + hmac.new(github_secret.encode(), body.encode(), hashlib.sha1).hexdigest()
+  if gitlab_secret is not None and delivery.get("provider") == 'gitlab':
+    headers["X-Gitlab-Token"] = gitlab_secret
+  return delivery["path"], headers, body.encode()
+
+
+class Replayer:
+  """
+  Replays deliveries against a webhook and records the response latencies.
+
+  Attributes
+  ----------
+  target : str
+    The base URL of the webhook.
+  latencies : list
+    The latency of every successful delivery, in seconds.
+  errors : int
+    The number of deliveries that failed or were answered with an error status.
+  """
+
+  def __init__(self, target, rewrites=(), github_secret=None, gitlab_secret=None):
+    self.target = target.rstrip('/')
+    self.rewrites = rewrites
+    self.github_secret = github_secret
+    self.gitlab_secret = gitlab_secret
+    self.latencies = []
+    self.errors = 0
+    self.lock = threading.Lock()
+    self.local = threading.local()
+
+  def send(self, delivery):
+    session = getattr(self.local, 'session', None)
+    if session is None:
+      session = self.local.session = requests.Session()
+    path, headers, body = prepare(delivery, self.rewrites, self.github_secret, self.gitlab_secret)
+    start = time.monotonic()
+    try:
+      r = session.post(self.target + path, data=body, headers=headers, timeout=REPLAY_TIMEOUT)
+      ok = r.status_code < 400
+    except requests.RequestException:
+      ok = False
+    elapsed = time.monotonic() - start
+    with self.lock:
+      if ok:
+        self.latencies.append(elapsed)
+      else:
+        self.errors += 1
+
+  def run(self, deliveries, rate=None, concurrency=1):
+    """ Sends the deliveries at 'rate' deliveries per second (open loop), or back to back from 'concurrency'
+    threads (closed loop). Returns the elapsed time.
+    """
+    start = time.monotonic()
+    if rate:
+      with ThreadPoolExecutor(max_workers=max(concurrency, 64)) as executor:
+        for i, delivery in enumerate(deliveries):
+          delay = start + i / float(rate) - time.monotonic()
+          if delay > 0:
+            time.sleep(delay)
+          executor.submit(self.send, delivery)
+    else:
+      pending = iter(deliveries)
+      pending_lock = threading.Lock()
+
+      def worker():
+        while True:
+          with pending_lock:
+            delivery = next(pending, None)
+          if delivery is None:
+            return
+          self.send(delivery)
+      threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+    return time.monotonic() - start
+
+  def report(self, elapsed):
+    sent = len(self.latencies) + self.errors
+    return {"sent": sent, "errors": self.errors, "seconds": elapsed,
+            "throughput": sent / elapsed if elapsed else 0.0,
+            "p50": percentile(self.latencies, 50), "p90": percentile(self.latencies, 90),
+            "p99": percentile(self.latencies, 99), "max": max(self.latencies) if self.latencies else 0.0}
+
+
+def wait_for_scans(mock_url, expected, timeout):
+  """ Waits until the mocks have recorded 'expected' more completed scans. Returns the final mock stats.
+  """
+  deadline = time.monotonic() + timeout
+  stats = requests.get(mock_url.rstrip('/') + "/_mock/stats", timeout=REPLAY_TIMEOUT).json()
+  while stats["completed"] < expected and time.monotonic() < deadline:
+    time.sleep(0.5)
+    stats = requests.get(mock_url.rstrip('/') + "/_mock/stats", timeout=REPLAY_TIMEOUT).json()
+  return stats
+
+
+def commits_in(delivery):
+  """ Returns the number of commits of a push delivery, that is, the number of scans it triggers.
+  """
+  try:
+    body = json.loads(delivery["body"])
+  except ValueError:
+    return 0
+  if "push" in body:
+    return sum(len(change.get("commits") or []) for change in body["push"].get("changes") or [])
+  return len(body.get("commits") or [])
+
+
+def _rewrite(value):
+  if '=' not in value:
+    raise argparse.ArgumentTypeError("Expected FROM=TO, got %s" % value)
+  return tuple(value.split('=', 1))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Load generator for the SCANOSS webhook")
+  sub = parser.add_subparsers(dest="command")
+  sub.required = True
+
+  p = sub.add_parser("mock", help="Run the mock git hosts and SCANOSS API")
+  p.add_argument("--addr", default="127.0.0.1")
+  p.add_argument("--port", type=int, default=8899)
+  p.add_argument("--files", type=int, default=20, help="Files changed in each commit")
+  p.add_argument("--file-size", type=int, default=4096, help="Size of each file in bytes")
+  p.add_argument("--latency", type=float, default=0.0, help="Delay of each API response in seconds")
+  p.add_argument("--match-ratio", type=float, default=0.0, help="Fraction of files reported as matches")
+  p.add_argument("--rate-limit", type=int, help="Hourly API rate limit advertised in the responses")
+  p.add_argument("--scan-latency", type=float, default=0.0, help="Extra delay of each SCANOSS scan in seconds")
+  p.add_argument("--scan-error-rate", type=float, default=0.0, help="Fraction of SCANOSS scans answered with 503")
+
+  p = sub.add_parser("generate", help="Write a synthetic corpus of push deliveries")
+  p.add_argument("--provider", choices=["gitlab", "github", "bitbucket"], required=True)
+  p.add_argument("--count", type=int, default=100)
+  p.add_argument("--commits", type=int, default=1, help="Commits in each push")
+  p.add_argument("--mock", default="http://localhost:8899", help="Base URL of the mock servers")
+  p.add_argument("--secret", help="GitLab secret token to include in the deliveries")
+  p.add_argument("--out", required=True, help="Corpus directory")
+
+  p = sub.add_parser("replay", help="Replay a corpus against a running webhook")
+  p.add_argument("--corpus", required=True, help="Corpus directory")
+  p.add_argument("--target", required=True, help="Base URL of the webhook, e.g. http://localhost:8888")
+  group = p.add_mutually_exclusive_group()
+  group.add_argument("--rate", type=float, help="Deliveries per second")
+  group.add_argument("--concurrency", type=int, default=1, help="Concurrent senders")
+  p.add_argument("--count", type=int, help="Number of deliveries to send, cycling through the corpus")
+  p.add_argument("--rewrite", type=_rewrite, action="append", default=[], metavar="FROM=TO",
+                 help="Replace a string (e.g. an API URL) in the payloads")
+  p.add_argument("--github-secret", help="Re-sign GitHub deliveries with this secret")
+  p.add_argument("--gitlab-secret", help="Send GitLab deliveries with this secret token")
+  p.add_argument("--mock", help="Base URL of the mock servers, to wait for the scans to complete")
+  p.add_argument("--wait", type=float, default=600, help="Seconds to wait for the scans to complete")
+
+  args = parser.parse_args(argv)
+
+  if args.command == "mock":
+    server = MockServer(args.addr, args.port, files=args.files, file_size=args.file_size, latency=args.latency,
+                        match_ratio=args.match_ratio, rate_limit=args.rate_limit, scan_latency=args.scan_latency,
+                        scan_error_rate=args.scan_error_rate)
+    print("Mock servers listening on %s" % server.url)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    return 0
+
+  if args.command == "generate":
+    os.makedirs(args.out, exist_ok=True)
+    for i, delivery in enumerate(generate(args.provider, args.count, args.mock, args.commits, args.secret)):
+      with open(os.path.join(args.out, "%06d-%s.json" % (i, args.provider)), "w") as f:
+        json.dump(delivery, f)
+    print("Wrote %d deliveries to %s" % (args.count, args.out))
+    return 0
+
+  deliveries = capture.load(args.corpus)
+  if not deliveries:
+    print("No deliveries in %s" % args.corpus, file=sys.stderr)
+    return 1
+  count = args.count or len(deliveries)
+  deliveries = [deliveries[i % len(deliveries)] for i in range(count)]
+  before = 0
+  if args.mock:
+    before = wait_for_scans(args.mock, 0, 0)["completed"]
+  replayer = Replayer(args.target, args.rewrite, args.github_secret, args.gitlab_secret)
+  report = replayer.report(replayer.run(deliveries, rate=args.rate, concurrency=args.concurrency))
+  print("Sent %(sent)d deliveries in %(seconds).2fs (%(throughput).1f/s), %(errors)d errors" % report)
+  print("Latency p50 %.1fms p90 %.1fms p99 %.1fms max %.1fms" % tuple(
+    report[k] * 1000 for k in ("p50", "p90", "p99", "max")))
+  if args.mock:
+    start = time.monotonic()
+    stats = wait_for_scans(args.mock, before + sum(commits_in(d) for d in deliveries), args.wait)
+    done = stats["completed"] - before
+    elapsed = report["seconds"] + time.monotonic() - start
+    print("Completed %d scans in %.2fs (%.2f scans/s)" % (done, elapsed, done / elapsed if elapsed else 0.0))
+    print("Mock requests: %s" % json.dumps(stats["requests"], sort_keys=True))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
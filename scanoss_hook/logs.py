@@ -0,0 +1,236 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Logging setup for the SCANOSS webhook.
+
+ - The records are put in a bounded queue and written to stdout and the log file by a background thread, so the
+   request and worker threads never wait for the disk. Records are dropped, and counted in the
+   scanoss_hook_log_dropped_total metric, when the queue is full.
+ - The level can be set by module ('levels'). The modules of the webhook log through the root logger, so their
+   levels are applied by module name (e.g. scanoss_hook.scanner), other libraries by logger name (e.g. urllib3).
+ - payload() defers the serialization of large values until a record is written, and truncates them.
+ - sampled_debug() limits the debug lines written for each file or component to 'sample-rate' per second.
+
+Configuration example:
+
+logging:
+  level: INFO
+  file: /var/log/scanoss-hook.log
+  queue-size: 10000
+  payload-limit: 2048
+  sample-rate: 10
+  levels:
+    scanoss_hook.scanner: DEBUG
+    urllib3: WARNING
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers as handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from scanoss_hook import metrics, tracing
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_FILE = "/var/log/scanoss-hook.log"
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_PAYLOAD_LIMIT = 2048
+DEFAULT_SAMPLE_RATE = 10
+LOG_FORMAT = "%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s"
+PACKAGE = "scanoss_hook."
+
+_settings = {"queue-size": DEFAULT_QUEUE_SIZE, "payload-limit": DEFAULT_PAYLOAD_LIMIT,
+             "sample-rate": DEFAULT_SAMPLE_RATE}
+_listener = None
+_queue_handler = None
+_sinks = []
+
+
+class LevelFilter(logging.Filter):
+  """ Applies the level of their module to the records of the webhook modules, and the default level to the rest.
+  The records of loggers with a level of their own have been filtered by the logger already.
+  """
+
+  def __init__(self, level, levels):
+    super().__init__()
+    self.level = level
+    self.modules = {name[len(PACKAGE):]: value for name, value in levels.items() if name.startswith(PACKAGE)}
+    self.loggers = tuple(name for name in levels if not name.startswith(PACKAGE))
+
+  def filter(self, record):
+    if any(record.name == name or record.name.startswith(name + ".") for name in self.loggers):
+      return True
+    return record.levelno >= self.modules.get(record.module, self.level)
+
+
+class DroppingQueueHandler(handlers.QueueHandler):
+  """ A QueueHandler that drops the records instead of blocking or failing when the queue is full.
+  """
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      metrics.inc_counter("scanoss_hook_log_dropped_total")
+
+
+def _level(value):
+  return value if isinstance(value, int) else logging.getLevelName(str(value).upper())
+
+
+def _start_listener():
+  global _listener
+  log_queue = queue.Queue(_settings["queue-size"])
+  _queue_handler.queue = log_queue
+  _listener = handlers.QueueListener(log_queue, *_sinks, respect_handler_level=True)
+  _listener.start()
+
+
+def _after_fork():
+  # The writer thread does not survive a fork, each worker process starts its own
+  if _listener is not None:
+    _start_listener()
+
+
+def stop():
+  """ Writes the queued records, stops the background writer and removes the handlers.
+  """
+  global _listener, _queue_handler
+  if _listener is not None:
+    _listener.stop()
+    _listener = None
+  if _queue_handler is not None:
+    logging.getLogger().removeHandler(_queue_handler)
+    _queue_handler = None
+  for sink in _sinks:
+    sink.close()
+  del _sinks[:]
+
+
+def configure(config=None, stream=sys.stdout):
+  """ Sets up the logging from the 'logging' configuration section.
+  """
+  global _queue_handler
+  config = config or {}
+  stop()
+  root = logging.getLogger()
+
+  _settings["queue-size"] = int(config.get("queue-size", DEFAULT_QUEUE_SIZE))
+  _settings["payload-limit"] = int(config.get("payload-limit", DEFAULT_PAYLOAD_LIMIT))
+  _settings["sample-rate"] = float(config.get("sample-rate", DEFAULT_SAMPLE_RATE))
+  _sampler.reset()
+
+  formatter = logging.Formatter(LOG_FORMAT)
+  if stream is not None:
+    _sinks.append(logging.StreamHandler(stream))
+  path = config.get("file", DEFAULT_FILE)
+  if path:
+    _sinks.append(handlers.TimedRotatingFileHandler(path, when='midnight', interval=1))
+  for sink in _sinks:
+    sink.setFormatter(formatter)
+
+  level = _level(config.get("level", DEFAULT_LEVEL))
+  levels = {name: _level(value) for name, value in (config.get("levels") or {}).items()}
+  for name, value in levels.items():
+    if not name.startswith(PACKAGE):
+      logging.getLogger(name).setLevel(value)
+  # Records of the webhook modules are created at the lowest level any of them needs, then filtered by module
+  module_levels = [value for name, value in levels.items() if name.startswith(PACKAGE)]
+  root.setLevel(min([level] + module_levels))
+  _queue_handler = DroppingQueueHandler(None)
+  # The trace ID is taken from the thread logging the record, before it is queued
+  _queue_handler.addFilter(tracing.TraceIdFilter())
+  _queue_handler.addFilter(LevelFilter(level, levels))
+  root.addHandler(_queue_handler)
+  _start_listener()
+
+
+class Payload:
+  """ A value logged as JSON (or as is if it is a string), serialized only if the record is written and truncated
+  to 'payload-limit' characters.
+  """
+
+  __slots__ = ("value", "limit")
+
+  def __init__(self, value, limit=None):
+    self.value = value
+    self.limit = limit
+
+  def __str__(self):
+    value = self.value
+    if isinstance(value, bytes):
+      value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, str):
+      try:
+        value = json.dumps(value)
+      except (TypeError, ValueError):
+        value = repr(value)
+    limit = self.limit if self.limit is not None else _settings["payload-limit"]
+    if len(value) > limit:
+      return "%s... (%d more characters)" % (value[:limit], len(value) - limit)
+    return value
+
+
+def payload(value, limit=None):
+  """ Returns a lazy, size capped representation of value to be passed as a logging argument.
+  """
+  return Payload(value, limit)
+
+
+class Sampler:
+  """ Token buckets of 'sample-rate' lines per second, by key.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.buckets = {}
+
+  def reset(self):
+    with self.lock:
+      self.buckets.clear()
+
+  def take(self, key):
+    """ Returns None if a line for key must be suppressed, otherwise the number of lines suppressed since the
+    previous one.
+    """
+    rate = _settings["sample-rate"]
+    now = time.monotonic()
+    with self.lock:
+      tokens, last, suppressed = self.buckets.get(key, (rate, now, 0))
+      tokens = min(rate, tokens + (now - last) * rate)
+      if tokens < 1:
+        self.buckets[key] = (tokens, now, suppressed + 1)
+        return None
+      self.buckets[key] = (tokens - 1, now, 0)
+      return suppressed
+
+
+_sampler = Sampler()
+
+
+def sampled_debug(key, msg, *args, logger=None):
+  """ Logs a debug line unless more than 'sample-rate' lines per second have been logged for key.
+  """
+  logger = logger or logging.getLogger()
+  if not logger.isEnabledFor(logging.DEBUG):
+    return
+  suppressed = _sampler.take(key)
+  if suppressed is None:
+    metrics.inc_counter("scanoss_hook_log_sampled_out_total", labels={"key": key})
+    return
+  if suppressed:
+    msg += " (%d similar lines suppressed)"
+    args += (suppressed,)
+  logger.debug(msg, *args, stacklevel=2)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(stop)
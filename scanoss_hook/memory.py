@@ -0,0 +1,215 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Memory budget for the file contents held by the scan jobs.
+
+The contents fetched by the jobs are streamed into Blobs, which are kept in memory while they are smaller than
+'spill-threshold', the job holds less than its budget ('job-budget') and all the jobs together hold less than the
+global budget ('global-budget'). They are written to temporary files otherwise. The budgets are spill thresholds,
+not admission limits: jobs never wait for memory before they start fetching, and jobs holding no contents cost
+nothing. Blobs are fingerprinted without copying their contents, through a memoryview of the buffer or an mmap of
+the temporary file.
+
+The peak number of bytes held in memory by each job is added to its statistics (peak_memory_bytes) and to the
+scanoss_hook_job_peak_memory_bytes metric.
+
+Configuration example:
+
+memory:
+  global-budget: 1073741824
+  job-budget: 268435456
+  spill-threshold: 16777216
+  spill-dir: /var/tmp
+"""
+
+import contextlib
+import io
+import mmap
+import resource
+import tempfile
+import threading
+
+from scanoss_hook import jobs, metrics
+
+DEFAULT_GLOBAL_BUDGET = 1024 * 1024 * 1024
+DEFAULT_JOB_BUDGET = 256 * 1024 * 1024
+DEFAULT_SPILL_THRESHOLD = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+_settings = {"global-budget": DEFAULT_GLOBAL_BUDGET, "job-budget": DEFAULT_JOB_BUDGET,
+             "spill-threshold": DEFAULT_SPILL_THRESHOLD, "spill-dir": None}
+_cond = threading.Condition()
+# Bytes held in memory by all the jobs
+_held = 0
+# Bytes held in memory and their peak, by job ID (None for the work done outside of jobs)
+_usage = {}
+
+
+def configure(config):
+  """ Sets the budgets from the 'memory' configuration section.
+  """
+  if config:
+    for name in ("global-budget", "job-budget", "spill-threshold"):
+      if name in config:
+        _settings[name] = int(config[name])
+    _settings["spill-dir"] = config.get("spill-dir")
+
+
+def _job_key():
+  job = jobs.current_job()
+  return job.id if job is not None else None
+
+
+def _account(nbytes):
+  """ Accounts nbytes more held in memory by the current job. Returns False, without accounting them, if they
+  exceed the budget of the job or the global budget.
+  """
+  global _held
+  key = _job_key()
+  with _cond:
+    usage = _usage.setdefault(key, {"used": 0, "peak": 0})
+    if nbytes > 0 and (usage["used"] + nbytes > _settings["job-budget"] or
+                       _held + nbytes > _settings["global-budget"]):
+      return False
+    usage["used"] += nbytes
+    usage["peak"] = max(usage["peak"], usage["used"])
+    _held += nbytes
+    metrics.set_gauge("scanoss_hook_memory_held_bytes", _held)
+  return True
+
+
+def _release(key, nbytes):
+  global _held
+  with _cond:
+    usage = _usage.get(key)
+    if usage is not None:
+      released = min(usage["used"], nbytes)
+      usage["used"] -= released
+    else:
+      # The job has finished, its usage was already given back
+      released = 0
+    _held -= released
+    metrics.set_gauge("scanoss_hook_memory_held_bytes", _held)
+
+
+@contextlib.contextmanager
+def job_budget(job):
+  """ Tracks the memory held by a job in the enclosed block and records its peak. Memory is accounted on demand as
+  the job holds contents, nothing is reserved up front.
+  """
+  global _held
+  with _cond:
+    _usage[job.id] = {"used": 0, "peak": 0}
+  try:
+    yield
+  finally:
+    with _cond:
+      usage = _usage.pop(job.id, None) or {"used": 0, "peak": 0}
+      # Blobs the job did not close are no longer counted against the global budget
+      _held -= usage["used"]
+      metrics.set_gauge("scanoss_hook_memory_held_bytes", _held)
+    job.stats["peak_memory_bytes"] = usage["peak"]
+    metrics.observe("scanoss_hook_job_peak_memory_bytes", usage["peak"])
+    # ru_maxrss is in kilobytes on Linux
+    metrics.set_gauge("scanoss_hook_process_peak_rss_bytes", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def usage():
+  """ Returns the bytes held in memory by the current job and their peak.
+  """
+  with _cond:
+    return dict(_usage.get(_job_key()) or {"used": 0, "peak": 0})
+
+
+class Blob:
+  """
+  The contents of a file, held in memory or spilled to a temporary file.
+
+  Attributes
+  ----------
+  size : int
+    The number of bytes written.
+  spilled : bool
+    True if the contents are in a temporary file.
+  path : str
+    The path of the temporary file, None if the contents are in memory.
+  """
+
+  def __init__(self):
+    self.size = 0
+    self.spilled = False
+    self.path = None
+    self._job = _job_key()
+    self._buffer = io.BytesIO()
+    self._accounted = 0
+    self._file = None
+
+  def __len__(self):
+    return self.size
+
+  def _spill(self):
+    # A named file, so it can be mapped by the fingerprinting processes
+    self._file = tempfile.NamedTemporaryFile(dir=_settings["spill-dir"])
+    self.path = self._file.name
+    self._file.write(self._buffer.getbuffer())
+    self._buffer = None
+    _release(self._job, self._accounted)
+    self._accounted = 0
+    self.spilled = True
+    metrics.inc_counter("scanoss_hook_memory_spilled_total")
+
+  def write(self, chunk):
+    if not self.spilled:
+      if self.size + len(chunk) > _settings["spill-threshold"] or not _account(len(chunk)):
+        self._spill()
+      else:
+        self._accounted += len(chunk)
+    (self._file if self.spilled else self._buffer).write(chunk)
+    self.size += len(chunk)
+
+  @contextlib.contextmanager
+  def view(self):
+    """ Provides the contents as a memoryview of the buffer, or as a read only mmap of the temporary file if they
+    have been spilled. Nothing can be written to the blob while the view is in use.
+    """
+    if not self.spilled:
+      with self._buffer.getbuffer() as data:
+        yield data
+      return
+    self._file.flush()
+    if not self.size:
+      yield b''
+      return
+    with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      yield data
+
+  def getvalue(self):
+    with self.view() as data:
+      return bytes(data)
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+      self.path = None
+    _release(self._job, self._accounted)
+    self._accounted = 0
+    self._buffer = None
+
+  def __del__(self):
+    try:
+      self.close()
+    except Exception:
+      pass
+
+
+def from_bytes(data):
+  """ Returns a Blob with the given contents, spilled to a temporary file if they do not fit in the budget.
+  """
+  blob = Blob()
+  for start in range(0, len(data), CHUNK_SIZE):
+    blob.write(data[start:start + CHUNK_SIZE])
+  return blob
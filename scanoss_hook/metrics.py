@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Process wide metrics registry for the SCANOSS webhook.
+
+Metrics are identified by a name and an optional set of labels. Three kinds of metrics are supported:
+ - gauges: the last value set
+ - counters: monotonically increasing values
+ - summaries: count, sum and max of observed values
+
+The registry can be rendered in the Prometheus text exposition format, which is what the webhook
+serves on the /metrics endpoint.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_gauges = {}
+_counters = {}
+_summaries = {}
+
+
+def _key(name, labels):
+  return (name, tuple(sorted((labels or {}).items())))
+
+
+def set_gauge(name, value, labels=None):
+  """ Sets the value of a gauge.
+
+  Parameters
+  ----------
+  name : str
+    The name of the metric.
+  value : float
+    The new value of the gauge.
+  labels : dict
+    Optional labels identifying the time series.
+  """
+  with _lock:
+    _gauges[_key(name, labels)] = value
+
+
+def inc_counter(name, value=1, labels=None):
+  """ Increments a counter by the given value.
+  """
+  with _lock:
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, labels=None):
+  """ Records an observation (typically a duration in seconds) in a summary.
+  """
+  with _lock:
+    key = _key(name, labels)
+    count, total, maximum = _summaries.get(key, (0, 0.0, 0.0))
+    _summaries[key] = (count + 1, total + value, max(maximum, value))
+
+
+def get(name, labels=None):
+  """ Returns the current value of a gauge or counter, or None if it does not exist.
+  """
+  with _lock:
+    key = _key(name, labels)
+    if key in _gauges:
+      return _gauges[key]
+    return _counters.get(key)
+
+
+def snapshot():
+  """ Returns a dictionary with a copy of all the metrics in the registry.
+  """
+  with _lock:
+    return {"gauges": dict(_gauges), "counters": dict(_counters), "summaries": dict(_summaries)}
+
+
+def reset():
+  """ Removes all the metrics from the registry.
+  """
+  with _lock:
+    _gauges.clear()
+    _counters.clear()
+    _summaries.clear()
+
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+
+def render():
+  """ Renders the registry using the Prometheus text exposition format.
+  """
+  data = snapshot()
+  lines = []
+  for (name, labels), value in sorted(data["gauges"].items()):
+    lines.append("%s%s %s" % (name, _format_labels(labels), value))
+  for (name, labels), value in sorted(data["counters"].items()):
+    lines.append("%s%s %s" % (name, _format_labels(labels), value))
+  for (name, labels), (count, total, maximum) in sorted(data["summaries"].items()):
+    lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+    lines.append("%s_sum%s %f" % (name, _format_labels(labels), total))
+    lines.append("%s_max%s %f" % (name, _format_labels(labels), maximum))
+  return '\n'.join(lines) + '\n'
+
+
+def send_metrics(request_handler):
+  """ Writes the rendered metrics as the response of a BaseHTTPRequestHandler.
+  """
+  body = render().encode()
+  request_handler.send_response(200, "OK")
+  request_handler.send_header("Content-Type", "text/plain; version=0.0.4")
+  request_handler.send_header("Content-Length", str(len(body)))
+  request_handler.end_headers()
+  request_handler.wfile.write(body)
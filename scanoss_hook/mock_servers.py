@@ -0,0 +1,417 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Local mock GitHub, GitLab, Bitbucket and SCANOSS servers for load testing the webhook.
+
+A single MockServer serves the four APIs under different path prefixes. Point the webhook configuration to it:
+
+gitlab:
+  api-base: http://localhost:8899/gitlab/api/v4
+github:
+  api-base: http://localhost:8899/github
+scanoss:
+  url: http://localhost:8899/scanoss
+
+Bitbucket API URLs are taken from the webhook payloads, which must point to http://localhost:8899/bitbucket/2.0.
+
+Every commit of every repository has the same number of changed files ('files') of the same size ('file_size').
+Each request is delayed by 'latency' seconds. The SCANOSS mock reports a match for a 'match_ratio' fraction of the
+files. When 'rate_limit' is set, the responses advertise that hourly API rate limit, to exercise the rate limiter
+of the webhook. The SCANOSS mock accepts gzip (and zstd) compressed uploads unless 'compressed_uploads' is False,
+then it answers them with 415. Scan requests are delayed by 'scan_latency' more seconds, and a 'scan_error_rate'
+fraction of them (plus the first 'scan_errors') are answered with 503, to exercise the SCANOSS client of the webhook.
+The first 'src_errors' Bitbucket file fetches are answered with 503 and 'Retry-After: 0'.
+GET /_mock/stats returns the request counters and the number of completed scans, where a scan completes
+when the build status (or, for GitHub, the commit comment) is posted.
+"""
+
+import base64
+import collections
+import gzip
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+DIFF_PAGE_SIZE = 20
+# Blobs larger than this are returned truncated by the GraphQL mock
+GRAPHQL_TEXT_LIMIT = 512 * 1024
+SOURCE_LINE = "  result[%d] = compute_value(input_%d, %d) + offset_%d; /* %s */\n"
+
+
+def file_contents(path, sha, size):
+  """ Returns deterministic source-like contents of 'size' bytes for a file at a commit.
+  """
+  seed = int(hashlib.md5(("%s@%s" % (path, sha)).encode()).hexdigest()[:8], 16)
+  rnd = random.Random(seed)
+  out = []
+  total = 0
+  i = 0
+  while total < size:
+    line = SOURCE_LINE % (i, rnd.randint(0, 999), rnd.randint(0, 99999), i % 7, rnd.getrandbits(48))
+    out.append(line)
+    total += len(line)
+    i += 1
+  return ''.join(out).encode()[:size]
+
+
+class MockState:
+  """
+  The configuration and counters of a MockServer.
+  """
+
+  def __init__(self, files=20, file_size=4096, latency=0.0, match_ratio=0.0, rate_limit=None,
+               compressed_uploads=True, scan_latency=0.0, scan_error_rate=0.0, scan_errors=0, src_errors=0):
+    self.files = files
+    self.src_errors = src_errors
+    self.scan_latency = scan_latency
+    self.scan_error_rate = scan_error_rate
+    self.scan_errors = scan_errors
+    self.rate_limit = rate_limit
+    self.compressed_uploads = compressed_uploads
+    self.file_size = file_size
+    self.latency = latency
+    self.match_ratio = match_ratio
+    self.lock = threading.Lock()
+    self.requests = collections.Counter()
+    self.completed = 0
+    self.completions = []
+    self.blobs = {}
+
+  def count(self, name, value=1):
+    with self.lock:
+      self.requests[name] += value
+
+  def complete(self):
+    with self.lock:
+      self.completed += 1
+      self.completions.append(time.time())
+
+  def stats(self):
+    with self.lock:
+      return {"requests": dict(self.requests), "completed": self.completed,
+              "first_completion": self.completions[0] if self.completions else None,
+              "last_completion": self.completions[-1] if self.completions else None}
+
+  def blob(self, path, ref):
+    """ Returns the SHA of the blob of a file at a ref, and remembers it for the blob endpoints.
+    """
+    sha = hashlib.sha1(("%s@%s" % (path, ref)).encode()).hexdigest()
+    with self.lock:
+      self.blobs[sha] = (path, ref)
+    return sha
+
+  def paths(self):
+    return ["src/module_%d/file_%d.c" % (i % 10, i) for i in range(self.files)]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+  """Serves the mock APIs."""
+
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  @property
+  def state(self):
+    return self.server.state
+
+  def _base(self):
+    return "http://%s" % self.headers.get('Host')
+
+  def _send(self, status, body=b'', content_type="application/json", headers=None):
+    if not isinstance(body, bytes):
+      body = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    if self.state.rate_limit:
+      self.send_header("X-RateLimit-Limit", str(self.state.rate_limit))
+      self.send_header("X-RateLimit-Remaining", str(self.state.rate_limit - 1))
+      self.send_header("X-RateLimit-Reset", str(int(time.time()) + 3600))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    return self.rfile.read(length) if length else b''
+
+  def _route(self, method):
+    if self.state.latency:
+      time.sleep(self.state.latency)
+    url = parse.urlsplit(self.path)
+    query = parse.parse_qs(url.query)
+    path = parse.unquote(url.path)
+    body = self._body() if method == 'POST' else b''
+    for prefix, handler in (('/gitlab/api/v4/', self._gitlab), ('/github/', self._github),
+                            ('/bitbucket/2.0/', self._bitbucket), ('/scanoss/', self._scanoss)):
+      if path.startswith(prefix):
+        return handler(method, path[len(prefix):], query, body)
+    if path == '/_mock/stats':
+      return self._send(200, self.state.stats())
+    return self._send(404, {"message": "Not Found"})
+
+  def do_GET(self):
+    self._route('GET')
+
+  def do_POST(self):
+    self._route('POST')
+
+  # GitLab
+
+  def _gitlab(self, method, path, query, body):
+    m = re.match(r'projects/(\d+)/repository/commits/([^/]+)/diff$', path)
+    if m:
+      self.state.count("gitlab_diff")
+      page = int(query.get('page', ['1'])[0])
+      paths = self.state.paths()
+      pages = max(1, math.ceil(len(paths) / DIFF_PAGE_SIZE))
+      chunk = paths[(page - 1) * DIFF_PAGE_SIZE:page * DIFF_PAGE_SIZE]
+      diffs = [{"old_path": p, "new_path": p, "diff": "@@ -1 +1 @@\n+changed\n", "new_file": False,
+                "renamed_file": False, "deleted_file": False} for p in chunk]
+      return self._send(200, diffs, headers={"x-total-pages": str(pages)})
+    m = re.match(r'projects/(\d+)/repository/files/(.+?)(/raw)?$', path)
+    if m:
+      self.state.count("gitlab_file")
+      filename, ref = m.group(2), query.get('ref', [''])[0]
+      if filename not in self.state.paths():
+        return self._send(404, {"message": "404 File Not Found"})
+      contents = file_contents(filename, ref, self.state.file_size)
+      if m.group(3):
+        return self._send(200, contents, content_type="text/plain")
+      return self._send(200, {"file_name": filename, "file_path": filename, "size": len(contents),
+                              "encoding": "base64", "ref": ref, "content": base64.b64encode(contents).decode()})
+    if method == 'POST' and re.match(r'projects/\d+/repository/commits/[^/]+/comments$', path):
+      self.state.count("gitlab_comment")
+      return self._send(201, {"note": "ok"})
+    if method == 'POST' and re.match(r'projects/\d+/statuses/[^/]+$', path):
+      self.state.count("gitlab_status")
+      self.state.complete()
+      return self._send(201, {"status": "ok"})
+    return self._send(404, {"message": "404 Not Found"})
+
+  # Bitbucket
+
+  def _bitbucket(self, method, path, query, body):
+    m = re.match(r'repositories/([^/]+)/([^/]+)/(.*)$', path)
+    if not m:
+      return self._send(404, {"error": "Not Found"})
+    repo_url = "%s/bitbucket/2.0/repositories/%s/%s" % (self._base(), m.group(1), m.group(2))
+    rest = m.group(3)
+    m = re.match(r'diff/([^/]+)$', rest)
+    if m:
+      self.state.count("bitbucket_diff")
+      diff = ''.join("diff --git a/%s b/%s\n--- a/%s\n+++ b/%s\n@@ -1 +1 @@\n+changed\n" % (p, p, p, p)
+                     for p in self.state.paths())
+      return self._send(200, diff.encode(), content_type="text/plain")
+    m = re.match(r'diffstat/([^/]+)$', rest)
+    if m:
+      self.state.count("bitbucket_diffstat")
+      page = int(query.get('page', ['1'])[0])
+      paths = self.state.paths()
+      chunk = paths[(page - 1) * DIFF_PAGE_SIZE:page * DIFF_PAGE_SIZE]
+      data = {"values": [{"type": "diffstat", "status": "modified", "lines_added": 1, "lines_removed": 1,
+                          "old": {"path": p}, "new": {"path": p}} for p in chunk], "page": page}
+      if page * DIFF_PAGE_SIZE < len(paths):
+        data["next"] = "%s/%s?page=%d" % (repo_url, rest, page + 1)
+      return self._send(200, data)
+    m = re.match(r'src/([^/]+)/(.+)$', rest)
+    if m:
+      self.state.count("bitbucket_src")
+      with self.state.lock:
+        fail = self.state.src_errors > 0
+        self.state.src_errors = max(0, self.state.src_errors - 1)
+      if fail:
+        return self._send(503, {"error": "Service Unavailable"}, headers={"Retry-After": "0"})
+      if m.group(2) not in self.state.paths():
+        return self._send(404, {"error": "Not Found"})
+      return self._send(200, file_contents(m.group(2), m.group(1), self.state.file_size), content_type="text/plain")
+    if method == 'POST' and re.match(r'commit/[^/]+/comments$', rest):
+      self.state.count("bitbucket_comment")
+      return self._send(201, {"id": 1})
+    if method == 'POST' and re.match(r'commit/[^/]+/statuses/build$', rest):
+      self.state.count("bitbucket_status")
+      self.state.complete()
+      return self._send(201, {"state": "ok"})
+    return self._send(404, {"error": "Not Found"})
+
+  # GitHub
+
+  def _github_repo(self, owner, name):
+    base = self._base() + "/github"
+    return {"id": 1, "name": name, "full_name": "%s/%s" % (owner, name), "default_branch": "main",
+            "owner": {"login": owner, "type": "User", "url": "%s/users/%s" % (base, owner)},
+            "url": "%s/repos/%s/%s" % (base, owner, name)}
+
+  def _github_files(self, ref, query, data):
+    page = int(query.get('page', ['1'])[0])
+    per_page = int(query.get('per_page', ['300'])[0])
+    paths = self.state.paths()
+    data["files"] = [{"filename": p, "status": "modified", "patch": "@@ -1 +1 @@\n+changed",
+                      "sha": self.state.blob(p, ref)} for p in paths[(page - 1) * per_page:page * per_page]]
+    headers = {}
+    if page * per_page < len(paths):
+      headers["Link"] = '<%s%s?page=%d&per_page=%d>; rel="next"' % (self._base(), parse.urlsplit(self.path).path,
+                                                                    page + 1, per_page)
+    return self._send(200, data, headers=headers)
+
+  def _github_graphql(self, body):
+    self.state.count("github_graphql")
+    request = json.loads(body)
+    repository = {}
+    for alias, expression in re.findall(r'(\w+): object\(expression: ("(?:[^"\\]|\\.)*")\)', request["query"]):
+      ref, path = json.loads(expression).split(':', 1)
+      if path not in self.state.paths():
+        repository[alias] = None
+        continue
+      contents = file_contents(path, ref, self.state.file_size)
+      repository[alias] = {"oid": self.state.blob(path, ref), "isBinary": False, "byteSize": len(contents),
+                           "isTruncated": len(contents) > GRAPHQL_TEXT_LIMIT,
+                           "text": contents[:GRAPHQL_TEXT_LIMIT].decode()}
+    return self._send(200, {"data": {"repository": repository}})
+
+  def _github(self, method, path, query, body):
+    base = self._base() + "/github"
+    if method == 'POST' and path == 'graphql':
+      return self._github_graphql(body)
+    if path == 'rate_limit':
+      self.state.count("github_rate_limit")
+      limit = self.state.rate_limit or 1000000
+      core = {"limit": limit, "remaining": limit - 1, "reset": int(time.time()) + 3600, "used": 1}
+      return self._send(200, {"resources": {"core": core}, "rate": core})
+    m = re.match(r'(users|orgs)/([^/]+)$', path)
+    if m:
+      self.state.count("github_owner")
+      return self._send(200, {"login": m.group(2), "id": 1, "type": "User" if m.group(1) == "users" else
+                              "Organization", "url": "%s/%s/%s" % (base, m.group(1), m.group(2))})
+    m = re.match(r'repos/([^/]+)/([^/]+)(/.*)?$', path)
+    if not m:
+      return self._send(404, {"message": "Not Found"})
+    owner, name, rest = m.group(1), m.group(2), (m.group(3) or '')
+    repo_url = "%s/repos/%s/%s" % (base, owner, name)
+    if rest == '':
+      self.state.count("github_repo")
+      return self._send(200, self._github_repo(owner, name))
+    m = re.match(r'/commits/([^/]+)$', rest)
+    if m:
+      self.state.count("github_commit")
+      return self._github_files(m.group(1), query, {"sha": m.group(1), "url": "%s/commits/%s" % (repo_url, m.group(1))})
+    m = re.match(r'/compare/([^.]+)\.\.\.(.+)$', rest)
+    if m:
+      self.state.count("github_compare")
+      return self._github_files(m.group(2), query, {"base_commit": {"sha": m.group(1)}})
+    m = re.match(r'/git/blobs/([0-9a-f]+)$', rest)
+    if m:
+      self.state.count("github_blob")
+      if m.group(1) not in self.state.blobs:
+        return self._send(404, {"message": "Not Found"})
+      contents = file_contents(*self.state.blobs[m.group(1)], self.state.file_size)
+      if 'raw' in (self.headers.get('Accept') or ''):
+        return self._send(200, contents, content_type="application/vnd.github.raw")
+      return self._send(200, {"sha": m.group(1), "size": len(contents), "encoding": "base64",
+                              "content": base64.b64encode(contents).decode()})
+    m = re.match(r'/contents/(.+)$', rest)
+    if m:
+      self.state.count("github_contents")
+      filename, ref = m.group(1), query.get('ref', ['main'])[0]
+      if filename not in self.state.paths():
+        return self._send(404, {"message": "Not Found"})
+      contents = file_contents(filename, ref, self.state.file_size)
+      return self._send(200, {"type": "file", "encoding": "base64", "name": filename.rsplit('/', 1)[-1],
+                              "path": filename, "size": len(contents), "url": "%s/contents/%s" % (repo_url, filename),
+                              "content": base64.b64encode(contents).decode()})
+    m = re.match(r'/pulls/(\d+)(/commits)?$', rest)
+    if m:
+      self.state.count("github_pull")
+      number = int(m.group(1))
+      if m.group(2):
+        return self._send(200, [{"sha": hashlib.sha1(("pr%d" % number).encode()).hexdigest(),
+                                 "url": "%s/commits/pr%d" % (repo_url, number)}])
+      return self._send(200, {"number": number, "state": "open", "url": "%s/pulls/%d" % (repo_url, number),
+                              "issue_url": "%s/issues/%d" % (repo_url, number)})
+    if method == 'POST' and re.match(r'/commits/[^/]+/comments$', rest):
+      self.state.count("github_comment")
+      self.state.complete()
+      return self._send(201, {"id": 1, "body": "ok", "url": repo_url + "/comments/1"})
+    if method == 'POST' and re.match(r'/issues/\d+/comments$', rest):
+      self.state.count("github_issue_comment")
+      return self._send(201, {"id": 1, "body": "ok", "url": repo_url + "/issues/comments/1"})
+    return self._send(404, {"message": "Not Found"})
+
+  # SCANOSS
+
+  def _scanoss(self, method, path, query, body):
+    if method != 'POST' or path != 'api/scan/direct':
+      return self._send(404, {"error": "Not Found"})
+    if self.state.scan_latency:
+      time.sleep(self.state.scan_latency)
+    with self.state.lock:
+      fail = self.state.scan_errors > 0 or random.random() < self.state.scan_error_rate
+      self.state.scan_errors = max(0, self.state.scan_errors - 1)
+    if fail:
+      self.state.count("scanoss_error")
+      return self._send(503, {"error": "Service Unavailable"})
+    encoding = self.headers.get('Content-Encoding')
+    if encoding:
+      if not self.state.compressed_uploads or encoding not in ('gzip', 'zstd'):
+        return self._send(415, {"error": "Unsupported Content-Encoding"})
+      self.state.count("scanoss_scan_%s" % encoding)
+      if encoding == 'gzip':
+        body = gzip.decompress(body)
+      else:
+        import zstandard
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    self.state.count("scanoss_scan")
+    results = {}
+    for md5, index in re.findall(rb'file=([0-9a-f]{32}),\d+,(\S+)', body):
+      index = index.decode()
+      if int(md5[:8], 16) / float(0xffffffff) < self.state.match_ratio:
+        results[index] = [{"id": "file", "lines": "all", "oss_lines": "all", "matched": "100%", "vendor": "mock",
+                           "component": "mock-component", "version": "1.0.0",
+                           "purl": ["pkg:github/mock/mock-component"], "url": "https://github.com/mock/mock-component",
+                           "file_url": "https://github.com/mock/mock-component/blob/master/%s.c" % index,
+                           "licenses": [{"name": "MIT"}]}]
+      else:
+        results[index] = [{"id": "none"}]
+    self.state.count("scanoss_files", len(results))
+    return self._send(200, results)
+
+
+class MockServer(ThreadingHTTPServer):
+  """
+  A threaded HTTP server serving the mock APIs.
+
+  Attributes
+  ----------
+  state : MockState
+    The configuration and counters of the mocks.
+  url : str
+    The base URL of the server.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, addr='127.0.0.1', port=0, **options):
+    self.state = MockState(**options)
+    ThreadingHTTPServer.__init__(self, (addr, port), MockRequestHandler)
+
+  @property
+  def url(self):
+    return "http://%s:%d" % self.server_address[:2]
+
+  def start(self):
+    """ Serves the mocks in a background thread. Returns the server.
+    """
+    threading.Thread(target=self.serve_forever, name="mock-server", daemon=True).start()
+    return self
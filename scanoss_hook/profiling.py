@@ -0,0 +1,200 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+On-demand and automatic profiling of scan jobs.
+
+On demand: profiling is armed for the next N seconds or the next N jobs, with a POST to the /admin/profile endpoint
+or by sending SIGUSR2 to the process. Every job started while profiling is armed runs under cProfile and its stats
+are dumped to the profiles directory. cProfile can only profile one job at a time, so an armed job starting while
+another one is under cProfile is sampled by the stack sampler instead, and its samples are always saved.
+
+Automatic: when a wall time or CPU time threshold is configured, every job is sampled by a low overhead stack
+sampler. The samples of the jobs crossing a threshold are saved in the collapsed stack format used by flame
+graph tools.
+
+Every dump is tagged with the repository, the number of commits, the number of files and the bytes fingerprinted
+by the job, in a .json file next to the profile.
+
+Configuration example:
+
+profiling:
+  dir: /var/log/scanoss-hook-profiles
+  signal-seconds: 60
+  auto-wall: 30
+  auto-cpu: 20
+  sample-interval: 0.01
+"""
+
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from scanoss_hook import metrics
+
+DEFAULT_DIR = "/tmp/scanoss-hook-profiles"
+DEFAULT_SIGNAL_SECONDS = 60
+DEFAULT_SAMPLE_INTERVAL = 0.01
+
+_lock = threading.Lock()
+_settings = {"dir": DEFAULT_DIR, "signal-seconds": DEFAULT_SIGNAL_SECONDS, "auto-wall": None, "auto-cpu": None,
+             "sample-interval": DEFAULT_SAMPLE_INTERVAL}
+_armed = {"until": 0.0, "jobs": 0}
+# True while a job runs under cProfile
+_cprofile = {"active": False}
+_sampled = {}
+_sampler = None
+
+
+def configure(config):
+  """ Sets up profiling from the 'profiling' configuration section and installs the SIGUSR2 handler.
+  """
+  if config:
+    _settings.update({k: v for k, v in config.items() if k in _settings})
+  if hasattr(signal, 'SIGUSR2'):
+    signal.signal(signal.SIGUSR2, lambda signum, frame: arm(seconds=float(_settings["signal-seconds"])))
+
+
+def arm(seconds=None, jobs=None):
+  """ Profiles the jobs started in the next 'seconds' seconds and/or the next 'jobs' jobs.
+  """
+  with _lock:
+    if seconds:
+      _armed["until"] = max(_armed["until"], time.monotonic() + seconds)
+    if jobs:
+      _armed["jobs"] += jobs
+  logging.info("Profiling armed for %s seconds and %s jobs", seconds or 0, jobs or 0)
+
+
+def status():
+  """ Returns a dictionary with the current profiling state.
+  """
+  with _lock:
+    return {"seconds": max(0.0, _armed["until"] - time.monotonic()), "jobs": _armed["jobs"],
+            "auto-wall": _settings["auto-wall"], "auto-cpu": _settings["auto-cpu"], "dir": _settings["dir"]}
+
+
+def _take_armed():
+  """ Returns how to profile a job starting now: 'cprofile', 'sample' if profiling is armed but another job is under
+  cProfile, None if profiling is not armed.
+  """
+  with _lock:
+    if _armed["jobs"] > 0:
+      _armed["jobs"] -= 1
+    elif time.monotonic() >= _armed["until"]:
+      return None
+    if _cprofile["active"]:
+      return "sample"
+    _cprofile["active"] = True
+    return "cprofile"
+
+
+def _release_cprofile():
+  with _lock:
+    _cprofile["active"] = False
+
+
+def _enable(profiler):
+  """ Enables a cProfile profiler. Returns False, after logging why, if it cannot be enabled (e.g. another profiler
+  is active in the interpreter).
+  """
+  try:
+    profiler.enable()
+  except ValueError as e:
+    logging.warning("Cannot start cProfile, sampling the job instead: %s", e)
+    _release_cprofile()
+    return False
+  return True
+
+
+def _auto_enabled():
+  return bool(_settings["auto-wall"] or _settings["auto-cpu"])
+
+
+def _sample_loop():
+  while True:
+    time.sleep(float(_settings["sample-interval"]))
+    frames = sys._current_frames()
+    with _lock:
+      for thread_id, counter in _sampled.items():
+        frame = frames.get(thread_id)
+        stack = []
+        while frame is not None:
+          code = frame.f_code
+          stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+          frame = frame.f_back
+        if stack:
+          counter[';'.join(reversed(stack))] += 1
+
+
+def _start_sampler():
+  global _sampler
+  with _lock:
+    if _sampler is None or not _sampler.is_alive():
+      _sampler = threading.Thread(target=_sample_loop, name="profile-sampler", daemon=True)
+      _sampler.start()
+
+
+def _dump(job, kind, write, wall, cpu):
+  directory = _settings["dir"]
+  os.makedirs(directory, exist_ok=True)
+  base = os.path.join(directory, "%s-%d-%d-%s" % (time.strftime("%Y%m%d%H%M%S"), os.getpid(), job.id, kind))
+  write(base)
+  tags = {"repo": job.key, "job": job.id, "commits": job.cost, "wall_seconds": wall, "cpu_seconds": cpu}
+  tags.update(job.stats)
+  with open(base + ".json", "w") as f:
+    json.dump(tags, f)
+  logging.info("Saved %s profile of job %d for %s in %s", kind, job.id, job.key, base)
+  metrics.inc_counter("scanoss_hook_profiles_total", labels={"kind": kind})
+
+
+@contextlib.contextmanager
+def profile_job(job):
+  """ Profiles the job running in the enclosed block if profiling is armed or automatic profiling is enabled.
+  """
+  armed = _take_armed()
+  profiler = cProfile.Profile() if armed == "cprofile" else None
+  if profiler is not None and not _enable(profiler):
+    profiler = None
+    armed = "sample"
+  counter = None
+  if profiler is None and (armed or _auto_enabled()):
+    _start_sampler()
+    counter = collections.Counter()
+    with _lock:
+      _sampled[threading.get_ident()] = counter
+  start_wall = time.monotonic()
+  start_cpu = time.thread_time()
+  try:
+    yield
+  finally:
+    if profiler is not None:
+      profiler.disable()
+      _release_cprofile()
+    wall = time.monotonic() - start_wall
+    cpu = time.thread_time() - start_cpu
+    if counter is not None:
+      with _lock:
+        _sampled.pop(threading.get_ident(), None)
+    slow = ((_settings["auto-wall"] and wall >= float(_settings["auto-wall"])) or
+            (_settings["auto-cpu"] and cpu >= float(_settings["auto-cpu"])))
+    try:
+      if profiler is not None:
+        _dump(job, "cprofile", lambda base: profiler.dump_stats(base + ".prof"), wall, cpu)
+      elif counter is not None and (armed or slow):
+        def write_collapsed(base):
+          with open(base + ".folded", "w") as f:
+            for stack, count in counter.most_common():
+              f.write("%s %d\n" % (stack, count))
+        _dump(job, "sampled" if armed else "slow", write_collapsed, wall, cpu)
+    except OSError as e:
+      logging.error("Cannot save the profile of job %d: %s", job.id, e)
@@ -0,0 +1,244 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Rate limit aware request scheduling for the git host APIs.
+
+Every (host, token) pair gets its own RateLimiter: a token bucket that is refilled at a configurable rate.
+When the API returns rate limit headers (X-RateLimit-Remaining/X-RateLimit-Reset for GitHub, RateLimit-Remaining/
+RateLimit-Reset for GitLab) the refill rate is adjusted so the remaining budget is spread until the reset time.
+A 429 response (Bitbucket does not send rate limit headers) blocks the bucket until the Retry-After time.
+
+Callers acquire a token with a priority. Lower priority requests (comments, asset lookups) always yield to
+waiting higher priority requests (file fetches) and never consume the last tokens of the bucket.
+
+The buckets live in process memory. When the webhook runs several worker processes (see server.serve_prefork),
+set_processes() gives each process an equal share of the configured rate and burst and of the remaining budget
+reported by the API, so all the workers together stay within the limits of a token.
+"""
+
+import hashlib
+import threading
+import time
+
+from scanoss_hook import metrics
+
+# Priorities, lower values are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Defaults, can be overridden with the 'ratelimit' section of the configuration file
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+DEFAULT_LOW_RESERVE = 0.2
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+
+_HEADERS_REMAINING = ('X-RateLimit-Remaining', 'RateLimit-Remaining')
+_HEADERS_LIMIT = ('X-RateLimit-Limit', 'RateLimit-Limit')
+_HEADERS_RESET = ('X-RateLimit-Reset', 'RateLimit-Reset')
+
+_settings = {"rate": DEFAULT_RATE, "burst": DEFAULT_BURST, "low-reserve": DEFAULT_LOW_RESERVE}
+# The number of processes sharing the rate limits of every token
+_processes = {"count": 1}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def configure(config):
+  """ Sets the defaults for new rate limiters from the 'ratelimit' configuration section.
+
+  Parameters
+  ----------
+  config : dict
+    The 'ratelimit' section of the configuration file, may be None.
+  """
+  if config:
+    for key in _settings:
+      if key in config:
+        _settings[key] = float(config[key])
+
+
+def set_processes(count):
+  """ Splits the rate limits of every token between 'count' processes, e.g. the pre-forked workers. Only the rate
+  limiters created afterwards are affected.
+  """
+  _processes["count"] = max(1, int(count))
+
+
+def token_id(token):
+  """ Returns a short, non reversible identifier for an API token, suitable for metric labels.
+  """
+  if not token:
+    return 'anonymous'
+  return hashlib.sha1(str(token).encode()).hexdigest()[:8]
+
+
+def get_limiter(host, token):
+  """ Returns the shared RateLimiter for the given host and API token, creating it if needed.
+  """
+  key = (host, token_id(token))
+  with _limiters_lock:
+    limiter = _limiters.get(key)
+    if limiter is None:
+      limiter = RateLimiter(host, key[1], rate=_settings["rate"], burst=_settings["burst"],
+                            low_reserve=_settings["low-reserve"], share=1.0 / _processes["count"])
+      _limiters[key] = limiter
+    return limiter
+
+
+def _header(headers, names):
+  for name in names:
+    value = headers.get(name)
+    if value is not None:
+      try:
+        return float(value)
+      except ValueError:
+        return None
+  return None
+
+
+class RateLimiter:
+  """
+  A token bucket for a single git host API token.
+
+  Attributes
+  ----------
+  host : str
+    The API host.
+  rate : float
+    The number of requests per second the bucket is refilled with.
+  burst : float
+    The capacity of the bucket.
+  remaining : float
+    The remaining budget reported by the API, None if unknown.
+  share : float
+    The fraction of the rate limits of the token used by this process.
+
+  Methods
+  -------
+  acquire(priority)
+    Blocks until a request with the given priority can be performed.
+
+  update(status_code, headers)
+    Learns the remaining budget from the headers of an API response.
+  """
+
+  def __init__(self, host, token_label, rate=DEFAULT_RATE, burst=DEFAULT_BURST, low_reserve=DEFAULT_LOW_RESERVE,
+               share=1.0):
+    self.host = host
+    self.labels = {"host": host, "token": token_label}
+    self.share = share
+    self.base_rate = rate * share
+    self.rate = self.base_rate
+    self.burst = max(1.0, burst * share)
+    self.low_reserve = low_reserve
+    self.tokens = float(self.burst)
+    self.remaining = None
+    self.reset_at = None
+    self.blocked_until = 0.0
+    self.backoff = DEFAULT_BACKOFF
+    self.last_refill = time.monotonic()
+    self.waiting = {}
+    self.cond = threading.Condition()
+    self._publish()
+
+  def _refill(self, now):
+    elapsed = now - self.last_refill
+    self.last_refill = now
+    if self.reset_at is not None and time.time() >= self.reset_at:
+      # The API window has been reset, go back to the configured rate until we learn the new budget
+      self.reset_at = None
+      self.remaining = None
+      self.rate = self.base_rate
+    self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+  def _can_proceed(self, priority, now):
+    if now < self.blocked_until or self.tokens < 1:
+      return False
+    if any(count for p, count in self.waiting.items() if p < priority):
+      return False
+    if priority >= PRIORITY_LOW and self.tokens < 1 + self.burst * self.low_reserve:
+      return False
+    return True
+
+  def _wait_time(self, now):
+    if now < self.blocked_until:
+      return self.blocked_until - now
+    if self.rate <= 0:
+      return 1.0
+    return max(0.01, (1 - self.tokens % 1) / self.rate)
+
+  def acquire(self, priority=PRIORITY_NORMAL):
+    """ Blocks until a request with the given priority can be performed and consumes a token.
+    Returns the time waited in seconds.
+    """
+    start = time.monotonic()
+    with self.cond:
+      self.waiting[priority] = self.waiting.get(priority, 0) + 1
+      try:
+        while True:
+          now = time.monotonic()
+          self._refill(now)
+          if self._can_proceed(priority, now):
+            self.tokens -= 1
+            if self.remaining is not None:
+              self.remaining = max(0, self.remaining - 1)
+            break
+          self.cond.wait(self._wait_time(now))
+      finally:
+        self.waiting[priority] -= 1
+        self.cond.notify_all()
+      self._publish()
+    waited = time.monotonic() - start
+    metrics.observe("scanoss_hook_ratelimit_wait_seconds", waited, dict(self.labels, priority=priority))
+    return waited
+
+  def update(self, status_code, headers):
+    """ Updates the bucket using the status code and headers of an API response.
+    """
+    remaining = _header(headers, _HEADERS_REMAINING)
+    reset = _header(headers, _HEADERS_RESET)
+    limit = _header(headers, _HEADERS_LIMIT)
+    with self.cond:
+      now = time.monotonic()
+      self._refill(now)
+      if status_code == 429:
+        retry_after = _header(headers, ('Retry-After',))
+        if retry_after is None and reset is not None:
+          retry_after = self._seconds_until(reset)
+        delay = retry_after if retry_after is not None else self.backoff
+        self.backoff = min(MAX_BACKOFF, self.backoff * 2)
+        self.blocked_until = now + delay
+        self.tokens = 0
+        metrics.inc_counter("scanoss_hook_ratelimit_throttled_total", labels=self.labels)
+      else:
+        self.backoff = DEFAULT_BACKOFF
+      if remaining is not None:
+        self.remaining = remaining
+        if limit is not None:
+          metrics.set_gauge("scanoss_hook_ratelimit_limit", limit, self.labels)
+        if reset is not None:
+          window = self._seconds_until(reset)
+          self.reset_at = time.time() + window
+          # Spread this process' share of what is left of the budget evenly until the reset
+          self.rate = min(self.base_rate, remaining * self.share / max(window, 1.0))
+          self.tokens = min(self.tokens, remaining * self.share)
+      self._publish()
+      self.cond.notify_all()
+
+  @staticmethod
+  def _seconds_until(reset):
+    # GitHub and GitLab send epoch timestamps, others may send a delta in seconds.
+    if reset > 1e9:
+      return max(0.0, reset - time.time())
+    return max(0.0, reset)
+
+  def _publish(self):
+    metrics.set_gauge("scanoss_hook_ratelimit_tokens", round(self.tokens, 2), self.labels)
+    metrics.set_gauge("scanoss_hook_ratelimit_rate", round(self.rate, 4), self.labels)
+    if self.remaining is not None:
+      metrics.set_gauge("scanoss_hook_ratelimit_remaining", self.remaining, self.labels)
@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Persistent store of the scan results.
+
+Every scan of a commit (or range of commits) is recorded in a SQLite database with the MD5 of the scanned files,
+the assets declared by the repository and the results returned by the SCANOSS API, indexed by repository, commit,
+file MD5 and matched purl. The /admin/results endpoints (see scanoss_hook.admin) serve them without contacting the
+git host or the SCANOSS API.
+
+A commit scanned several times keeps all its scans, the latest one is returned.
+
+Configuration example:
+
+results-store:
+  path: /var/lib/scanoss-hook/results.db
+"""
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+from scanoss_hook import metrics
+
+SCHEMA = """
+  PRAGMA journal_mode=WAL;
+  CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY AUTOINCREMENT, provider TEXT NOT NULL, repo TEXT NOT NULL,
+                                    commit_sha TEXT NOT NULL, base_sha TEXT, scanned_at REAL NOT NULL, assets TEXT,
+                                    results TEXT NOT NULL);
+  CREATE INDEX IF NOT EXISTS scans_commit ON scans (repo, commit_sha, id);
+  CREATE INDEX IF NOT EXISTS scans_sha ON scans (commit_sha);
+  CREATE TABLE IF NOT EXISTS files (scan_id INTEGER NOT NULL, path TEXT NOT NULL, md5 TEXT NOT NULL);
+  CREATE INDEX IF NOT EXISTS files_scan ON files (scan_id);
+  CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+  CREATE TABLE IF NOT EXISTS matches (scan_id INTEGER NOT NULL, path TEXT NOT NULL, purl TEXT NOT NULL, version TEXT);
+  CREATE INDEX IF NOT EXISTS matches_purl ON matches (purl, version);
+"""
+
+# Where scan results come from: the provider ('gitlab', 'github' or 'bitbucket'), the repository (its full name),
+# the commit and, for a range of commits, the base commit
+Source = collections.namedtuple('Source', ['provider', 'repo', 'commit', 'base'], defaults=[None])
+
+_store = None
+
+
+class ResultsStore:
+  """
+  Scan results stored in a SQLite database.
+
+  Attributes
+  ----------
+  path : str
+    The path of the database file.
+
+  Methods
+  -------
+  record(source, files, assets, results)
+    Stores the results of a scan.
+
+  get_commit(repo, commit)
+    Returns the latest scan of a commit.
+
+  find_purl(purl, version=None, repo=None)
+    Returns the files of the commits that matched a purl.
+
+  find_md5(md5)
+    Returns the commits where files with the given contents were scanned.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.local = threading.local()
+    self._conn().executescript(SCHEMA)
+
+  def _conn(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+      self.local.conn = conn
+    return conn
+
+  def record(self, source, files, assets, results):
+    """ Stores the results of a scan. Returns the ID of the scan.
+
+    Parameters
+    ----------
+    source : Source
+      The repository and commit scanned.
+    files : dict
+      The MD5 of the scanned files by path.
+    assets : str
+      The assets (SBOM) declared by the repository, if any.
+    results : dict
+      The results returned by the SCANOSS API by path.
+    """
+    if isinstance(assets, bytes):
+      assets = assets.decode('utf-8', 'replace')
+    conn = self._conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      cursor = conn.execute(
+          "INSERT INTO scans (provider, repo, commit_sha, base_sha, scanned_at, assets, results) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+          (source.provider, source.repo, source.commit, source.base, time.time(), assets or None, json.dumps(results)))
+      scan_id = cursor.lastrowid
+      conn.executemany("INSERT INTO files (scan_id, path, md5) VALUES (?, ?, ?)",
+                       [(scan_id, path, md5) for path, md5 in files.items()])
+      conn.executemany("INSERT INTO matches (scan_id, path, purl, version) VALUES (?, ?, ?, ?)",
+                       [(scan_id, path, purl, match.get('version'))
+                        for path, path_matches in results.items() for match in path_matches
+                        if match.get('id') != 'none' for purl in match.get('purl') or []])
+      conn.execute("COMMIT")
+    except Exception:
+      conn.execute("ROLLBACK")
+      raise
+    metrics.inc_counter("scanoss_hook_results_stored_total", labels={"provider": source.provider})
+    return scan_id
+
+  def get_commit(self, repo, commit):
+    """ Returns the latest scan of a commit as a dictionary, None if it has not been scanned.
+    """
+    conn = self._conn()
+    row = conn.execute("SELECT id, provider, repo, commit_sha, base_sha, scanned_at, assets, results FROM scans "
+                       "WHERE repo = ? AND commit_sha = ? ORDER BY id DESC LIMIT 1", (repo, commit)).fetchone()
+    if row is None:
+      return None
+    files = dict(conn.execute("SELECT path, md5 FROM files WHERE scan_id = ?", (row[0],)).fetchall())
+    return {"id": row[0], "provider": row[1], "repo": row[2], "commit": row[3], "base": row[4], "scanned_at": row[5],
+            "assets": row[6], "files": files, "results": json.loads(row[7])}
+
+  def find_purl(self, purl, version=None, repo=None):
+    """ Returns the matches of a purl (and version) in the latest scan of each commit, newest first.
+    """
+    query = ("SELECT s.provider, s.repo, s.commit_sha, s.scanned_at, m.path, m.version FROM matches m "
+             "JOIN scans s ON s.id = m.scan_id WHERE m.purl = ? "
+             "AND s.id = (SELECT MAX(id) FROM scans WHERE repo = s.repo AND commit_sha = s.commit_sha)")
+    params = [purl]
+    if version:
+      query += " AND m.version = ?"
+      params.append(version)
+    if repo:
+      query += " AND s.repo = ?"
+      params.append(repo)
+    query += " ORDER BY s.id DESC, m.path"
+    return [{"provider": r[0], "repo": r[1], "commit": r[2], "scanned_at": r[3], "path": r[4], "version": r[5]}
+            for r in self._conn().execute(query, params).fetchall()]
+
+  def find_md5(self, md5):
+    """ Returns the commits where a file with the given MD5 was scanned, newest first.
+    """
+    query = ("SELECT s.provider, s.repo, s.commit_sha, s.scanned_at, f.path FROM files f "
+             "JOIN scans s ON s.id = f.scan_id WHERE f.md5 = ? ORDER BY s.id DESC, f.path")
+    return [{"provider": r[0], "repo": r[1], "commit": r[2], "scanned_at": r[3], "path": r[4]}
+            for r in self._conn().execute(query, (md5,)).fetchall()]
+
+
+def configure(config):
+  """ Opens the results store from the 'results-store' configuration section. Without it, results are not stored.
+  """
+  global _store
+  _store = ResultsStore(config['path']) if config and config.get('path') else None
+
+
+def get_store():
+  """ Returns the ResultsStore, None if it is not configured.
+  """
+  return _store
@@ -0,0 +1,103 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Single port, multi-provider routing for the SCANOSS webhook.
+
+In routed mode one server handles the GitLab, GitHub and Bitbucket webhooks. The provider is selected by the
+request path (/gitlab, /github, /bitbucket) or, for any other path, detected from the event header sent by the
+git host. All the providers share the process wide resources: API connection pools, rate limiters, fingerprint
+and result caches, the job scheduler and the metrics registry.
+"""
+
+import logging
+from http.server import BaseHTTPRequestHandler
+from typing import Any
+
+from scanoss_hook import admin, metrics
+from scanoss_hook.bitbucket import BB_HEADER_EVENT, BitbucketRequestHandler
+from scanoss_hook.github import GH_HEADER_EVENT, GitHubRequestHandler
+from scanoss_hook.gitlab import GL_HEADER_EVENT, GitLabRequestHandler
+
+PROVIDERS = {
+    'gitlab': (GitLabRequestHandler, GL_HEADER_EVENT),
+    'github': (GitHubRequestHandler, GH_HEADER_EVENT),
+    'bitbucket': (BitbucketRequestHandler, BB_HEADER_EVENT),
+}
+
+
+def make_handler(provider, config, logger: logging):
+  """ Returns a configured provider handler that is not bound to any request, None if it cannot be configured.
+  It is used to run jobs for requests received by another handler or another node.
+  """
+  handler_class = PROVIDERS[provider][0]
+  # The handler is not initialised as a BaseHTTPRequestHandler, so it does not try to handle a request
+  handler = handler_class.__new__(handler_class)
+  if provider == 'github':
+    configured = handler.configure(config, logger)
+  else:
+    configured = handler.configure(config)
+  return handler if configured else None
+
+
+class RoutingRequestHandler(BaseHTTPRequestHandler):
+  """A request handler that dispatches each webhook to the handler of its git host.
+
+  Attributes
+  ----------
+  config : dict
+    The configuration dictionary, with a section for each enabled provider.
+  logger : logging.Logger
+    The logger passed to the GitHub handler.
+  """
+
+  def __init__(self, config, logger: logging, *args: Any) -> None:
+    self.config = config
+    self.logger = logger
+    BaseHTTPRequestHandler.__init__(self, *args)
+
+  def detect_provider(self):
+    """ Returns the provider for the request, from its path or its event header. None if unknown.
+    """
+    name = self.path.split('?', 1)[0].strip('/').split('/', 1)[0]
+    if name in PROVIDERS:
+      return name
+    for provider, (_, event_header) in PROVIDERS.items():
+      if self.headers.get(event_header) is not None:
+        return provider
+    return None
+
+  def _delegate(self):
+    provider = self.detect_provider()
+    if provider is None or provider not in self.config:
+      logging.warning("No webhook provider for request %s", self.path)
+      self.send_response(404, "Not Found")
+      self.end_headers()
+      return None
+    delegate = make_handler(provider, self.config, self.logger)
+    if delegate is None:
+      self.send_response(500, "Provider not configured")
+      self.end_headers()
+      return None
+    # The provider handler takes over this request's connection state
+    delegate.__dict__.update(self.__dict__)
+    metrics.inc_counter("scanoss_hook_webhooks_total", labels={"provider": provider})
+    return delegate
+
+  def do_GET(self):
+    if admin.handle_get(self):
+      return
+    delegate = self._delegate()
+    if delegate is not None:
+      delegate.do_GET()
+      self.close_connection = delegate.close_connection
+
+  def do_POST(self):
+    if admin.handle_post(self):
+      return
+    delegate = self._delegate()
+    if delegate is not None:
+      delegate.do_POST()
+      self.close_connection = delegate.close_connection
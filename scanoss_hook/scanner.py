@@ -3,13 +3,60 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import hashlib
 import json
 from json.decoder import JSONDecodeError
 import logging
-import requests
 import uuid
+from urllib import parse
 
-from .winnowing import wfp_for_file
+from . import cache, compression, fingerprinting, jobs, logs, memory, results_store, scanoss_client, tracing
+from .winnowing import Fingerprint
+
+
+class WFPUpload:
+  """
+  A multipart/form-data request body with the WFP of a list of fingerprints.
+
+  The WFP text is serialized one file at a time while the body is sent, so it is never held in memory in full.
+  The length of the body is computed beforehand, so it is sent with a Content-Length header.
+
+  Attributes
+  ----------
+  fingerprints : list
+    (index, Fingerprint) tuples, the files are named after their index in the WFP.
+  content_type : str
+    The Content-Type header of the body.
+  """
+
+  def __init__(self, fingerprints, data=None):
+    self.fingerprints = fingerprints
+    boundary = uuid.uuid4().hex
+    self.content_type = "multipart/form-data; boundary=%s" % boundary
+    head = b''
+    for name, value in (data or {}).items():
+      if not isinstance(value, (str, bytes)):
+        value = json.dumps(value)
+      if isinstance(value, str):
+        value = value.encode()
+      head += b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+          boundary.encode(), name.encode(), value)
+    head += b'--%s\r\nContent-Disposition: form-data; name="file"; filename="%s.wfp"\r\n\r\n' % (
+        boundary.encode(), uuid.uuid1().hex.encode())
+    self.head = head
+    self.tail = b'\r\n--%s--\r\n' % boundary.encode()
+
+  def __len__(self):
+    return len(self.head) + self.wfp_size() + len(self.tail)
+
+  def wfp_size(self):
+    return sum(fp.wfp_size(index) for index, fp in self.fingerprints)
+
+  def __iter__(self):
+    yield self.head
+    for index, fp in self.fingerprints:
+      yield fp.to_wfp(index).encode()
+    yield self.tail
 
 
 class Scanner:
@@ -26,60 +73,152 @@ class Scanner:
     The full URL used to request scans
   token : str
     The SCANOSS API Key used to authenticate
+  compression : str
+    The encoding of the WFP uploads ('gzip' or 'zstd'), None to send them uncompressed
+  client : scanoss_client.ScanossClient
+    The client shared by the scans sent to scan_url
 
 
   Methods
   -------
-  scan_files(files, asset_json)
+  scan_files(files, asset_json, source=None)
     Performs a scan of the files using the SCANOSS API.
 
   format_scan_results(scan_results)
     Formats the scan results as a markdown comment.
+
+  format_sbom_comment(result, asset_json, sbom_file)
+    Appends the CycloneDX components missing from the SBOM to a formatted comment.
+
+  scan_files raises scanoss_client.ScanossUnavailable when the SCANOSS API is unavailable, which parks the job
+  performing the scan.
   """
 
   def __init__(self, config):
     self.url = config['scanoss']['url']
     self.scan_url = "%s/api/scan/direct" % self.url
     self.token = config['scanoss']['token']
+    self.client = scanoss_client.get_client(self.scan_url, config['scanoss'].get('client'))
+    self.compression = config['scanoss'].get('compression')
+    if self.compression in (None, 'none'):
+      self.compression = None
+    elif not compression.available(self.compression):
+      logging.warning("Unsupported WFP upload compression %s, uploading uncompressed", self.compression)
+      self.compression = None
     self.badge_ok_url = "%s/static/badge-scanoss-ok.svg" % self.url
     self.badge_failed_url = "%s/static/badge-scanoss-failed.svg" % self.url
     self.comment_verified_ok = "![Asset Verification Successful](%s)" % self.badge_ok_url
     self.comment_verified_failed = "![Asset Verification Failed](%s)" % self.badge_failed_url
 
-  def scan_files(self, files, asset_json):
-    """ Performs a scan of the files given
+  def scan_files(self, files, asset_json, source=None):
+    """ Performs a scan of the files given, a dictionary of file names and their contents (bytes or memory.Blob)
+    or, if they have been fingerprinted while downloaded, their winnowing.Fingerprint.
 
+    The results are recorded in the results store, if configured, for the repository and commit given as source
+    (a results_store.Source).
     """
     if not files:
       logging.debug("No files found and no scan performed")
       return None
-    wfp = ''
     # This is a dictionary that is used to perform a lookup of a file name using the corresponding file index
     files_conversion = {}
+    fingerprints = []
     # We assign a number to each of the files. This avoids sending the file names to SCANOSS API,
     # hiding the names and the structure of the project from SCANOSS API.
     files_index = 0
-    for file, contents in files.items():
-      files_index += 1
-      files_conversion[str(files_index)] = file
-      wfp += wfp_for_file(files_index, contents)
-
-    headers = {'X-Session': self.token}
-    scan_files = {
-        'file': ("%s.wfp" % uuid.uuid1().hex, wfp)}
-
-    data = {"assets": asset_json} if asset_json else {}
-    logging.debug(wfp)
-    r = requests.post(self.scan_url, files=scan_files,
-                      data=data, headers=headers)
+    with jobs.stage("fingerprint"), tracing.span("fingerprint", files=len(files)) as span:
+      for file, contents in files.items():
+        jobs.check_cancelled()
+        files_index += 1
+        files_conversion[str(files_index)] = file
+        if isinstance(contents, Fingerprint):
+          cache.fingerprints.put(contents.md5, contents)
+          fingerprints.append((files_index, contents))
+        else:
+          fingerprints.append((files_index, self.fingerprint_for_contents(contents)))
+      fingerprinted = sum(fp.length for _, fp in fingerprints)
+      span.set(bytes=fingerprinted, hashes=sum(len(fp) for _, fp in fingerprints))
+      jobs.add_stats(files=len(files), bytes_fingerprinted=fingerprinted)
+
+    # The WFP is determined by the contents and index of each file, so the same files with the same assets always
+    # produce the same results
+    digest = hashlib.sha1()
+    for index, fp in fingerprints:
+      digest.update(('%s,%d,%d\n' % (fp.md5, fp.length, index)).encode())
+    digest.update(str(asset_json or '').encode())
+    results_key = digest.hexdigest()
+    json_resp = cache.results.get(results_key)
+    if json_resp is not None:
+      logging.debug("Using cached scan results")
+      return self.store_results(source, files_conversion, fingerprints, asset_json, json_resp)
+
+    upload = WFPUpload(fingerprints, {"assets": asset_json} if asset_json else None)
+    jobs.check_cancelled()
+    with jobs.stage("scan"), tracing.span("scan", url=self.scan_url) as span:
+      span.set(wfp_bytes=upload.wfp_size())
+      r = self.post_upload(upload)
+      span.set(status=r.status_code)
     if r.status_code >= 400:
+      logging.error("The SCANOSS API rejected the scan with status %d", r.status_code)
       return None
     try:
       json_resp = r.json()
     except JSONDecodeError:
       logging.error("The SCANOSS API returned an invalid JSON")
       return None
-    return {files_conversion[k]: v for (k, v) in json_resp.items()}
+    cache.results.put(results_key, json_resp)
+    return self.store_results(source, files_conversion, fingerprints, asset_json, json_resp)
+
+  @staticmethod
+  def store_results(source, files_conversion, fingerprints, asset_json, json_resp):
+    """ Returns the results of a scan by file name, after recording them in the results store.
+    """
+    results = {files_conversion[k]: v for (k, v) in json_resp.items()}
+    store = results_store.get_store()
+    if store is not None and source is not None:
+      md5s = {files_conversion[str(index)]: fp.md5 for index, fp in fingerprints}
+      try:
+        store.record(source, md5s, asset_json, results)
+      except Exception:
+        logging.exception("Could not store the results of %s@%s", source.repo, source.commit)
+    return results
+
+  def post_upload(self, upload):
+    """ Posts a WFP upload to the scan endpoint, compressed if the endpoint accepts it, within the deadline of the
+    current job.
+    """
+    host = parse.urlsplit(self.scan_url).netloc
+    headers = {'X-Session': self.token, 'Content-Type': upload.content_type}
+    encoding = self.compression
+    if encoding and compression.accepts(self.scan_url, encoding):
+      with compression.compress(upload, encoding) as body:
+        r = self.client.post(body, dict(headers, **{'Content-Encoding': encoding}), jobs.deadline())
+      if not compression.rejected(r, encoding):
+        compression.record(host, "out", len(body), len(upload))
+        compression.record_response(host, r)
+        return r
+      logging.warning("%s rejected a %s compressed upload, uploading uncompressed for %d seconds", self.scan_url,
+                      encoding, compression.REJECTION_TTL)
+      compression.reject(self.scan_url, encoding)
+    r = self.client.post(upload, headers, jobs.deadline())
+    compression.record(host, "out", len(upload), len(upload))
+    compression.record_response(host, r)
+    return r
+
+  @staticmethod
+  def fingerprint_for_contents(contents, path=None):
+    """ Returns the fingerprint of the contents of a file, reusing the cached fingerprints of identical contents.
+    Large files are fingerprinted in parallel, from the file at path if given.
+    """
+    if isinstance(contents, memory.Blob):
+      with contents.view() as data:
+        return Scanner.fingerprint_for_contents(data, contents.path)
+    md5 = hashlib.md5(contents).hexdigest()
+    fp = cache.fingerprints.get(md5)
+    if fp is None:
+      fp = fingerprinting.fingerprint(contents, path)
+      cache.fingerprints.put(md5, fp)
+    return fp
 
 
   def format_scan_results(self, scan_results):
@@ -88,9 +227,6 @@ class Scanner:
     """
     cyclondx = {"bomFormat": "CycloneDX", "specVersion": "1.2",  "version": 1, "components" : [] }
     cyclondx_components = []
-    # Troubleshooting ONLY
-    with open("/tmp/scan_results", "w") as f:
-      f.write(json.dumps(scan_results))
 
     matches = []
     for f, m in scan_results.items():
@@ -100,13 +236,12 @@ class Scanner:
           
           lic = []
           licenses = match['licenses']
-          logging.debug(licenses)
           if licenses:
             for l in licenses:
               lic.append({ 'id': l["name"]})
           
           component = {"type": "Library", "publisher": match["vendor"], "version": match['version'], "purl" : match['purl'][0], 'licenses': lic}
-          logging.debug(json.dumps(component))
+          logs.sampled_debug("component", "Component matched by %s: %s", f, logs.payload(component))
           cyclondx_components.append(component)
    # cyclondx["components"] = list(set(cyclondx_components)) # remove duplicated
     cyclondx["components"] = cyclondx_components
@@ -119,3 +254,17 @@ class Scanner:
         comment += "| %s |[%s](%s) | %s | %s |[%s](%s) | %s |\n" % (
             match[0], match[1],match[6], match[2], match[3], match[4].rsplit('/',1)[1],match[4], match[5])
       return {"validation": False, "comment": comment, "cyclondx": cyclondx}
+
+  @staticmethod
+  def format_sbom_comment(result, asset_json, sbom_file):
+    """ Returns the comment of a formatted scan result (see format_scan_results) followed by the CycloneDX
+    components to declare in the SBOM file.
+    """
+    full_comment = result['comment']
+    if result['cyclondx']:
+      full_comment += "\n Please find the CycloneDX component details to add to your %s to declare the missing components here:\n" % sbom_file
+      if asset_json:
+        full_comment += "```\n"+ json.dumps(result['cyclondx']['components'], indent=2) + "\n```"
+      else:
+        full_comment += "```\n"+ json.dumps(result['cyclondx'], indent=2) + "\n```"
+    return full_comment
@@ -0,0 +1,387 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Resilient client for the SCANOSS API.
+
+All the scan requests to a SCANOSS API URL share one ScanossClient, which:
+ - limits the concurrent requests with an AIMD limit: it grows by one every 'limit' requests answered within
+   'latency-target' seconds and is halved when a request fails or is slower, at most once per round trip
+ - bounds every call by a deadline: 'timeout' seconds, or less if the caller's deadline is closer
+ - retries failed calls (connection errors, timeouts, 429 and 5xx responses) up to 'retries' times, after a full
+   jitter exponential backoff or the delay asked by a Retry-After header
+ - stops calling the API for 'open-seconds' after 'failure-threshold' consecutive failures (circuit breaker).
+   Calls fail fast with ScanossUnavailable meanwhile, which parks the calling job to be retried later (see
+   jobs.RetryLater). Once the time is up, a single probe call decides whether the circuit closes again.
+
+The state of the clients is published as metrics and served by GET /admin/scanoss.
+
+Configuration example:
+
+scanoss:
+  url: https://osskb.org
+  token: my-scanoss-token
+  client:
+    timeout: 120
+    connect-timeout: 10
+    retries: 3
+    backoff: 1
+    max-backoff: 30
+    min-concurrency: 1
+    max-concurrency: 16
+    latency-target: 30
+    failure-threshold: 5
+    open-seconds: 30
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from urllib import parse
+
+import requests
+
+from scanoss_hook import api_client, jobs, metrics
+
+DEFAULTS = {
+    "timeout": 120.0,
+    "connect-timeout": 10.0,
+    "retries": 3,
+    "backoff": 1.0,
+    "max-backoff": 30.0,
+    "min-concurrency": 1,
+    "max-concurrency": 16,
+    "initial-concurrency": 4,
+    "latency-target": 30.0,
+    "failure-threshold": 5,
+    "open-seconds": 30.0,
+}
+# Statuses meaning that the API is overloaded or failing, the call may succeed later
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_HALF_OPEN = 'half-open'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_STATES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class ScanossUnavailable(jobs.RetryLater):
+  """ Raised when the SCANOSS API cannot be called or keeps failing. Raised inside a job, it parks the job to be
+  retried after 'delay' seconds.
+  """
+
+
+class AIMDLimiter:
+  """
+  Additive increase, multiplicative decrease limit of concurrent calls.
+
+  Attributes
+  ----------
+  limit : float
+    The current limit, between minimum and maximum.
+  in_flight : int
+    The calls running.
+  """
+
+  def __init__(self, name, initial, minimum, maximum, latency_target, decrease=0.5):
+    self.name = name
+    self.minimum = minimum
+    self.maximum = maximum
+    self.limit = float(max(minimum, min(initial, maximum)))
+    self.latency_target = latency_target
+    self.decrease = decrease
+    self.in_flight = 0
+    self.last_decrease = 0.0
+    self.cond = threading.Condition()
+    self._publish()
+
+  def acquire(self, deadline=None):
+    """ Waits for a free slot until the monotonic deadline. Returns False if it expired first.
+    """
+    with self.cond:
+      while self.in_flight >= int(self.limit):
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+          return False
+        self.cond.wait(remaining)
+      self.in_flight += 1
+      self._publish()
+      return True
+
+  def release(self, started, ok):
+    """ Frees the slot of a call started at the given monotonic time, adapting the limit to its outcome.
+    """
+    now = time.monotonic()
+    with self.cond:
+      self.in_flight -= 1
+      if ok and now - started <= self.latency_target:
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+      elif started >= self.last_decrease:
+        # Calls started before the last decrease were sent at the previous limit and do not decrease it again
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.last_decrease = now
+      self._publish()
+      self.cond.notify_all()
+
+  def _publish(self):
+    labels = {"api": self.name}
+    metrics.set_gauge("scanoss_hook_scanoss_concurrency_limit", int(self.limit), labels)
+    metrics.set_gauge("scanoss_hook_scanoss_in_flight", self.in_flight, labels)
+
+
+class CircuitBreaker:
+  """
+  Stops the calls to a failing API for a while.
+
+  Attributes
+  ----------
+  state : str
+    CIRCUIT_CLOSED (calls allowed), CIRCUIT_OPEN (calls rejected) or CIRCUIT_HALF_OPEN (a probe call is running).
+  failures : int
+    The consecutive failed calls.
+
+  Every call allowed by allow() must end in success(), failure() or, if it was not sent, release_probe().
+  """
+
+  def __init__(self, name, failure_threshold, open_seconds):
+    self.name = name
+    self.failure_threshold = failure_threshold
+    self.open_seconds = open_seconds
+    self.state = CIRCUIT_CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    self.probe = None
+    self.lock = threading.Lock()
+    self._publish()
+
+  def allow(self):
+    """ Returns 0 if a call may proceed, otherwise the seconds after which it should be retried.
+    """
+    with self.lock:
+      if self.state == CIRCUIT_CLOSED:
+        return 0
+      remaining = self.opened_at + self.open_seconds - time.monotonic()
+      if self.state == CIRCUIT_OPEN and remaining <= 0:
+        self.state = CIRCUIT_HALF_OPEN
+        self.probe = threading.get_ident()
+        self._publish()
+        logging.info("Probing the %s API after %.0f seconds", self.name, self.open_seconds)
+        return 0
+      return max(remaining, 1.0)
+
+  def retry_after(self):
+    """ Returns the seconds until the circuit lets a probe call through, 0 if it is not open. Unlike allow(), it
+    does not change the state.
+    """
+    with self.lock:
+      if self.state != CIRCUIT_OPEN:
+        return 0
+      return max(self.opened_at + self.open_seconds - time.monotonic(), 0)
+
+  def release_probe(self):
+    """ Ends a call that was allowed but not sent. If it was the probe, the circuit opens again and the next call
+    becomes the probe.
+    """
+    with self.lock:
+      if self.state == CIRCUIT_HALF_OPEN and self.probe == threading.get_ident():
+        self.state = CIRCUIT_OPEN
+        self.opened_at = time.monotonic() - self.open_seconds
+        self.probe = None
+        self._publish()
+
+  def success(self):
+    with self.lock:
+      self.failures = 0
+      self.probe = None
+      if self.state != CIRCUIT_CLOSED:
+        logging.info("The %s API has recovered", self.name)
+        self.state = CIRCUIT_CLOSED
+        self._publish()
+
+  def failure(self):
+    with self.lock:
+      self.failures += 1
+      self.probe = None
+      if self.state == CIRCUIT_HALF_OPEN or (self.state == CIRCUIT_CLOSED and
+                                             self.failures >= self.failure_threshold):
+        logging.error("The %s API is failing, pausing the calls for %.0f seconds", self.name, self.open_seconds)
+        self.state = CIRCUIT_OPEN
+        self.opened_at = time.monotonic()
+        metrics.inc_counter("scanoss_hook_scanoss_circuit_opened_total", labels={"api": self.name})
+        self._publish()
+
+  def _publish(self):
+    metrics.set_gauge("scanoss_hook_scanoss_circuit_state", CIRCUIT_STATES[self.state], {"api": self.name})
+
+
+def _retry_after(response):
+  """ Returns the seconds asked by the Retry-After header of a response, None if there is none.
+  """
+  value = response.headers.get('Retry-After') if response is not None else None
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+class ScanossClient:
+  """
+  Calls the scan endpoint of a SCANOSS API.
+
+  Attributes
+  ----------
+  scan_url : str
+    The full URL used to request scans.
+  limiter : AIMDLimiter
+    The concurrency limit of the calls.
+  breaker : CircuitBreaker
+    The circuit breaker of the API.
+
+  Methods
+  -------
+  post(data, headers, deadline=None)
+    Posts a scan request and returns the response.
+
+  status()
+    Returns the state of the client.
+  """
+
+  def __init__(self, scan_url, config=None):
+    settings = dict(DEFAULTS, **(config or {}))
+    self.scan_url = scan_url
+    self.host = parse.urlsplit(scan_url).netloc
+    self.timeout = float(settings["timeout"])
+    self.connect_timeout = float(settings["connect-timeout"])
+    self.retries = int(settings["retries"])
+    self.backoff = float(settings["backoff"])
+    self.max_backoff = float(settings["max-backoff"])
+    self.limiter = AIMDLimiter(self.host, int(settings["initial-concurrency"]), int(settings["min-concurrency"]),
+                               int(settings["max-concurrency"]), float(settings["latency-target"]))
+    self.breaker = CircuitBreaker(self.host, int(settings["failure-threshold"]), float(settings["open-seconds"]))
+
+  def _outcome(self, outcome, started=None):
+    labels = {"api": self.host, "outcome": outcome}
+    metrics.inc_counter("scanoss_hook_scanoss_requests_total", labels=labels)
+    if started is not None:
+      metrics.observe("scanoss_hook_scanoss_request_seconds", time.monotonic() - started, {"api": self.host})
+
+  def _backoff(self, attempt, response):
+    delay = _retry_after(response)
+    if delay is None:
+      delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+    return delay
+
+  def post(self, data, headers, deadline=None):
+    """ Posts a scan request and returns the response, which may be a client error (4xx) but not a failure.
+    Raises ScanossUnavailable if the circuit is open or the call keeps failing, jobs.JobCancelled if the
+    calling job is superseded while waiting and jobs.DeadlineExceeded if it runs out of time.
+
+    Parameters
+    ----------
+    data :
+      The request body, iterated again on every attempt.
+    headers : dict
+      The request headers.
+    deadline : float
+      The monotonic time after which the call must be abandoned, None to only bound each attempt by 'timeout'.
+    """
+    reason = None
+    for attempt in range(self.retries + 1):
+      jobs.check_cancelled()
+      wait = self.breaker.allow()
+      if wait:
+        self._outcome("rejected")
+        raise ScanossUnavailable("The SCANOSS API circuit is open", wait)
+      call_deadline = time.monotonic() + self.timeout
+      if deadline is not None:
+        call_deadline = min(call_deadline, deadline)
+      response = None
+      sent = False
+      try:
+        if not self.limiter.acquire(call_deadline):
+          self._outcome("throttled")
+          reason = "no free slot before the deadline"
+        else:
+          started = time.monotonic()
+          ok = False
+          try:
+            remaining = max(call_deadline - started, 0.001)
+            response = api_client.get_session(self.host).post(
+                self.scan_url, data=data, headers=headers, timeout=(min(self.connect_timeout, remaining), remaining))
+            ok = response.status_code not in RETRY_STATUSES
+            reason = "status %d" % response.status_code
+          except requests.Timeout:
+            reason = "timeout"
+          except requests.ConnectionError as e:
+            reason = "connection error: %s" % e
+          finally:
+            self.limiter.release(started, ok)
+          sent = True
+          if ok:
+            self.breaker.success()
+            self._outcome("success", started)
+            return response
+          self.breaker.failure()
+          self._outcome("timeout" if reason == "timeout" else "error", started)
+      finally:
+        if not sent:
+          # Neither throttled calls nor calls aborted while sending the body (e.g. by a cancelled job) decide the
+          # circuit state
+          self.breaker.release_probe()
+      if attempt == self.retries:
+        break
+      delay = self._backoff(attempt, response)
+      if deadline is not None and time.monotonic() + delay >= deadline:
+        break
+      logging.warning("SCANOSS API call failed (%s), retrying in %.1f seconds (%d/%d)", reason, delay, attempt + 1,
+                      self.retries)
+      metrics.inc_counter("scanoss_hook_scanoss_retries_total", labels={"api": self.host})
+      time.sleep(delay)
+    # Running out of time is not a reason to retry the job later
+    jobs.check_cancelled()
+    raise ScanossUnavailable("The SCANOSS API call failed: %s" % reason,
+                             self.breaker.retry_after() or self.breaker.open_seconds)
+
+  def status(self):
+    """ Returns the state of the client as a dictionary.
+    """
+    return {"url": self.scan_url, "concurrency_limit": int(self.limiter.limit), "in_flight": self.limiter.in_flight,
+            "circuit": self.breaker.state, "consecutive_failures": self.breaker.failures}
+
+
+def get_client(scan_url, config=None):
+  """ Returns the ScanossClient shared by the calls to scan_url, created with the given 'client' settings.
+  """
+  with _clients_lock:
+    client = _clients.get(scan_url)
+    if client is None:
+      client = ScanossClient(scan_url, config)
+      _clients[scan_url] = client
+    return client
+
+
+def reset():
+  """ Forgets the clients, so they are created again with their current settings.
+  """
+  with _clients_lock:
+    _clients.clear()
+
+
+def status():
+  """ Returns the state of all the clients.
+  """
+  with _clients_lock:
+    return [client.status() for client in _clients.values()]
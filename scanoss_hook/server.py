@@ -0,0 +1,163 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+HTTP server runners for the SCANOSS webhook.
+
+serve() runs a single HTTPServer in the current process. serve_prefork() runs a supervisor process that forks N
+worker processes, each of them running its own HTTPServer and job scheduler, so fingerprinting can use all the
+cores of the host. The workers either share the listening socket inherited from the supervisor or, when
+SO_REUSEPORT is available and requested, bind their own socket and let the kernel balance the connections.
+
+The supervisor restarts crashed workers. On SIGTERM or SIGINT it forwards the signal to the workers, which stop
+accepting new webhooks, drain their queued and running jobs and exit.
+
+The git host rate limits are kept by every worker, so the configured rates are divided by the number of workers
+(see ratelimit.set_processes).
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from http.server import HTTPServer
+
+from scanoss_hook import jobs, ratelimit
+
+DEFAULT_DRAIN_TIMEOUT = 300
+RESTART_DELAY = 1.0
+LISTEN_BACKLOG = 128
+
+
+def _listen(addr, port, reuse_port=False):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  if reuse_port:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+  sock.bind((addr, port))
+  sock.listen(LISTEN_BACKLOG)
+  return sock
+
+
+def _server_for_socket(sock, handler):
+  httpd = HTTPServer(sock.getsockname()[:2], handler, bind_and_activate=False)
+  httpd.socket.close()
+  httpd.socket = sock
+  host, port = sock.getsockname()[:2]
+  httpd.server_name = socket.getfqdn(host)
+  httpd.server_port = port
+  return httpd
+
+
+def _run_worker(httpd, drain_timeout, on_start=None):
+  """ Runs an HTTPServer until SIGTERM/SIGINT, then drains the job scheduler.
+  on_start is called first, in the worker process, to start its background threads.
+  """
+  if on_start is not None:
+    on_start()
+  def stop(signum, frame):
+    logging.info("Worker %d received signal %d, draining", os.getpid(), signum)
+    # shutdown() blocks until serve_forever() returns, it cannot be called from the serving thread
+    threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  httpd.serve_forever()
+  httpd.server_close()
+  if not jobs.get_scheduler().drain(drain_timeout):
+    logging.warning("Worker %d exiting with unfinished jobs", os.getpid())
+
+
+def serve(addr, port, handler, drain_timeout=DEFAULT_DRAIN_TIMEOUT, on_start=None):
+  """ Runs the webhook in the current process.
+  """
+  _run_worker(HTTPServer((addr, port), handler), drain_timeout, on_start)
+
+
+def serve_prefork(addr, port, handler, workers, reuse_port=False, drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+                  on_start=None):
+  """ Runs a supervisor that forks and restarts 'workers' worker processes serving the webhook.
+
+  Parameters
+  ----------
+  addr : str
+    The listening address.
+  port : int
+    The listening port.
+  handler : callable
+    The request handler factory passed to HTTPServer.
+  workers : int
+    The number of worker processes.
+  reuse_port : bool
+    Whether every worker binds its own SO_REUSEPORT socket instead of sharing the supervisor one.
+  drain_timeout : float
+    Maximum time in seconds a worker waits for its jobs when stopping.
+  on_start : callable
+    Called in every worker process before it starts serving.
+  """
+  if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+    logging.warning("SO_REUSEPORT is not supported on this platform, sharing the listening socket")
+    reuse_port = False
+  shared = None if reuse_port else _listen(addr, port)
+  # Inherited by the workers, so together they stay within the rate limits of every token
+  ratelimit.set_processes(workers)
+  children = {}
+  stopping = []
+
+  def spawn(slot):
+    pid = os.fork()
+    if pid == 0:
+      status = 0
+      try:
+        sock = _listen(addr, port, reuse_port=True) if reuse_port else shared
+        _run_worker(_server_for_socket(sock, handler), drain_timeout, on_start)
+      except Exception:
+        logging.exception("Worker %d crashed", os.getpid())
+        status = 1
+      finally:
+        logging.shutdown()
+        os._exit(status)
+    children[pid] = slot
+    logging.info("Started worker %d (pid %d)", slot, pid)
+
+  def stop(signum, frame):
+    if not stopping:
+      stopping.append(signum)
+      logging.info("Supervisor received signal %d, stopping workers", signum)
+      for pid in list(children):
+        try:
+          os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+          pass
+
+  for slot in range(workers):
+    spawn(slot)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  while children:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    except InterruptedError:
+      continue
+    slot = children.pop(pid, None)
+    if slot is None:
+      continue
+    if stopping:
+      logging.info("Worker %d (pid %d) stopped", slot, pid)
+      continue
+    logging.error("Worker %d (pid %d) exited with status %d, restarting", slot, pid, status)
+    time.sleep(RESTART_DELAY)
+    if not stopping:
+      spawn(slot)
+
+  if shared is not None:
+    shared.close()
+  sys.exit(0)
@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Lightweight tracing for the SCANOSS webhook.
+
+Every webhook delivery starts a trace. Its jobs inherit the trace, and each stage (fetch, fingerprint, scan,
+report) and each outbound HTTP call is recorded as a span. Finished spans are exported in the background to:
+ - a local JSON lines file ('file' in the 'tracing' configuration section)
+ - an OTLP/HTTP compatible collector accepting JSON ('otlp', e.g. http://localhost:4318/v1/traces)
+
+The trace ID of the current thread is added to the log records as 'trace_id' by TraceIdFilter.
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import requests
+
+DEFAULT_SERVICE_NAME = "scanoss-hook"
+EXPORT_BATCH_SIZE = 100
+EXPORT_INTERVAL = 2.0
+OTLP_TIMEOUT = 5
+
+_local = threading.local()
+_exporters = []
+_queue = queue.Queue(maxsize=10000)
+_thread = None
+_thread_lock = threading.Lock()
+_service_name = DEFAULT_SERVICE_NAME
+
+
+def _new_id(size):
+  return os.urandom(size).hex()
+
+
+class Span:
+  """
+  A timed operation of a trace.
+
+  Attributes
+  ----------
+  name : str
+    The name of the operation.
+  trace_id : str
+    The 32 hex digits trace ID, shared by all the spans of a webhook delivery.
+  span_id : str
+    The 16 hex digits span ID.
+  parent_id : str
+    The span ID of the parent span, None for the root span.
+  attributes : dict
+    Attributes of the operation.
+  """
+
+  def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+    self.name = name
+    self.trace_id = trace_id or _new_id(16)
+    self.span_id = _new_id(8)
+    self.parent_id = parent_id
+    self.attributes = dict(attributes or {})
+    self.start = time.time()
+    self.end = None
+    self.error = None
+
+  def set(self, **attributes):
+    """ Adds attributes to the span.
+    """
+    self.attributes.update(attributes)
+
+  def to_dict(self):
+    return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+            "start": self.start, "end": self.end, "duration": (self.end or time.time()) - self.start,
+            "attributes": self.attributes, "error": self.error}
+
+
+def current_span():
+  """ Returns the active span of the current thread, None if there is none.
+  """
+  stack = getattr(_local, 'stack', None)
+  return stack[-1] if stack else None
+
+
+def remote_parent(trace_id, span_id):
+  """ Returns a span standing for a parent span recorded in another process, to be used with activate().
+  """
+  parent = Span("remote", trace_id=trace_id)
+  parent.span_id = span_id
+  return parent
+
+
+def current_trace_id():
+  span = current_span()
+  return span.trace_id if span else None
+
+
+@contextlib.contextmanager
+def activate(span):
+  """ Makes span (typically captured in another thread) the active span of the current thread.
+  """
+  if span is None:
+    yield None
+    return
+  stack = _local.__dict__.setdefault('stack', [])
+  stack.append(span)
+  try:
+    yield span
+  finally:
+    stack.pop()
+
+
+@contextlib.contextmanager
+def span(name, new_trace=False, **attributes):
+  """ Records the enclosed block as a span, child of the active span. Starts a new trace if there is no active
+  span or new_trace is set.
+  """
+  parent = None if new_trace else current_span()
+  s = Span(name, trace_id=parent.trace_id if parent else None, parent_id=parent.span_id if parent else None,
+           attributes=attributes)
+  with activate(s):
+    try:
+      yield s
+    except BaseException as e:
+      s.error = "%s: %s" % (type(e).__name__, e)
+      raise
+    finally:
+      s.end = time.time()
+      _export(s)
+
+
+def traced(name, new_trace=False):
+  """ Decorator that records every call to the function as a span.
+  """
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(name, new_trace=new_trace):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+class TraceIdFilter(logging.Filter):
+  """ Adds the trace ID of the active span to the log records, '-' outside of a trace.
+  """
+
+  def filter(self, record):
+    record.trace_id = current_trace_id() or '-'
+    return True
+
+
+class JSONLinesExporter:
+  """ Appends the spans as JSON lines to a file.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def export(self, spans):
+    with open(self.path, 'a') as f:
+      for s in spans:
+        f.write(json.dumps(s.to_dict()) + '\n')
+
+
+class OTLPExporter:
+  """ Posts the spans to an OTLP/HTTP collector using the JSON encoding.
+  """
+
+  def __init__(self, endpoint, headers=None):
+    self.endpoint = endpoint
+    self.headers = headers or {}
+
+  @staticmethod
+  def _value(value):
+    if isinstance(value, bool):
+      return {"boolValue": value}
+    if isinstance(value, int):
+      return {"intValue": str(value)}
+    if isinstance(value, float):
+      return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+  def _span(self, s):
+    data = {"traceId": s.trace_id, "spanId": s.span_id, "name": s.name, "kind": 1,
+            "startTimeUnixNano": str(int(s.start * 1e9)), "endTimeUnixNano": str(int((s.end or s.start) * 1e9)),
+            "attributes": [{"key": k, "value": self._value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1}}
+    if s.parent_id:
+      data["parentSpanId"] = s.parent_id
+    return data
+
+  def export(self, spans):
+    body = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": _service_name}}]},
+        "scopeSpans": [{"scope": {"name": "scanoss_hook"}, "spans": [self._span(s) for s in spans]}]}]}
+    requests.post(self.endpoint, json=body, headers=self.headers, timeout=OTLP_TIMEOUT)
+
+
+def _export(s):
+  if not _exporters:
+    return
+  _start_thread()
+  try:
+    _queue.put_nowait(s)
+  except queue.Full:
+    pass
+
+
+def _start_thread():
+  global _thread
+  with _thread_lock:
+    # The thread does not survive a fork, so check it is alive in this process
+    if _thread is None or not _thread.is_alive():
+      _thread = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+      _thread.start()
+
+
+def _export_loop():
+  while True:
+    batch = [_queue.get()]
+    deadline = time.monotonic() + EXPORT_INTERVAL
+    while len(batch) < EXPORT_BATCH_SIZE:
+      try:
+        batch.append(_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+      except queue.Empty:
+        break
+    flush(batch)
+
+
+def flush(spans):
+  """ Exports a list of spans synchronously through all the exporters.
+  """
+  for exporter in list(_exporters):
+    try:
+      exporter.export(spans)
+    except Exception as e:
+      logging.warning("Error exporting traces: %s", e)
+
+
+def configure(config):
+  """ Sets up the exporters from the 'tracing' configuration section.
+  """
+  global _service_name
+  del _exporters[:]
+  if not config:
+    return
+  _service_name = config.get('service-name', DEFAULT_SERVICE_NAME)
+  if config.get('file'):
+    _exporters.append(JSONLinesExporter(config['file']))
+  if config.get('otlp'):
+    _exporters.append(OTLPExporter(config['otlp'], config.get('otlp-headers')))
@@ -44,7 +44,13 @@ file is the MD5 hash, file length and file path being fingerprinted, followed by
 a list of WFP fingerprints with their corresponding line numbers.
 """
 
+import base64
 import hashlib
+import io
+import re
+import sys
+from array import array
+
 from crc32c import crc32
 
 
@@ -64,6 +70,14 @@ ASCII_BACKSLASH = 92
 
 MAX_CRC32 = 4294967296
 
+# Size of the chunks in which buffers other than bytes are fingerprinted
+CHUNK_SIZE = 1024 * 1024
+
+# Normalized bytes needed before a position to reach it in the same state as the serial algorithm: they fill a
+# gram and a window, so the last selected hash is known too
+WARMUP = GRAM + WINDOW - 1
+NORMALIZED_BYTES = re.compile(rb'[0-9A-Za-z]')
+
 
 def normalize(byte):
   """
@@ -116,6 +130,261 @@ def diff_to_wfp(diff, md5, src_path):
   return wfp
 
 
+class Fingerprint:
+  """
+  The compact winnowing fingerprint of a file.
+
+  The hashes are kept in two parallel arrays of 32 bit integers instead of WFP text, which is several times
+  larger. The WFP text is only produced when the fingerprint is uploaded.
+
+  Attributes
+  ----------
+  md5 : str
+    The MD5 hash of the file contents.
+  length : int
+    The length of the file contents.
+  lines : array
+    The line number of each hash, in ascending order.
+  crcs : array
+    The hashes.
+  """
+
+  __slots__ = ('md5', 'length', 'lines', 'crcs')
+
+  def __init__(self, md5, length, lines=None, crcs=None):
+    self.md5 = md5
+    self.length = length
+    self.lines = lines if lines is not None else array('I')
+    self.crcs = crcs if crcs is not None else array('I')
+
+  def __len__(self):
+    return len(self.crcs)
+
+  def __eq__(self, other):
+    return (isinstance(other, Fingerprint) and self.md5 == other.md5 and self.length == other.length and
+            self.lines == other.lines and self.crcs == other.crcs)
+
+  def add(self, line, crc):
+    self.lines.append(line)
+    self.crcs.append(crc)
+
+  def header(self, file):
+    return 'file={0},{1},{2}\n'.format(self.md5, self.length, file)
+
+  def write_wfp(self, out, file):
+    """ Writes the WFP of the file to a text stream, one line of hashes at a time.
+    """
+    out.write(self.header(file))
+    lines = self.lines
+    crcs = self.crcs
+    i = 0
+    count = len(crcs)
+    while i < count:
+      line = lines[i]
+      j = i + 1
+      while j < count and lines[j] == line:
+        j += 1
+      out.write("%d=%s\n" % (line, ','.join(['%08x' % crc for crc in crcs[i:j]])))
+      i = j
+
+  def to_wfp(self, file):
+    """ Returns the WFP of the file.
+    """
+    out = io.StringIO()
+    self.write_wfp(out, file)
+    return out.getvalue()
+
+  def wfp_size(self, file):
+    """ Returns the length of the WFP of the file without serializing it.
+    """
+    size = len(self.header(file).encode())
+    previous = None
+    for line in self.lines:
+      if line != previous:
+        size += len(str(line)) + 1
+        previous = line
+      size += 9
+    return size
+
+  def to_json(self):
+    """ Returns a JSON serializable representation, used by the shared cluster caches.
+    """
+    lines, crcs = array('I', self.lines), array('I', self.crcs)
+    if sys.byteorder == 'big':
+      lines.byteswap()
+      crcs.byteswap()
+    return [self.md5, self.length, base64.b64encode(lines.tobytes()).decode(),
+            base64.b64encode(crcs.tobytes()).decode()]
+
+  @classmethod
+  def from_json(cls, value):
+    lines, crcs = array('I'), array('I')
+    lines.frombytes(base64.b64decode(value[2]))
+    crcs.frombytes(base64.b64decode(value[3]))
+    if sys.byteorder == 'big':
+      lines.byteswap()
+      crcs.byteswap()
+    return cls(value[0], value[1], lines, crcs)
+
+
+class Winnower:
+  """
+  Incremental winnowing of a file whose contents are received in chunks, e.g. while they are downloaded.
+
+  Methods
+  -------
+  update(chunk)
+    Processes the next chunk of the contents.
+
+  finish()
+    Returns the Fingerprint of all the contents processed.
+  """
+
+  def __init__(self):
+    self.md5 = hashlib.md5()
+    self.length = 0
+    self.lines = array('I')
+    self.crcs = array('I')
+    self.gram = ""
+    self.window = []
+    self.line = 1
+    self.last_hash = MAX_CRC32
+
+  def update(self, chunk: bytes):
+    self.md5.update(chunk)
+    self.length += len(chunk)
+
+    # The state is kept in local variables while processing the chunk
+    gram = self.gram
+    window = self.window
+    line = self.line
+    last_hash = self.last_hash
+    lines = self.lines
+    crcs = self.crcs
+
+    # Otherwise recurse src_content and calculate Winnowing hashes
+    for byte in chunk:
+
+      if byte == ASCII_LF:
+        line += 1
+        normalized = 0
+      else:
+        normalized = normalize(byte)
+
+      # Is it a useful byte?
+      if normalized:
+
+        # Add byte to gram
+        gram += chr(normalized)
+
+        # Do we have a full gram?
+        if len(gram) >= GRAM:
+          gram_crc32 = crc32(gram.encode('ascii'))
+          window.append(gram_crc32)
+
+          # Do we have a full window?
+          if len(window) >= WINDOW:
+
+            # Select minimum hash for the current window
+            min_hash = min(window)
+
+            # Is the minimum hash a new one?
+            if min_hash != last_hash:
+
+              # Hashing the hash will result in a better balanced resulting data set
+              # as it will counter the winnowing effect which selects the "minimum"
+              # hash in each window
+              lines.append(line)
+              crcs.append(crc32((min_hash).to_bytes(4, byteorder='little')))
+              last_hash = min_hash
+
+            # Shift window
+            window.pop(0)
+
+          # Shift gram
+          gram = gram[1:]
+
+    self.gram = gram
+    self.line = line
+    self.last_hash = last_hash
+
+  def finish(self) -> Fingerprint:
+    return Fingerprint(self.md5.hexdigest(), self.length, self.lines, self.crcs)
+
+
+def fingerprint(contents: bytes) -> Fingerprint:
+  """ Returns the fingerprint of a file by executing the winnowing algorithm over its contents.
+
+  Parameters
+  ----------
+  contents : bytes
+    The full contents of the file as a byte array or any buffer supporting slicing, like an mmap.
+  """
+  winnower = Winnower()
+  if isinstance(contents, bytes):
+    winnower.update(contents)
+  else:
+    # Other buffers (e.g. mmap) are processed in chunks, as iterating them does not yield integers
+    for start in range(0, len(contents), CHUNK_SIZE):
+      winnower.update(contents[start:start + CHUNK_SIZE])
+  return winnower.finish()
+
+
+def warmup_start(contents, position):
+  """ Returns the offset from which winnowing reaches position in the same state as when processing contents from
+  the start, that is, the offset of the WARMUP-th normalized byte before position (0 if there are fewer).
+  """
+  lookback = 16 * WARMUP
+  while True:
+    begin = max(0, position - lookback)
+    found = [m.start() for m in NORMALIZED_BYTES.finditer(contents, begin, position)]
+    if len(found) >= WARMUP:
+      return found[-WARMUP]
+    if begin == 0:
+      return 0
+    lookback *= 4
+
+
+def split(contents, segments):
+  """ Splits contents into (warmup, start, end) segments to be fingerprinted independently.
+  """
+  size = len(contents)
+  bounds = [size * i // segments for i in range(segments + 1)]
+  return [(warmup_start(contents, bounds[i]), bounds[i], bounds[i + 1]) for i in range(segments)
+          if bounds[i] < bounds[i + 1]]
+
+
+def fingerprint_segment(contents, warmup, start, end):
+  """ Fingerprints contents[start:end], after processing contents[warmup:start] to restore the state of the
+  algorithm. Returns the line numbers relative to the warmup offset, the hashes, the number of line feeds in
+  contents[warmup:start] and the number of line feeds in contents[start:end].
+  """
+  winnower = Winnower()
+  for offset in range(warmup, start, CHUNK_SIZE):
+    winnower.update(bytes(contents[offset:min(offset + CHUNK_SIZE, start)]))
+  # The hashes of the warm up belong to the previous segment
+  del winnower.lines[:]
+  del winnower.crcs[:]
+  warmup_lines = winnower.line - 1
+  for offset in range(start, end, CHUNK_SIZE):
+    winnower.update(bytes(contents[offset:min(offset + CHUNK_SIZE, end)]))
+  return winnower.lines, winnower.crcs, warmup_lines, winnower.line - 1 - warmup_lines
+
+
+def stitch(md5, length, parts):
+  """ Returns the Fingerprint of a file from the results of fingerprint_segment for its consecutive segments.
+  """
+  result = Fingerprint(md5, length)
+  line_feeds = 0
+  for lines, crcs, warmup_lines, segment_lines in parts:
+    # Line feeds before the warm up of the segment
+    offset = line_feeds - warmup_lines
+    result.lines.extend(line + offset for line in lines)
+    result.crcs.extend(crcs)
+    line_feeds += segment_lines
+  return result
+
+
 def wfp_for_file(file: str, contents: bytes) -> str:
   """ Returns the WFP for a file by executing the winnowing algorithm over its contents.
 
@@ -126,73 +395,4 @@ def wfp_for_file(file: str, contents: bytes) -> str:
   contents : bytes
     The full contents of the file as a byte array.
   """
-  file_md5 = hashlib.md5(
-      contents).hexdigest()
-  # Print file line
-  wfp = 'file={0},{1},{2}\n'.format(file_md5, len(contents), file)
-
-  # Initialize variables
-  gram = ""
-  window = []
-  normalized = 0
-  line = 1
-  min_hash = MAX_CRC32
-  last_hash = MAX_CRC32
-  last_line = 0
-  output = ""
-
-  # Otherwise recurse src_content and calculate Winnowing hashes
-  for byte in contents:
-
-    if byte == ASCII_LF:
-      line += 1
-      normalized = 0
-    else:
-      normalized = normalize(byte)
-
-    # Is it a useful byte?
-    if normalized:
-
-      # Add byte to gram
-      gram += chr(normalized)
-
-      # Do we have a full gram?
-      if len(gram) >= GRAM:
-        gram_crc32 = crc32(gram.encode('ascii'))
-        window.append(gram_crc32)
-
-        # Do we have a full window?
-        if len(window) >= WINDOW:
-
-          # Select minimum hash for the current window
-          min_hash = min(window)
-
-          # Is the minimum hash a new one?
-          if min_hash != last_hash:
-
-            # Hashing the hash will result in a better balanced resulting data set
-            # as it will counter the winnowing effect which selects the "minimum"
-            # hash in each window
-            crc = crc32((min_hash).to_bytes(4, byteorder='little'))
-            crc_hex = '{:08x}'.format(crc)
-
-            if last_line != line:
-              if output:
-                wfp += output + '\n'
-              output = "%d=%s" % (line, crc_hex)
-            else:
-              output += ',' + crc_hex
-
-            last_line = line
-            last_hash = min_hash
-
-          # Shift window
-          window.pop(0)
-
-        # Shift gram
-        gram = gram[1:]
-
-  if output:
-    wfp += output + '\n'
-
-  return wfp
+  return fingerprint(contents).to_wfp(file)
@@ -8,8 +8,10 @@ setup(
     setup_requires=["pytest-runner"],
     tests_require=["pytest", "grappa"],
     install_requires=["requests", "crc32c", "pyyaml", "pyjwt[crypto]"],
+    extras_require={"zstd": ["zstandard"]},
     entry_points={
-        'console_scripts': ['scanoss-hook=scanoss_hook.command_line:main'],
+        'console_scripts': ['scanoss-hook=scanoss_hook.command_line:main',
+                            'scanoss-hook-loadtest=scanoss_hook.loadtest:main'],
     },
     packages=find_packages(),
     classifiers=[
@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+A local stand-in for a Redis server implementing the commands used by the cluster backend.
+"""
+
+import socketserver
+import threading
+import time
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self):
+    self.data = {}
+    self.lists = {}
+    self.lock = threading.Condition()
+    super().__init__(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+
+  @property
+  def url(self):
+    return "redis://127.0.0.1:%d/0" % self.server_address[1]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+  def _read_command(self):
+    line = self.rfile.readline()
+    if not line:
+      return None
+    args = []
+    for _ in range(int(line[1:-2])):
+      length = int(self.rfile.readline()[1:-2])
+      args.append(self.rfile.read(length + 2)[:-2])
+    return args
+
+  def _bulk(self, value):
+    if value is None:
+      return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+  def handle(self):
+    server = self.server
+    while True:
+      args = self._read_command()
+      if args is None:
+        return
+      command = args[0].upper()
+      with server.lock:
+        if command in (b"SELECT", b"AUTH"):
+          reply = b"+OK\r\n"
+        elif command == b"GET":
+          entry = server.data.get(args[1])
+          reply = self._bulk(entry[0] if entry and entry[1] > time.time() else None)
+        elif command == b"SET":
+          options = [a.upper() for a in args[3:]]
+          ttl = int(args[3 + options.index(b"EX") + 1]) if b"EX" in options else 1e9
+          entry = server.data.get(args[1])
+          if b"NX" in options and entry and entry[1] > time.time():
+            reply = b"$-1\r\n"
+          else:
+            server.data[args[1]] = (args[2], time.time() + ttl)
+            reply = b"+OK\r\n"
+        elif command == b"EXPIRE":
+          entry = server.data.get(args[1])
+          if entry and entry[1] > time.time():
+            server.data[args[1]] = (entry[0], time.time() + int(args[2]))
+          reply = b":%d\r\n" % (1 if entry else 0)
+        elif command == b"DEL":
+          reply = b":%d\r\n" % (1 if server.data.pop(args[1], None) else 0)
+        elif command == b"LPUSH":
+          server.lists.setdefault(args[1], []).insert(0, args[2])
+          server.lock.notify_all()
+          reply = b":%d\r\n" % len(server.lists[args[1]])
+        elif command == b"BRPOP":
+          deadline = time.time() + int(args[2])
+          while not server.lists.get(args[1]) and time.time() < deadline:
+            server.lock.wait(deadline - time.time())
+          if server.lists.get(args[1]):
+            reply = b"*2\r\n" + self._bulk(args[1]) + self._bulk(server.lists[args[1]].pop())
+          else:
+            reply = b"*-1\r\n"
+        else:
+          reply = b"-ERR unknown command\r\n"
+      self.wfile.write(reply)
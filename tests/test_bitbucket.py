@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+from functools import partial
+
+from grappa import should
+
+from scanoss_hook import cache, jobs, metrics
+from scanoss_hook.jobs import JobScheduler, RetryLater
+from scanoss_hook.mock_servers import MockServer
+from scanoss_hook.router import make_handler
+
+COMMITS = [{"hash": "a1"}, {"hash": "b2"}, {"hash": "c3"}]
+
+
+def test_commits_are_scanned_separately():
+  cache.results.clear()
+  mock = MockServer(files=25, file_size=1500).start()
+  try:
+    config = {'bitbucket': {'api-base': mock.url + '/bitbucket/2.0', 'api-key': 'key', 'api-user': 'user'},
+              'scanoss': {'url': mock.url + '/scanoss', 'token': 'token'}}
+    handler = make_handler('bitbucket', config, logging.getLogger('test'))
+    base_url = mock.url + '/bitbucket/2.0/repositories/ws/repo'
+    handler.process_commits_diff(base_url, COMMITS)
+    requests = mock.state.requests
+    # Two diffstat pages per commit
+    requests["bitbucket_diffstat"] | should.be.equal.to(6)
+    # 25 files and the assets file per commit
+    requests["bitbucket_src"] | should.be.equal.to(78)
+    requests["scanoss_scan"] | should.be.equal.to(3)
+    requests["scanoss_files"] | should.be.equal.to(75)
+    requests["bitbucket_status"] | should.be.equal.to(3)
+    requests.get("bitbucket_diff") | should.be.none
+
+    # The same commits pushed to another branch are not downloaded again
+    handler.process_commits_diff(base_url, COMMITS)
+    requests["bitbucket_src"] | should.be.equal.to(81)
+  finally:
+    mock.shutdown()
+
+
+def test_timed_out_scan_is_reported():
+  cache.results.clear()
+  mock = MockServer(files=2, file_size=1500, scan_latency=3).start()
+  try:
+    config = {'bitbucket': {'api-base': mock.url + '/bitbucket/2.0', 'api-key': 'key', 'api-user': 'user'},
+              'scanoss': {'url': mock.url + '/scanoss', 'token': 'token'}}
+    handler = make_handler('bitbucket', config, logging.getLogger('test'))
+    base_url = mock.url + '/bitbucket/2.0/repositories/ws/slow'
+    statuses = []
+    update_build_status = handler.api.update_build_status
+
+    def record_status(base_url, commit, status=False, description=None):
+      statuses.append((commit['hash'], status))
+      update_build_status(base_url, commit, status, description)
+
+    handler.api.update_build_status = record_status
+    # Bitbucket lists the commits of a push newest first
+    job = JobScheduler(workers=1, budget=1.0).submit("bitbucket:ws/slow", handler.process_commits_diff, base_url,
+                                                     COMMITS[:2])
+    job.done.wait(5) | should.be.true
+    # The scan of the head commit is abandoned and its build status reports the time out
+    statuses | should.be.equal.to([("a1", False)])
+    mock.state.requests["bitbucket_status"] | should.be.equal.to(1)
+    metrics.get("scanoss_hook_jobs_timed_out_total",
+                {"repo": "bitbucket:ws/slow", "stage": "scan"}) | should.be.equal.to(1)
+  finally:
+    mock.shutdown()
+
+
+def test_transient_fetch_errors_retry_the_commit():
+  cache.results.clear()
+  cache.blobs.clear()
+  mock = MockServer(files=3, file_size=1500, src_errors=1).start()
+  try:
+    config = {'bitbucket': {'api-base': mock.url + '/bitbucket/2.0', 'api-key': 'key', 'api-user': 'user'},
+              'scanoss': {'url': mock.url + '/scanoss', 'token': 'token'}}
+    handler = make_handler('bitbucket', config, logging.getLogger('test'))
+    base_url = mock.url + '/bitbucket/2.0/repositories/ws/flaky'
+    partial(handler.api.get_file_fingerprint, base_url, {"hash": "d4"}, "src/module_0/file_0.c") | should.raise_error(
+        RetryLater)
+    # A missing file is left out of the scan
+    handler.api.get_file_fingerprint(base_url, {"hash": "d4"}, "missing.c") | should.be.none
+
+    mock.state.src_errors = 1
+    job = JobScheduler(workers=1).submit("bitbucket:ws/flaky", handler.process_commits_diff, base_url, COMMITS[:1])
+    job.done.wait(5) | should.be.true
+    job.parked | should.be.equal.to(1)
+    job.outcome | should.be.equal.to(jobs.OUTCOME_COMPLETED)
+    # The commit is scanned once, with all its files
+    mock.state.requests["scanoss_scan"] | should.be.equal.to(1)
+    mock.state.requests["scanoss_files"] | should.be.equal.to(3)
+  finally:
+    mock.shutdown()
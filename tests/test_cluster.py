@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import socket
+import time
+
+from grappa import should
+
+from scanoss_hook import cache, jobs
+from scanoss_hook.cluster import Cluster, HashRing, RedisBackend, SQLiteBackend
+from tests.redis_standin import RedisStandIn
+
+
+def _check_backend(backend):
+  backend.pop_job("node-a", 0) | should.be.none
+  backend.push_job("node-a", {"key": "1"})
+  backend.push_job("node-a", {"key": "2"})
+  backend.pop_job("node-a", 1) | should.be.equal.to({"key": "1"})
+  backend.pop_job("node-a", 1) | should.be.equal.to({"key": "2"})
+  backend.cache_get("results", "abc") | should.be.none
+  backend.cache_set("results", "abc", {"1": [{"id": "none"}]})
+  backend.cache_get("results", "abc") | should.be.equal.to({"1": [{"id": "none"}]})
+  backend.claim("delivery") | should.be.true
+  backend.claim("delivery") | should.be.false
+  backend.renew("delivery", 60)
+  backend.claim("delivery") | should.be.false
+  backend.release("delivery")
+  backend.claim("delivery") | should.be.true
+
+
+def test_sqlite_backend(tmp_path):
+  _check_backend(SQLiteBackend(str(tmp_path / "cluster.db")))
+
+
+def test_redis_backend():
+  server = RedisStandIn()
+  try:
+    _check_backend(RedisBackend(server.url))
+  finally:
+    server.shutdown()
+
+
+def test_hash_ring_is_stable():
+  ring = HashRing(["node-a", "node-b", "node-c"])
+  owners = {ring.node_for("gitlab:%d" % i) for i in range(100)}
+  owners | should.be.equal.to({"node-a", "node-b", "node-c"})
+  # Adding a node only moves the keys the new node takes over
+  bigger = HashRing(["node-a", "node-b", "node-c", "node-d"])
+  for i in range(100):
+    key = "gitlab:%d" % i
+    if bigger.node_for(key) != "node-d":
+      bigger.node_for(key) | should.be.equal.to(ring.node_for(key))
+
+
+def test_jobs_are_routed_to_the_owner_once(tmp_path):
+  backend = SQLiteBackend(str(tmp_path / "cluster.db"))
+  config = {'cluster': {'node': 'node-a', 'nodes': ['node-a', 'node-b']}}
+  cluster = Cluster(config, backend)
+  key = next(k for k in ("github:org/repo-%d" % i for i in range(100)) if cluster.ring.node_for(k) == 'node-b')
+  cluster.dispatch('github', 'process_commits_diff', key, ({"full_name": key}, [{"id": "abc"}]), delivery="d1")
+  # The same delivery received by another node is not scanned again
+  Cluster(dict(config, cluster={'node': 'node-b', 'nodes': ['node-a', 'node-b']}), backend).dispatch(
+      'github', 'process_commits_diff', key, ({"full_name": key}, [{"id": "abc"}]), delivery="d1") | should.be.none
+  job = backend.pop_job('node-b', 0)
+  job['args'] | should.be.equal.to([{"full_name": key}, [{"id": "abc"}]])
+  backend.pop_job('node-b', 0) | should.be.none
+  # Another delivery of the same commits, e.g. a manual redelivery, is scanned
+  cluster.dispatch('github', 'process_commits_diff', key, ({"full_name": key}, [{"id": "abc"}]), delivery="d2")
+  backend.pop_job('node-b', 0)['claim'] | should.not_be.equal.to(job['claim'])
+
+
+class _Handler:
+  provider = 'gitlab'
+
+  def __init__(self):
+    self.runs = 0
+
+  def process_commits_diff(self, fail):
+    self.runs += 1
+    if fail:
+      raise RuntimeError("scan failed")
+
+
+def test_failed_jobs_release_their_claim(tmp_path):
+  backend = SQLiteBackend(str(tmp_path / "cluster.db"))
+  cluster = Cluster({'cluster': {'node': 'node-a'}}, backend)
+  handler = cluster.handlers['gitlab'] = _Handler()
+  outcomes = []
+  for fail in (True, True, False, False):
+    job = cluster.dispatch('gitlab', 'process_commits_diff', 'gitlab:1', (fail,), delivery="d1")
+    if job is not None:
+      job.done.wait(5) | should.be.true
+      outcomes.append(job.outcome)
+  # The failed delivery is scanned again until it completes, then it is a duplicate
+  handler.runs | should.be.equal.to(3)
+  outcomes | should.be.equal.to([jobs.OUTCOME_FAILED, jobs.OUTCOME_FAILED, jobs.OUTCOME_COMPLETED])
+
+
+def test_hung_backend_falls_back_to_local_behaviour():
+  # Connections are accepted by the kernel but never answered
+  hung = socket.socket()
+  hung.bind(('127.0.0.1', 0))
+  hung.listen(16)
+  backend = RedisBackend("redis://127.0.0.1:%d/0" % hung.getsockname()[1], timeout=0.2)
+  cluster = Cluster({'cluster': {'node': 'node-a', 'nodes': ['node-a', 'node-b']}}, backend)
+  handler = cluster.handlers['gitlab'] = _Handler()
+  try:
+    start = time.monotonic()
+    key = next(k for k in ("gitlab:%d" % i for i in range(100)) if cluster.ring.node_for(k) == 'node-b')
+    # The delivery cannot be claimed nor routed, it is processed on this node
+    job = cluster.dispatch('gitlab', 'process_commits_diff', key, (False,), delivery="d1")
+    job.done.wait(5) | should.be.true
+    job.outcome | should.be.equal.to(jobs.OUTCOME_COMPLETED)
+    handler.runs | should.be.equal.to(1)
+    # The shared cache is skipped
+    cache.set_backend(backend)
+    cache.results.put("abc", {"1": []})
+    cache.results.get("abc") | should.be.equal.to({"1": []})
+    cache.results.get("missing") | should.be.none
+    (time.monotonic() - start) | should.be.lower.than(5)
+  finally:
+    cache.set_backend(None)
+    hung.close()
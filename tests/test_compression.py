@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import gzip
+import time
+from urllib import parse
+
+import requests
+from grappa import should
+
+from scanoss_hook import cache, compression, metrics
+from scanoss_hook.mock_servers import MockServer, file_contents
+from scanoss_hook.scanner import Scanner
+
+FILES = {"src/a%d.c" % i: file_contents("src/a%d.c" % i, "1", 8000) for i in range(5)}
+
+
+def _scan(mock, encoding):
+  cache.results.clear()
+  metrics.reset()
+  scanner = Scanner({'scanoss': {'url': mock.url + '/scanoss', 'token': 'token', 'compression': encoding}})
+  results = scanner.scan_files(FILES, None)
+  labels = {"host": parse.urlsplit(mock.url).netloc, "direction": "out"}
+  return (results, metrics.get("scanoss_hook_transfer_wire_bytes_total", labels),
+          metrics.get("scanoss_hook_transfer_logical_bytes_total", labels))
+
+
+def test_compressed_upload():
+  mock = MockServer().start()
+  try:
+    results, wire, logical = _scan(mock, 'gzip')
+    sorted(results) | should.be.equal.to(sorted(FILES))
+    mock.state.requests["scanoss_scan_gzip"] | should.be.equal.to(1)
+    wire | should.be.lower.than(logical)
+  finally:
+    mock.shutdown()
+
+
+def test_fallback_to_uncompressed_upload():
+  mock = MockServer(compressed_uploads=False).start()
+  try:
+    results, wire, logical = _scan(mock, 'gzip')
+    sorted(results) | should.be.equal.to(sorted(FILES))
+    wire | should.be.equal.to(logical)
+    compression.accepts(mock.url + '/scanoss/api/scan/direct', 'gzip') | should.be.false
+    # The endpoint is not sent compressed uploads anymore
+    _scan(mock, 'gzip')
+    mock.state.requests["scanoss_scan"] | should.be.equal.to(2)
+  finally:
+    mock.shutdown()
+
+
+def test_compressed_body():
+  chunks = [b"line %d\n" % i for i in range(10000)]
+  with compression.compress(chunks, 'gzip') as body:
+    data = b''.join(body)
+    len(data) | should.be.equal.to(len(body))
+    gzip.decompress(data) | should.be.equal.to(b''.join(chunks))
+
+
+def _response(status, text):
+  response = requests.Response()
+  response.status_code = status
+  response._content = text.encode()
+  return response
+
+
+def test_only_encoding_errors_are_rejections():
+  compression.rejected(_response(415, ""), 'gzip') | should.be.true
+  compression.rejected(_response(400, '{"error": "Unsupported Content-Encoding"}'), 'gzip') | should.be.true
+  compression.rejected(_response(400, "cannot decode gzip body"), 'gzip') | should.be.true
+  compression.rejected(_response(400, '{"error": "Invalid WFP"}'), 'gzip') | should.be.false
+  compression.rejected(_response(500, "gzip"), 'gzip') | should.be.false
+
+
+def test_rejections_expire():
+  url = "http://rejecting.example/scan"
+  compression.reject(url, 'gzip', ttl=0.05)
+  compression.accepts(url, 'gzip') | should.be.false
+  compression.accepts(url, 'zstd') | should.be.true
+  time.sleep(0.1)
+  compression.accepts(url, 'gzip') | should.be.true
@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+from functools import partial
+
+from github import UnknownObjectException
+from grappa import should
+
+from scanoss_hook import cache, mock_servers
+from scanoss_hook.jobs import DeadlineExceeded
+from scanoss_hook.github import GH_GRAPHQL_BATCH, GitHubAPI
+from scanoss_hook.ratelimit import PRIORITY_NORMAL
+from scanoss_hook.mock_servers import MockServer, file_contents
+from scanoss_hook.router import make_handler
+
+REPOSITORY = {"name": "repo", "full_name": "owner/repo", "default_branch": "main",
+              "owner": {"login": "owner", "name": "owner", "type": "User"}}
+
+
+def _handler(mock):
+  config = {'github': {'api-base': mock.url + '/github', 'api-key': 'key', 'secret-token': 'secret',
+                       'bulk-fetch': True},
+            'scanoss': {'url': mock.url + '/scanoss', 'token': 'token', 'comment_always': 1,
+                        'sbom_filename': 'SBOM.json'}}
+  return make_handler('github', config, logging.getLogger('test'))
+
+
+def test_bulk_fetch_contents():
+  mock = MockServer(files=GH_GRAPHQL_BATCH + 10, file_size=1000).start()
+  try:
+    api = GitHubAPI(mock.url + '/github', 'key')
+    files = api.get_commit_files("owner/repo", "abc")
+    len(files) | should.be.equal.to(GH_GRAPHQL_BATCH + 10)
+    contents = api.get_contents("owner/repo", "abc", files + [{"filename": "SBOM.json"}])
+    sorted(contents) | should.be.equal.to(sorted(f['filename'] for f in files))
+    for f in files:
+      contents[f['filename']].getvalue() | should.be.equal.to(file_contents(f['filename'], "abc", 1000))
+    mock.state.requests["github_graphql"] | should.be.equal.to(2)
+    mock.state.requests.get("github_blob") | should.be.none
+  finally:
+    mock.shutdown()
+
+
+def test_large_files_use_blobs_api():
+  mock = MockServer(files=2, file_size=mock_servers.GRAPHQL_TEXT_LIMIT + 1).start()
+  try:
+    api = GitHubAPI(mock.url + '/github', 'key')
+    files = api.get_compare_files("owner/repo", "abc", "def")
+    contents = api.get_contents("owner/repo", "def", files)
+    for f in files:
+      contents[f['filename']].getvalue() | should.be.equal.to(
+          file_contents(f['filename'], "def", mock_servers.GRAPHQL_TEXT_LIMIT + 1))
+    mock.state.requests["github_blob"] | should.be.equal.to(2)
+  finally:
+    mock.shutdown()
+
+
+def test_push_range_is_scanned_at_once():
+  cache.results.clear()
+  mock = MockServer(files=5, file_size=2000).start()
+  try:
+    handler = _handler(mock)
+    handler.process_commits_diff(REPOSITORY, [{"id": "c1"}, {"id": "c2"}, {"id": "c3"}], "c0")
+    requests = mock.state.requests
+    requests["github_compare"] | should.be.equal.to(1)
+    requests["github_graphql"] | should.be.equal.to(1)
+    requests["scanoss_scan"] | should.be.equal.to(1)
+    requests["github_comment"] | should.be.equal.to(1)
+    requests.get("github_commit") | should.be.none
+    requests.get("github_contents") | should.be.none
+  finally:
+    mock.shutdown()
+
+
+def test_rate_limit_is_read_from_the_responses():
+  mock = MockServer().start()
+  try:
+    handler = _handler(mock)
+    user = handler.call_api(PRIORITY_NORMAL, handler.g.get_user, "owner")
+    handler.call_api(PRIORITY_NORMAL, user.get_repo, "repo")
+    # Without rate limit headers, no extra call is made to fetch them
+    mock.state.requests.get("github_rate_limit") | should.be.none
+  finally:
+    mock.shutdown()
+
+
+def test_commit_contents_are_streamed_from_the_blobs_api():
+  cache.results.clear()
+  mock = MockServer(files=3, file_size=2000).start()
+  try:
+    handler = _handler(mock)
+    repo = handler.call_api(PRIORITY_NORMAL, handler.g.get_repo, "owner/repo")
+    handler.process_commit(repo, "c1")
+    requests = mock.state.requests
+    requests["github_blob"] | should.be.equal.to(3)
+    # Only the SBOM file is fetched with the contents API
+    requests["github_contents"] | should.be.equal.to(1)
+    requests["scanoss_scan"] | should.be.equal.to(1)
+  finally:
+    mock.shutdown()
+
+
+class _Commit:
+  raw_data = {"files": []}
+
+  def create_comment(self, comment):
+    pass
+
+
+class _Repo:
+  """ A PyGithub repository whose SBOM fetch raises the given exception.
+  """
+  full_name = "owner/repo"
+
+  def __init__(self, error):
+    self.error = error
+
+  def get_commit(self, sha):
+    return _Commit()
+
+  def get_contents(self, path, ref=None):
+    raise self.error
+
+
+def test_job_control_exceptions_are_not_taken_for_a_missing_sbom():
+  mock = MockServer().start()
+  try:
+    handler = _handler(mock)
+    validation, _ = handler.process_commit(_Repo(UnknownObjectException(404, {}, {})), "c1")
+    validation | should.be.true
+    partial(handler.process_commit, _Repo(DeadlineExceeded("Out of time", "fetch")), "c1") | should.raise_error(
+        DeadlineExceeded)
+  finally:
+    mock.shutdown()
@@ -0,0 +1,25 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+from grappa import should
+
+from scanoss_hook.gitlab import GitLabAPI
+from scanoss_hook.mock_servers import MockServer, file_contents
+from scanoss_hook.winnowing import fingerprint
+
+PROJECT = {"id": 42}
+COMMIT = {"id": "c0ffee"}
+
+
+def test_streamed_fingerprints():
+  mock = MockServer(files=2, file_size=300000).start()
+  try:
+    api = GitLabAPI({'gitlab': {'api-key': 'key', 'api-base': mock.url + '/gitlab/api/v4'}})
+    filename = mock.state.paths()[1]
+    fp = api.get_file_fingerprint(PROJECT, COMMIT, filename)
+    fp | should.be.equal.to(fingerprint(file_contents(filename, COMMIT["id"], 300000)))
+    api.get_file_fingerprint(PROJECT, COMMIT, "missing.c") | should.be.none
+  finally:
+    mock.shutdown()
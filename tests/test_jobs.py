@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+from grappa import should
+
+from scanoss_hook import jobs, metrics
+from scanoss_hook.jobs import PRIORITY_PR, DeadlineExceeded, JobScheduler, check_cancelled
+
+
+def test_small_repos_are_not_starved_by_a_large_push():
+  scheduler = JobScheduler(workers=1, max_per_repo=1)
+  gate = threading.Event()
+  order = []
+  # Block the only worker so the rest of the jobs are queued
+  first = scheduler.submit("big", gate.wait)
+  for i in range(5):
+    scheduler.submit("big", order.append, "big-%d" % i)
+  last = scheduler.submit("small", order.append, "small")
+  gate.set()
+  first.done.wait(5)
+  last.done.wait(5)
+  order.index("small") | should.be.lower.than(2)
+
+
+def test_pull_requests_go_ahead_of_pushes():
+  scheduler = JobScheduler(workers=1, max_per_repo=1)
+  gate = threading.Event()
+  order = []
+  blocker = scheduler.submit("a", gate.wait)
+  scheduler.submit("b", order.append, "b-push")
+  pr = scheduler.submit("c", order.append, "c-pr", priority=PRIORITY_PR)
+  gate.set()
+  blocker.done.wait(5)
+  pr.done.wait(5)
+  order[0] | should.be.equal.to("c-pr")
+
+
+def test_per_repo_concurrency_cap():
+  scheduler = JobScheduler(workers=4, max_per_repo=1)
+  gate = threading.Event()
+  blocker = scheduler.submit("a", gate.wait)
+  blocker.done.wait(0.1)
+  scheduler.submit("a", gate.wait)
+  blocker.done.wait(0.1)
+  scheduler.queued("a") | should.be.equal.to(1)
+  metrics.get("scanoss_hook_jobs_running", {"repo": "a"}) | should.be.equal.to(1)
+  gate.set()
+
+
+def test_new_push_supersedes_queued_and_running_jobs():
+  scheduler = JobScheduler(workers=2, max_per_repo=2, quiet_period=0.1)
+  started = threading.Event()
+  order = []
+
+  def long_scan(name):
+    started.set()
+    while True:
+      check_cancelled()
+      time.sleep(0.01)
+
+  running = scheduler.submit("r", long_scan, "old", supersede=("r", "refs/heads/main"))
+  started.wait(5)
+  queued = scheduler.submit("r", order.append, "queued", supersede=("r", "refs/heads/main"))
+  newest = scheduler.submit("r", order.append, "newest", supersede=("r", "refs/heads/main"))
+  for job in (running, queued, newest):
+    job.done.wait(5) | should.be.true
+  running.cancelled.is_set() | should.be.true
+  order | should.be.equal.to(["newest"])
+
+
+def test_quiet_period_delays_start():
+  scheduler = JobScheduler(workers=1, quiet_period=0.2)
+  job = scheduler.submit("r", time.monotonic, supersede=("r", "refs/heads/dev"))
+  job.done.wait(5)
+  (job.started_at - job.enqueued_at >= 0.15) | should.be.true
+
+
+def test_quiet_period_holds_back_only_its_supersede_key():
+  scheduler = JobScheduler(workers=1, quiet_period=0.5)
+  order = []
+  waiting = scheduler.submit("r", order.append, "dev", supersede=("r", "refs/heads/dev"))
+  other = scheduler.submit("r", order.append, "main", supersede=("r", "refs/heads/main"))
+  plain = scheduler.submit("r", order.append, "plain")
+  # The job without a supersede key does not wait behind the jobs in their quiet period
+  plain.done.wait(5) | should.be.true
+  waiting.done.is_set() | should.be.false
+  waiting.done.wait(5) | should.be.true
+  other.done.wait(5) | should.be.true
+  order | should.be.equal.to(["plain", "dev", "main"])
+
+
+def test_job_runs_out_of_time_in_its_stage():
+  scheduler = JobScheduler(workers=1, budget=1.0)
+  timeouts = []
+
+  def slow_fetch():
+    try:
+      with jobs.stage("fetch"):
+        # The fetch stage leaves 60% of the budget to the next stages
+        timeouts.append(jobs.timeout(60))
+        while True:
+          check_cancelled()
+          time.sleep(0.01)
+    except DeadlineExceeded as e:
+      with jobs.overtime(5):
+        check_cancelled()
+        timeouts.append(time.monotonic() - jobs.current_job().started_at)
+      raise
+
+  job = scheduler.submit("slow", slow_fetch)
+  job.done.wait(5) | should.be.true
+  (0.3 < timeouts[0] <= 0.4) | should.be.true
+  (0.4 <= timeouts[1] < 0.9) | should.be.true
+  metrics.get("scanoss_hook_jobs_timed_out_total", {"repo": "slow", "stage": "fetch"}) | should.be.equal.to(1)
+
+
+def test_no_deadline_outside_of_a_budget():
+  jobs.timeout(60) | should.be.equal.to(60)
+  jobs.deadline() | should.be.none
+  job = JobScheduler(workers=1).submit("r", jobs.deadline)
+  job.done.wait(5)
+  job.deadline | should.be.none
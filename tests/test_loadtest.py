@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+from grappa import should
+
+from scanoss_hook import capture, loadtest
+from scanoss_hook.mock_servers import MockServer
+from scanoss_hook.router import RoutingRequestHandler
+
+
+def _serve_hook(mock_url):
+  config = {
+      'gitlab': {'api-base': mock_url + '/gitlab/api/v4', 'api-key': 'key', 'secret-token': 'secret'},
+      'github': {'api-base': mock_url + '/github', 'api-key': 'key', 'secret-token': 'secret'},
+      'bitbucket': {'api-base': mock_url + '/bitbucket/2.0', 'api-key': 'key', 'api-user': 'user'},
+      'scanoss': {'url': mock_url + '/scanoss', 'token': 'token', 'comment_always': 1, 'sbom_filename': 'SBOM.json'},
+  }
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(RoutingRequestHandler, config, logging.getLogger('test')))
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  return httpd, "http://127.0.0.1:%d" % httpd.server_port
+
+
+def test_replay_against_mocks():
+  mock = MockServer(files=3, file_size=2048, match_ratio=0.5).start()
+  httpd, url = _serve_hook(mock.url)
+  try:
+    deliveries = (loadtest.generate('gitlab', 3, mock.url, commits=2, secret='secret') +
+                  loadtest.generate('bitbucket', 2, mock.url) +
+                  loadtest.generate('github', 2, mock.url))
+    replayer = loadtest.Replayer(url, github_secret='secret')
+    report = replayer.report(replayer.run(deliveries, concurrency=3))
+    report['sent'] | should.be.equal.to(7)
+    report['errors'] | should.be.equal.to(0)
+    stats = loadtest.wait_for_scans(mock.url, 10, 30)
+    stats['completed'] | should.be.equal.to(10)
+    stats['requests']['scanoss_scan'] | should.be.equal.to(10)
+  finally:
+    httpd.shutdown()
+    mock.shutdown()
+
+
+def test_capture_round_trip(tmp_path):
+  capture.configure({'dir': str(tmp_path), 'max-files': 2})
+  try:
+    for i in range(3):
+      handler = SimpleNamespace(path="/gitlab", headers={'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': 'secret'})
+      capture.record('gitlab', handler, ('{"n": %d}' % i).encode())
+  finally:
+    capture.configure(None)
+  deliveries = capture.load(str(tmp_path))
+  [d['body'] for d in deliveries] | should.be.equal.to(['{"n": 1}', '{"n": 2}'])
+  path, headers, body = loadtest.prepare(deliveries[0], rewrites=[('"n"', '"m"')])
+  body | should.be.equal.to(b'{"m": 1}')
+  headers | should.be.equal.to({'X-Gitlab-Event': 'Push Hook'})
+  path, headers, body = loadtest.prepare(deliveries[0], gitlab_secret='secret')
+  headers | should.be.equal.to({'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': 'secret'})
+
+
+def test_percentile():
+  loadtest.percentile([], 50) | should.be.equal.to(0.0)
+  loadtest.percentile(list(range(1, 101)), 50) | should.be.equal.to(50)
+  loadtest.percentile(list(range(1, 101)), 99) | should.be.equal.to(99)
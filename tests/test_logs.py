@@ -0,0 +1,86 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import io
+import logging
+import queue
+
+from grappa import should
+
+from scanoss_hook import logs, metrics, tracing
+
+
+def teardown_function():
+  logs.stop()
+  logging.getLogger().setLevel(logging.WARNING)
+  logging.getLogger("urllib3").setLevel(logging.NOTSET)
+
+
+def _record(module, level):
+  return logging.LogRecord("root", level, "/src/scanoss_hook/%s.py" % module, 1, "msg", None, None)
+
+
+def test_records_are_written_in_the_background(tmp_path):
+  stream = io.StringIO()
+  path = tmp_path / "hook.log"
+  logs.configure({"level": "INFO", "file": str(path)}, stream=stream)
+  with tracing.span("webhook", new_trace=True) as root:
+    logging.info("Scanned %d files", 3)
+  logging.debug("Not written")
+  logs.stop()
+  stream.getvalue() | should.contain("[%s] Scanned 3 files" % root.trace_id)
+  stream.getvalue() | should.do_not.contain("Not written")
+  path.read_text() | should.be.equal.to(stream.getvalue())
+
+
+def test_levels_by_module():
+  logs.configure({"level": "WARNING", "file": None, "levels": {"scanoss_hook.scanner": "DEBUG", "urllib3": "ERROR"}},
+                 stream=None)
+  logging.getLogger().level | should.be.equal.to(logging.DEBUG)
+  logging.getLogger("urllib3").level | should.be.equal.to(logging.ERROR)
+  level_filter = logs.LevelFilter(logging.WARNING, {"scanoss_hook.scanner": logging.DEBUG, "urllib3": logging.ERROR})
+  level_filter.filter(_record("scanner", logging.DEBUG)) | should.be.true
+  level_filter.filter(_record("gitlab", logging.INFO)) | should.be.false
+  level_filter.filter(_record("gitlab", logging.WARNING)) | should.be.true
+  record = _record("connectionpool", logging.ERROR)
+  record.name = "urllib3.connectionpool"
+  level_filter.filter(record) | should.be.true
+
+
+def test_payloads_are_lazy_and_capped():
+  logs.configure({"level": "INFO", "file": None, "payload-limit": 10}, stream=None)
+  serialized = []
+
+  class Value:
+    def __repr__(self):
+      serialized.append(True)
+      return "value"
+
+  logging.debug("%s", logs.payload(Value()))
+  serialized | should.be.empty
+  str(logs.payload(Value())) | should.be.equal.to("value")
+  str(logs.payload({"purl": "pkg:github/scanoss/engine"})) | should.be.equal.to(
+      '{"purl": "... (27 more characters)')
+  str(logs.payload("short")) | should.be.equal.to("short")
+
+
+def test_debug_lines_are_sampled():
+  stream = io.StringIO()
+  logs.configure({"level": "DEBUG", "file": None, "sample-rate": 2}, stream=stream)
+  before = metrics.get("scanoss_hook_log_sampled_out_total", {"key": "file"}) or 0
+  for i in range(10):
+    logs.sampled_debug("file", "Fetching file %d", i)
+  logs.stop()
+  stream.getvalue().count("Fetching file") | should.be.equal.to(2)
+  metrics.get("scanoss_hook_log_sampled_out_total", {"key": "file"}) | should.be.equal.to(before + 8)
+
+
+def test_full_queue_drops_records():
+  handler = logs.DroppingQueueHandler(queue.Queue(1))
+  before = metrics.get("scanoss_hook_log_dropped_total") or 0
+  for _ in range(3):
+    handler.handle(_record("gitlab", logging.ERROR))
+  handler.queue.qsize() | should.be.equal.to(1)
+  metrics.get("scanoss_hook_log_dropped_total") | should.be.equal.to(before + 2)
@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+from types import SimpleNamespace
+
+from grappa import should
+
+from scanoss_hook import jobs, memory
+from scanoss_hook.mock_servers import file_contents
+from scanoss_hook.scanner import Scanner
+from scanoss_hook.winnowing import fingerprint
+
+CONTENTS = file_contents("big.c", "1", 50000)
+
+
+def _configure(**settings):
+  memory.configure({"global-budget": settings.get("global_budget", 1000000),
+                    "job-budget": settings.get("job_budget", 100000),
+                    "spill-threshold": settings.get("spill_threshold", 40000)})
+
+
+def teardown_function():
+  memory.configure({"global-budget": memory.DEFAULT_GLOBAL_BUDGET, "job-budget": memory.DEFAULT_JOB_BUDGET,
+                    "spill-threshold": memory.DEFAULT_SPILL_THRESHOLD})
+
+
+def test_large_blobs_are_spilled_and_fingerprinted_through_mmap():
+  _configure()
+  small = memory.from_bytes(CONTENTS[:1000])
+  small.spilled | should.be.false
+  with small.view() as data:
+    # A view of the buffer, not a copy
+    data | should.be.a(memoryview)
+    fingerprint(data) | should.be.equal.to(fingerprint(CONTENTS[:1000]))
+  # The buffer is released with the view
+  small.write(CONTENTS[1000:2000])
+  Scanner.fingerprint_for_contents(small) | should.be.equal.to(fingerprint(CONTENTS[:2000]))
+  big = memory.from_bytes(CONTENTS)
+  big.spilled | should.be.true
+  big.getvalue() | should.be.equal.to(CONTENTS)
+  Scanner.fingerprint_for_contents(big) | should.be.equal.to(fingerprint(CONTENTS))
+  with big.view() as data:
+    fingerprint(data) | should.be.equal.to(fingerprint(CONTENTS))
+  big.close()
+  small.close()
+
+
+def test_job_budget_and_peak():
+  _configure(job_budget=30000)
+  job = SimpleNamespace(id=12345, stats={})
+  with memory.job_budget(job), jobs.activate(job):
+    blobs = [memory.from_bytes(CONTENTS[:20000]) for _ in range(2)]
+    # The second blob does not fit in the budget of the job
+    [b.spilled for b in blobs] | should.be.equal.to([False, True])
+    memory.usage() | should.be.equal.to({"used": 20000, "peak": 20000})
+    for b in blobs:
+      b.close()
+    memory.usage()["used"] | should.be.equal.to(0)
+  job.stats["peak_memory_bytes"] | should.be.equal.to(20000)
+
+
+def test_global_budget_spills_instead_of_waiting():
+  _configure(global_budget=30000, job_budget=25000)
+  first = SimpleNamespace(id=1, stats={})
+  second = SimpleNamespace(id=2, stats={})
+  # Jobs holding no contents start without waiting for each other
+  with memory.job_budget(first), memory.job_budget(second):
+    with jobs.activate(first):
+      held = memory.from_bytes(CONTENTS[:20000])
+    with jobs.activate(second):
+      # Within the budget of the job, but not within what is left of the global budget
+      memory.from_bytes(CONTENTS[:20000]).spilled | should.be.true
+      memory.from_bytes(CONTENTS[:5000]).spilled | should.be.false
+    held.close()
+    with jobs.activate(second):
+      memory.from_bytes(CONTENTS[:15000]).spilled | should.be.false
@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import logging
+import threading
+import time
+from functools import partial
+from http.server import HTTPServer
+
+import requests
+from grappa import should
+
+from scanoss_hook import jobs, profiling
+from scanoss_hook.jobs import JobScheduler
+from scanoss_hook.router import RoutingRequestHandler
+
+SETTINGS = dict(profiling._settings)
+
+
+def teardown_function():
+  profiling._settings.clear()
+  profiling._settings.update(SETTINGS)
+  profiling._armed.update({"until": 0.0, "jobs": 0})
+  profiling._cprofile["active"] = False
+
+
+def _busy(seconds):
+  jobs.add_stats(files=3, bytes_fingerprinted=1024)
+  end = time.monotonic() + seconds
+  while time.monotonic() < end:
+    pass
+
+
+def test_armed_jobs_are_profiled(tmp_path):
+  profiling.configure({"dir": str(tmp_path)})
+  profiling.arm(jobs=1)
+  scheduler = JobScheduler(workers=1)
+  scheduler.submit("group/repo", _busy, 0.01, cost=2).done.wait(5)
+  scheduler.submit("group/repo", _busy, 0.01).done.wait(5)
+  len(list(tmp_path.glob("*.prof"))) | should.be.equal.to(1)
+  tags = json.loads(next(tmp_path.glob("*.json")).read_text())
+  tags["repo"] | should.be.equal.to("group/repo")
+  tags["commits"] | should.be.equal.to(2)
+  tags["files"] | should.be.equal.to(3)
+  tags["bytes_fingerprinted"] | should.be.equal.to(1024)
+
+
+def test_overlapping_armed_jobs_are_sampled(tmp_path):
+  profiling.configure({"dir": str(tmp_path), "sample-interval": 0.005})
+  profiling.arm(jobs=2)
+  scheduler = JobScheduler(workers=2)
+  barrier = threading.Barrier(2, timeout=5)
+
+  def overlapping():
+    barrier.wait()
+    _busy(0.2)
+
+  first = scheduler.submit("group/a", overlapping)
+  second = scheduler.submit("group/b", overlapping)
+  first.done.wait(5) | should.be.true
+  second.done.wait(5) | should.be.true
+  first.outcome | should.be.equal.to(jobs.OUTCOME_COMPLETED)
+  second.outcome | should.be.equal.to(jobs.OUTCOME_COMPLETED)
+  len(list(tmp_path.glob("*.prof"))) | should.be.equal.to(1)
+  folded = list(tmp_path.glob("*.folded"))
+  len(folded) | should.be.equal.to(1)
+  folded[0].read_text() | should.contain("_busy")
+  profiling._cprofile["active"] | should.be.false
+
+
+def test_slow_jobs_are_auto_profiled(tmp_path):
+  profiling.configure({"dir": str(tmp_path), "auto-wall": 0.2, "sample-interval": 0.005})
+  scheduler = JobScheduler(workers=1)
+  scheduler.submit("fast", _busy, 0.01).done.wait(5)
+  scheduler.submit("slow", _busy, 0.3).done.wait(5)
+  folded = list(tmp_path.glob("*.folded"))
+  len(folded) | should.be.equal.to(1)
+  folded[0].read_text() | should.contain("_busy")
+
+
+def test_profiling_is_armed_only_by_an_authorized_post():
+  config = {}
+  httpd = HTTPServer(('127.0.0.1', 0), partial(RoutingRequestHandler, config, logging.getLogger('test')))
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  url = "http://127.0.0.1:%d/admin/profile" % httpd.server_port
+  auth = {"Authorization": "Bearer admin-token"}
+  try:
+    requests.get(url, params={"jobs": 5}).json()["jobs"] | should.be.equal.to(0)
+    requests.post(url, params={"jobs": 5}).status_code | should.be.equal.to(403)
+    config['admin'] = {'token': 'admin-token'}
+    requests.post(url, params={"jobs": 5}).status_code | should.be.equal.to(401)
+    requests.post(url, params={"jobs": -1}, headers=auth).status_code | should.be.equal.to(400)
+    requests.post(url, params={"jobs": 5}, headers=auth).json()["jobs"] | should.be.equal.to(5)
+    requests.get(url, headers=auth).json()["jobs"] | should.be.equal.to(5)
+    profiling.status()["jobs"] | should.be.equal.to(5)
+  finally:
+    httpd.shutdown()
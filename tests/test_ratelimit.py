@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+
+from grappa import should
+
+from scanoss_hook import metrics, ratelimit
+from scanoss_hook.ratelimit import PRIORITY_HIGH, PRIORITY_LOW, RateLimiter, get_limiter
+
+
+def teardown_function():
+  ratelimit.set_processes(1)
+
+
+def test_learns_budget_from_headers():
+  limiter = RateLimiter("gitlab.example.com", "t1", rate=10, burst=20)
+  reset = time.time() + 100
+  limiter.update(200, {'RateLimit-Remaining': '50', 'RateLimit-Reset': str(int(reset))})
+  limiter.remaining | should.be.equal.to(50)
+  # 50 requests left for ~100 seconds
+  (limiter.rate < 1) | should.be.true
+  metrics.get("scanoss_hook_ratelimit_remaining", limiter.labels) | should.be.equal.to(50)
+
+
+def test_throttled_response_blocks_bucket():
+  limiter = RateLimiter("bitbucket.example.com", "t2", rate=100, burst=5)
+  limiter.update(429, {'Retry-After': '0.2'})
+  start = time.monotonic()
+  limiter.acquire(PRIORITY_HIGH)
+  (time.monotonic() - start >= 0.15) | should.be.true
+
+
+def test_low_priority_yields_to_file_fetches():
+  limiter = RateLimiter("api.github.com", "t3", rate=20, burst=2, low_reserve=0)
+  limiter.tokens = 0
+  order = []
+
+  def worker(priority, name):
+    limiter.acquire(priority)
+    order.append(name)
+
+  low = threading.Thread(target=worker, args=(PRIORITY_LOW, 'low'))
+  low.start()
+  time.sleep(0.01)
+  high = threading.Thread(target=worker, args=(PRIORITY_HIGH, 'high'))
+  high.start()
+  low.join()
+  high.join()
+  order | should.be.equal.to(['high', 'low'])
+
+
+def test_limiters_are_shared_per_host_and_token():
+  get_limiter("h", "a") | should.be.equal.to(get_limiter("h", "a"))
+  get_limiter("h", "a") | should.not_be.equal.to(get_limiter("h", "b"))
+
+
+def test_rate_limits_are_split_between_processes():
+  ratelimit.set_processes(4)
+  limiter = get_limiter("split.example.com", "t4")
+  limiter.rate | should.be.equal.to(ratelimit.DEFAULT_RATE / 4)
+  limiter.burst | should.be.equal.to(ratelimit.DEFAULT_BURST / 4)
+  limiter.update(200, {'RateLimit-Remaining': '400', 'RateLimit-Reset': str(int(time.time() + 1000))})
+  # Each process spreads a quarter of the remaining budget
+  (limiter.rate < 0.11) | should.be.true
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import threading
+from functools import partial
+from http.server import HTTPServer
+
+import requests
+from grappa import should
+
+from scanoss_hook import cache, results_store
+from scanoss_hook.mock_servers import MockServer, file_contents
+from scanoss_hook.results_store import Source
+from scanoss_hook.router import RoutingRequestHandler
+from scanoss_hook.scanner import Scanner
+from scanoss_hook.winnowing import fingerprint
+
+FILES = {"src/c%d.c" % i: file_contents("src/c%d.c" % i, "1", 3000) for i in range(6)}
+PURL = "pkg:github/mock/mock-component"
+
+
+def teardown_function():
+  results_store.configure(None)
+
+
+def _scan(mock, tmp_path):
+  cache.results.clear()
+  results_store.configure({"path": str(tmp_path / "results.db")})
+  config = {'scanoss': {'url': mock.url + '/scanoss', 'token': 'token'}}
+  scanner = Scanner(config)
+  results = scanner.scan_files(FILES, None, Source("github", "acme/app", "c1"))
+  scanner.scan_files(FILES, '{"components": []}', Source("gitlab", "acme/lib", "c2", "c0"))
+  return config, results
+
+
+def test_results_are_stored_and_indexed(tmp_path):
+  mock = MockServer(match_ratio=0.5).start()
+  try:
+    _, results = _scan(mock, tmp_path)
+    store = results_store.get_store()
+    scan = store.get_commit("acme/app", "c1")
+    scan["results"] | should.be.equal.to(results)
+    scan["files"]["src/c0.c"] | should.be.equal.to(fingerprint(FILES["src/c0.c"]).md5)
+    store.get_commit("acme/lib", "c2")["base"] | should.be.equal.to("c0")
+    store.get_commit("acme/app", "c2") | should.be.none
+    matched = sorted(f for f, m in results.items() if m[0].get('id') != 'none')
+    len(matched) | should.be.higher.than(0)
+    found = store.find_purl(PURL, repo="acme/app")
+    sorted(m["path"] for m in found) | should.be.equal.to(matched)
+    len(store.find_purl(PURL, version="1.0.0")) | should.be.equal.to(2 * len(matched))
+    store.find_purl(PURL, version="2.0.0") | should.be.empty
+    [m["repo"] for m in store.find_md5(scan["files"]["src/c1.c"])] | should.be.equal.to(["acme/lib", "acme/app"])
+  finally:
+    mock.shutdown()
+
+
+def test_results_endpoints_do_not_call_the_apis(tmp_path):
+  mock = MockServer(match_ratio=1.0).start()
+  try:
+    config, results = _scan(mock, tmp_path)
+    scans = mock.state.requests["scanoss_scan"]
+  finally:
+    mock.shutdown()
+  config['admin'] = {'token': 'admin-token'}
+  httpd = HTTPServer(('127.0.0.1', 0), partial(RoutingRequestHandler, config, logging.getLogger('test')))
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  url = "http://127.0.0.1:%d/admin/results" % httpd.server_port
+  get = partial(requests.get, headers={"Authorization": "Bearer admin-token"})
+  try:
+    r = get(url, params={"repo": "acme/app", "commit": "c1"})
+    r.json()["results"] | should.be.equal.to(results)
+    comment = get(url + "/comment", params={"repo": "acme/app", "commit": "c1"}).json()
+    comment["validation"] | should.be.false
+    comment["comment"] | should.contain(PURL)
+    comment["comment"] | should.contain("SBOM.json")
+    bom = get(url + "/cyclonedx", params={"repo": "acme/lib", "commit": "c2"}).json()
+    len(bom["components"]) | should.be.equal.to(len(FILES))
+    matches = get(url + "/purl", params={"purl": PURL}).json()["matches"]
+    sorted(set(m["commit"] for m in matches)) | should.be.equal.to(["c1", "c2"])
+    get(url, params={"repo": "acme/app", "commit": "nope"}).status_code | should.be.equal.to(404)
+    get(url + "/purl").status_code | should.be.equal.to(400)
+    requests.get(url, params={"repo": "acme/app", "commit": "c1"}).status_code | should.be.equal.to(401)
+    del config['admin']
+    get(url, params={"repo": "acme/app", "commit": "c1"}).status_code | should.be.equal.to(403)
+    mock.state.requests["scanoss_scan"] | should.be.equal.to(scans)
+  finally:
+    httpd.shutdown()
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import threading
+from functools import partial
+from http.server import HTTPServer
+
+import requests
+from grappa import should
+
+from scanoss_hook.router import RoutingRequestHandler
+
+CONFIG = {
+    'gitlab': {'api-base': 'http://127.0.0.1:1/api/v4', 'api-key': 'key', 'secret-token': 'secret'},
+    'bitbucket': {'api-base': 'http://127.0.0.1:1/2.0', 'api-key': 'key', 'api-user': 'user'},
+    'scanoss': {'url': 'http://127.0.0.1:1', 'token': 'token'},
+}
+
+
+def _serve():
+  httpd = HTTPServer(('127.0.0.1', 0), partial(RoutingRequestHandler, CONFIG, logging.getLogger('test')))
+  threading.Thread(target=httpd.serve_forever, daemon=True).start()
+  return httpd, "http://127.0.0.1:%d" % httpd.server_port
+
+
+def test_routes_by_path_and_event_header():
+  httpd, url = _serve()
+  try:
+    # Ignored events are acknowledged by the provider handler
+    r = requests.post(url + "/gitlab", data=b"{}", headers={'X-Gitlab-Event': 'Note Hook'})
+    r.status_code | should.be.equal.to(200)
+    r = requests.post(url + "/", data=b"{}", headers={'X-Event-Key': 'repo:fork'})
+    r.status_code | should.be.equal.to(200)
+    # A push without a valid token is rejected by the GitLab handler
+    r = requests.post(url + "/hook", data=b'{"commits": [{"id": "1"}]}',
+                      headers={'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': 'wrong'})
+    r.status_code | should.be.equal.to(401)
+  finally:
+    httpd.shutdown()
+
+
+def test_unknown_or_unconfigured_provider():
+  httpd, url = _serve()
+  try:
+    requests.post(url + "/", data=b"{}").status_code | should.be.equal.to(404)
+    requests.post(url + "/github", data=b"{}").status_code | should.be.equal.to(404)
+    requests.get(url + "/metrics").status_code | should.be.equal.to(200)
+  finally:
+    httpd.shutdown()
@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import threading
+import time
+
+from grappa import should
+
+from scanoss_hook import cache, jobs, scanoss_client
+from scanoss_hook.jobs import JobScheduler, RetryLater
+from scanoss_hook.mock_servers import MockServer, file_contents
+from scanoss_hook.scanner import Scanner
+
+FILES = {"src/b%d.c" % i: file_contents("src/b%d.c" % i, "1", 4000) for i in range(3)}
+CLIENT = {"retries": 2, "backoff": 0.01, "max-backoff": 0.05, "failure-threshold": 3, "open-seconds": 0.3}
+
+
+def _scanner(mock, **client):
+  cache.results.clear()
+  scanoss_client.reset()
+  return Scanner({'scanoss': {'url': mock.url + '/scanoss', 'token': 'token', 'client': dict(CLIENT, **client)}})
+
+
+def test_failed_calls_are_retried():
+  mock = MockServer(scan_errors=2).start()
+  try:
+    results = _scanner(mock).scan_files(FILES, None)
+    sorted(results) | should.be.equal.to(sorted(FILES))
+    mock.state.requests["scanoss_error"] | should.be.equal.to(2)
+    mock.state.requests["scanoss_scan"] | should.be.equal.to(1)
+  finally:
+    mock.shutdown()
+
+
+def test_circuit_opens_fails_fast_and_recovers():
+  mock = MockServer(scan_errors=100).start()
+  try:
+    scanner = _scanner(mock)
+    functools.partial(scanner.scan_files, FILES, None) | should.raise_error(scanoss_client.ScanossUnavailable)
+    mock.state.requests["scanoss_error"] | should.be.equal.to(3)
+    scanner.client.breaker.state | should.be.equal.to(scanoss_client.CIRCUIT_OPEN)
+    # Rejected without calling the API
+    functools.partial(scanner.scan_files, FILES, None) | should.raise_error(scanoss_client.ScanossUnavailable)
+    mock.state.requests["scanoss_error"] | should.be.equal.to(3)
+    mock.state.scan_errors = 0
+    time.sleep(0.35)
+    sorted(scanner.scan_files(FILES, None)) | should.be.equal.to(sorted(FILES))
+    scanner.client.breaker.state | should.be.equal.to(scanoss_client.CIRCUIT_CLOSED)
+    scanoss_client.status()[0]["circuit"] | should.be.equal.to("closed")
+  finally:
+    mock.shutdown()
+
+
+def test_calls_are_bounded_by_their_deadline():
+  mock = MockServer(scan_latency=2.0).start()
+  try:
+    scanner = _scanner(mock, timeout=0.2, retries=0)
+    start = time.monotonic()
+    functools.partial(scanner.scan_files, FILES, None) | should.raise_error(scanoss_client.ScanossUnavailable)
+    (time.monotonic() - start) | should.be.lower.than(1.5)
+  finally:
+    mock.shutdown()
+
+
+def test_aimd_limit():
+  limiter = scanoss_client.AIMDLimiter("test", initial=4, minimum=1, maximum=5, latency_target=1.0)
+  for _ in range(8):
+    limiter.acquire() | should.be.true
+    limiter.release(time.monotonic(), True)
+  int(limiter.limit) | should.be.equal.to(5)
+  started = time.monotonic()
+  for _ in range(3):
+    limiter.acquire()
+  # Failures of calls sent at the same limit halve it once
+  for _ in range(3):
+    limiter.release(started, False)
+  int(limiter.limit) | should.be.equal.to(2)
+  limiter.acquire()
+  limiter.acquire()
+  limiter.acquire(time.monotonic() + 0.05) | should.be.false
+
+
+def test_jobs_raising_retry_later_are_parked():
+  scheduler = JobScheduler(workers=1, max_parked=2)
+  calls = []
+
+  def flaky(fail):
+    calls.append(time.monotonic())
+    if len(calls) <= fail:
+      raise RetryLater("unavailable", 0.1)
+
+  job = scheduler.submit("repo", flaky, 1)
+  job.done.wait(5) | should.be.true
+  job.parked | should.be.equal.to(1)
+  (calls[1] - calls[0]) | should.be.higher.than(0.09)
+
+  del calls[:]
+  job = scheduler.submit("repo", flaky, 10)
+  job.done.wait(5) | should.be.true
+  len(calls) | should.be.equal.to(3)
+
+
+def test_superseded_parked_jobs_are_not_failures():
+  scheduler = JobScheduler(workers=1, max_parked=5, quiet_period=0)
+  started = threading.Event()
+  release = threading.Event()
+  calls = []
+
+  def unavailable(name):
+    calls.append(name)
+    if name == "old":
+      # Parked once, then superseded while it runs again
+      if calls.count("old") > 1:
+        started.set()
+        release.wait(5)
+      raise RetryLater("unavailable", 0.01)
+
+  old = scheduler.submit("repo", unavailable, "old", supersede=("repo", "main"))
+  started.wait(5) | should.be.true
+  new = scheduler.submit("repo", unavailable, "new", supersede=("repo", "main"))
+  release.set()
+  old.done.wait(5) | should.be.true
+  new.done.wait(5) | should.be.true
+  old.outcome | should.be.equal.to(jobs.OUTCOME_SUPERSEDED)
+  old.parked | should.be.equal.to(1)
+  new.outcome | should.be.equal.to(jobs.OUTCOME_COMPLETED)
+  calls | should.be.equal.to(["old", "old", "new"])
+
+
+def test_unsent_probe_does_not_leave_the_circuit_half_open():
+  client = scanoss_client.ScanossClient("http://127.0.0.1:9/api/scan/direct",
+                                        dict(CLIENT, **{"initial-concurrency": 1, "max-concurrency": 1,
+                                                        "open-seconds": 0.05}))
+  for _ in range(3):
+    client.breaker.failure()
+  # The only slot is held by another call, so the probe is never sent
+  client.limiter.acquire()
+  time.sleep(0.06)
+  functools.partial(client.post, b"", {}, time.monotonic() + 0.05) | should.raise_error(
+      scanoss_client.ScanossUnavailable)
+  client.breaker.state | should.be.equal.to(scanoss_client.CIRCUIT_OPEN)
+  client.limiter.release(time.monotonic(), True)
+  client.breaker.allow() | should.be.equal.to(0)
+
+
+def test_parked_jobs_skip_their_completed_items():
+  scheduler = JobScheduler(workers=1, max_parked=2)
+  processed = []
+
+  def scan(commits):
+    for commit in commits:
+      if jobs.is_completed(commit):
+        continue
+      processed.append(commit)
+      if processed == ["a", "b"]:
+        raise RetryLater("unavailable", 0.01)
+      jobs.mark_completed(commit)
+
+  job = scheduler.submit("repo", scan, ["a", "b", "c"])
+  job.done.wait(5) | should.be.true
+  processed | should.be.equal.to(["a", "b", "b", "c"])
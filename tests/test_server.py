@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+
+import requests
+from grappa import should
+
+from scanoss_hook import jobs, server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_SECONDS = 1.0
+_directory = None
+
+
+def _slow_job(directory):
+  time.sleep(JOB_SECONDS)
+  with open(os.path.join(directory, "%d-%s.done" % (os.getpid(), uuid.uuid4().hex)), "w") as f:
+    f.write("done")
+
+
+class _Handler(BaseHTTPRequestHandler):
+  """ Answers with the pid of the process serving the request, /job also queues a slow job.
+  """
+
+  def do_GET(self):
+    if self.path == '/job':
+      jobs.get_scheduler().submit("group/repo-%s" % uuid.uuid4().hex, _slow_job, _directory)
+    body = str(os.getpid()).encode()
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+def _main(mode, port, directory):
+  """ Runs the test server in a subprocess, with serve() or serve_prefork().
+  """
+  global _directory
+  _directory = directory
+  if mode == 'serve':
+    server.serve('127.0.0.1', port, _Handler, drain_timeout=10)
+  else:
+    server.serve_prefork('127.0.0.1', port, _Handler, int(mode), drain_timeout=10)
+
+
+def _free_port():
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+
+def _start(mode, tmp_path):
+  port = _free_port()
+  log = open(tmp_path / "server.log", "w")
+  process = subprocess.Popen([sys.executable, '-c', 'from tests.test_server import _main; _main(%r, %d, %r)' %
+                              (mode, port, str(tmp_path))], cwd=ROOT, stdout=log, stderr=log)
+  url = "http://127.0.0.1:%d" % port
+  _get(url + "/pid")
+  return process, url
+
+
+def _get(url, timeout=10):
+  """ Returns the pid answering url, retrying until the server accepts connections.
+  """
+  end = time.monotonic() + timeout
+  while True:
+    try:
+      return int(requests.get(url, timeout=timeout).text)
+    except requests.ConnectionError:
+      if time.monotonic() > end:
+        raise
+      time.sleep(0.05)
+
+
+def _done(tmp_path):
+  return len(list(tmp_path.glob("*.done")))
+
+
+def _alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  return True
+
+
+def test_serve_drains_running_jobs(tmp_path):
+  process, url = _start('serve', tmp_path)
+  try:
+    _get(url + "/job")
+    process.send_signal(signal.SIGTERM)
+    process.wait(10) | should.be.equal.to(0)
+    _done(tmp_path) | should.be.equal.to(1)
+  finally:
+    process.kill()
+
+
+def test_prefork_restarts_exited_workers(tmp_path):
+  process, url = _start('1', tmp_path)
+  try:
+    worker = _get(url + "/pid")
+    worker | should.not_be.equal.to(process.pid)
+    os.kill(worker, signal.SIGKILL)
+    end = time.monotonic() + 10
+    restarted = worker
+    while restarted == worker and time.monotonic() < end:
+      restarted = _get(url + "/pid")
+    restarted | should.not_be.equal.to(worker)
+    process.send_signal(signal.SIGTERM)
+    process.wait(10) | should.be.equal.to(0)
+  finally:
+    process.kill()
+
+
+def test_prefork_forwards_sigterm_and_drains_the_workers(tmp_path):
+  process, url = _start('2', tmp_path)
+  try:
+    workers = {_get(url + "/job") for _ in range(4)}
+    process.send_signal(signal.SIGTERM)
+    process.wait(10) | should.be.equal.to(0)
+    _done(tmp_path) | should.be.equal.to(4)
+    [pid for pid in workers if _alive(pid)] | should.be.empty
+  finally:
+    process.kill()
@@ -0,0 +1,47 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import logging
+
+from grappa import should
+
+from scanoss_hook import tracing
+from scanoss_hook.jobs import JobScheduler
+
+
+def test_jobs_inherit_the_delivery_trace(tmp_path):
+  path = tmp_path / "traces.jsonl"
+  exporter = tracing.JSONLinesExporter(str(path))
+  scheduler = JobScheduler(workers=1)
+  seen = []
+
+  def job():
+    with tracing.span("fetch"):
+      seen.append(tracing.current_trace_id())
+
+  with tracing.span("webhook", new_trace=True) as root:
+    submitted = scheduler.submit("repo", job)
+  submitted.done.wait(5)
+  seen | should.be.equal.to([root.trace_id])
+  exporter.export([root])
+  json.loads(path.read_text())["name"] | should.be.equal.to("webhook")
+
+
+def test_trace_id_filter():
+  record = logging.LogRecord("test", logging.INFO, __file__, 1, "msg", None, None)
+  tracing.TraceIdFilter().filter(record)
+  record.trace_id | should.be.equal.to('-')
+  with tracing.span("webhook", new_trace=True) as root:
+    tracing.TraceIdFilter().filter(record)
+  record.trace_id | should.be.equal.to(root.trace_id)
+
+
+def test_otlp_span_encoding():
+  with tracing.span("http GET", status=200) as s:
+    pass
+  encoded = tracing.OTLPExporter("http://localhost")._span(s)
+  encoded["traceId"] | should.be.equal.to(s.trace_id)
+  encoded["attributes"] | should.be.equal.to([{"key": "status", "value": {"intValue": "200"}}])
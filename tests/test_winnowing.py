@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: BSD-3-Clause
+# Copyright (C) 2017-2020, SCANOSS Ltd. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import email.parser
+import json
+
+import hashlib
+
+from grappa import should
+
+from scanoss_hook import fingerprinting, memory
+from scanoss_hook.mock_servers import file_contents
+from scanoss_hook.scanner import Scanner, WFPUpload
+from scanoss_hook.winnowing import Fingerprint, fingerprint, fingerprint_segment, split, stitch, wfp_for_file
+
+CONTENTS = file_contents("src/main.c", "1234", 6000)
+
+
+def test_wfp_format():
+  wfp = wfp_for_file("src/main.c", CONTENTS)
+  lines = wfp.splitlines()
+  lines[0] | should.start_with("file=%s,6000,src/main.c" % fingerprint(CONTENTS).md5)
+  numbers = [int(line.split('=')[0]) for line in lines[1:]]
+  numbers | should.be.equal.to(sorted(set(numbers)))
+  for line in lines[1:]:
+    for crc in line.split('=')[1].split(','):
+      len(crc) | should.be.equal.to(8)
+  wfp_for_file("empty.c", b"") | should.be.equal.to("file=d41d8cd98f00b204e9800998ecf8427e,0,empty.c\n")
+
+
+def test_fingerprint_is_compact_and_serializable():
+  fp = fingerprint(CONTENTS)
+  len(fp) | should.be.higher.than(10)
+  fp.wfp_size("7") | should.be.equal.to(len(fp.to_wfp("7").encode()))
+  Fingerprint.from_json(json.loads(json.dumps(fp.to_json()))) | should.be.equal.to(fp)
+
+
+def test_upload_body():
+  fps = [(1, fingerprint(CONTENTS)), (2, fingerprint(b"int main() { return 0; }\n" * 50))]
+  upload = WFPUpload(fps, {"assets": '{"components": []}'})
+  body = b''.join(upload)
+  len(body) | should.be.equal.to(len(upload))
+  message = email.parser.BytesParser().parsebytes(
+      b"Content-Type: " + upload.content_type.encode() + b"\r\n\r\n" + body)
+  parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+           for part in message.get_payload()}
+  parts["assets"] | should.be.equal.to(b'{"components": []}')
+  parts["file"] | should.be.equal.to(b''.join(fp.to_wfp(i).encode() for i, fp in fps))
+
+
+def _stitched(contents, segments):
+  parts = [fingerprint_segment(contents, *segment) for segment in split(contents, segments)]
+  return stitch(hashlib.md5(contents).hexdigest(), len(contents), parts)
+
+
+def test_segments_stitch_into_the_serial_fingerprint():
+  samples = [
+      CONTENTS,
+      b"".join(file_contents("f%d.c" % i, "1", 3000) for i in range(5)),
+      # A single long line, and hashes far apart from each other
+      CONTENTS.replace(b"\n", b" "),
+      b"a" + b"\n;;;\n" * 2000 + CONTENTS[:500] + b"{}\n" * 3000,
+      b"short",
+  ]
+  for contents in samples:
+    for segments in (1, 2, 3, 7, 40):
+      _stitched(contents, segments).to_wfp("f.c") | should.be.equal.to(wfp_for_file("f.c", contents))
+
+
+def test_large_files_are_fingerprinted_in_parallel():
+  contents = b"".join(file_contents("f%d.c" % i, "2", 20000) for i in range(10))
+  fingerprinting.configure({"parallel-threshold": 100000, "segment-size": 30000, "processes": 2})
+  memory.configure({"spill-threshold": 100000})
+  try:
+    fingerprinting.is_parallel(len(contents)) | should.be.true
+    fingerprinting.fingerprint(contents) | should.be.equal.to(fingerprint(contents))
+    blob = memory.from_bytes(contents)
+    blob.spilled | should.be.true
+    Scanner.fingerprint_for_contents(blob) | should.be.equal.to(fingerprint(contents))
+    chunks = [contents[i:i + 65536] for i in range(0, len(contents), 65536)]
+    fingerprinting.fingerprint_stream(chunks, len(contents)) | should.be.equal.to(fingerprint(contents))
+  finally:
+    memory.configure({"spill-threshold": memory.DEFAULT_SPILL_THRESHOLD})
+    fingerprinting.configure({"parallel-threshold": fingerprinting.DEFAULT_PARALLEL_THRESHOLD,
+                              "segment-size": fingerprinting.DEFAULT_SEGMENT_SIZE, "processes": fingerprinting.DEFAULT_PROCESSES})